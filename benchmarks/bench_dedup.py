@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Benchmark selection of image versions and removal of duplicates (getOC.select_granule_versions).
+
+Synthetic image lists of increasing size are generated for OLCI, MSI, and MODIS-Aqua, results are compared against
+the previous (quadratic) implementation up to --max-legacy images.
+
+    python benchmarks/bench_dedup.py --sizes 1000 10000 100000 --max-legacy 2000
+"""
+
+import os
+import sys
+import random
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from operator import itemgetter
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import getOC  # noqa: E402
+
+
+def olci_names(n, rng):
+    names = []
+    t0 = datetime(2018, 1, 1)
+    while len(names) < n:
+        t = t0 + timedelta(minutes=3 * len(names))
+        for center, timeliness in [(rng.choice(['MAR', 'LN1']), rng.choice(['NR', 'NT']))
+                                   for _ in range(rng.randint(1, 3))]:
+            names.append('S3%s_OL_2_WFR____%s_%s_%s_0179_053_122_1980_%s_%s_%s_002.SEN3.zip' %
+                         (rng.choice('AB'), t.strftime('%Y%m%dT%H%M%S'),
+                          (t + timedelta(minutes=3)).strftime('%Y%m%dT%H%M%S'),
+                          (t + timedelta(days=rng.randint(0, 30))).strftime('%Y%m%dT%H%M%S'),
+                          center, rng.choice('OR'), timeliness))
+    return names[0:n]
+
+
+def msi_names(n, rng):
+    names = []
+    t0 = datetime(2018, 1, 1)
+    while len(names) < n:
+        t = t0 + timedelta(minutes=len(names))
+        # reprocessing of the same product with different processing dates
+        for days in rng.sample(range(900), rng.randint(1, 3)):
+            names.append('S2A_MSIL2A_%s_N%04i_R022_T31TCJ_%s.SAFE.zip' %
+                         (t.strftime('%Y%m%dT%H%M%S'), rng.choice([213, 400, 500]),
+                          (t + timedelta(days=days)).strftime('%Y%m%dT%H%M%S')))
+    return names[0:n]
+
+
+def nasa_names(n, rng):
+    names = []
+    t0 = datetime(2018, 1, 1)
+    while len(names) < n:
+        t = t0 + timedelta(minutes=5 * len(names))
+        name = 'AQUA_MODIS.%s.L2.OC.nc' % t.strftime('%Y%m%dT%H%M%S')
+        names.extend(rng.choice([[name], [name.replace('.nc', '.NRT.nc')],
+                                 [name.replace('.nc', '.NRT.nc'), name], [name, name]]))
+    return names[0:n]
+
+
+# Previous implementation (each image name compared to the whole list)
+def legacy_find_most_recent_esa(imlistraw, instrument):
+    ref = imlistraw
+    if 'OLCI' in instrument:
+        ref = [x[0:29] for x in ref]
+        uref = np.unique(np.array(ref))
+        todelete = []
+        for singlref in uref:
+            str_match = [s for s in imlistraw if singlref in s]
+            NR_match = [s for s in str_match if '_NR_' in s]
+            NT_match = [s for s in str_match if '_NT_' in s]
+            O_match = [s for s in str_match if '_O_' in s]
+            R_match = [s for s in str_match if '_R_' in s]
+            LN1_match = [s for s in str_match if '_LN1_' in s]
+            MAR_match = [s for s in str_match if '_MAR_' in s]
+            if len(str_match) > 1:
+                if len(O_match) > 0 and len(R_match) > 0:
+                    todelete.extend(O_match)
+                if len(NR_match) > 0 and len(NT_match) > 0:
+                    todelete.extend(NR_match)
+                if len(MAR_match) > 0 and len(LN1_match) > 0:
+                    todelete.extend(LN1_match)
+                for todel in todelete:
+                    imlistraw = list(filter(todel.__ne__, imlistraw))
+    elif 'MSI' in instrument:
+        dt_processing = [datetime.strptime(x.replace('.SAFE.zip', '').split('_')[-1], '%Y%m%dT%H%M%S') for x in ref]
+        ref = ['_'.join(itemgetter(*[0, 1, 2, 4, 5])(x.replace('.SAFE.zip', '').split('_'))) for x in ref]
+        dtx = np.array(dt_processing)
+        refx = np.array(ref)
+        imlistrawx = np.array(imlistraw)
+        for singlref in np.unique(refx):
+            str_match = imlistrawx[np.where(refx == singlref)]
+            dt_match = dtx[np.where(refx == singlref)]
+            if len(dt_match) > 1:
+                dt_ref = datetime.utcnow()
+                recent_dt = dt_match[np.where(abs(dt_match - dt_ref) == min(abs(dt_match - dt_ref)))]
+                ref_tokeep = imlistrawx[np.logical_and(refx == singlref, dtx == recent_dt)]
+                for todel in str_match[ref_tokeep != str_match]:
+                    imlistraw = list(filter(todel.__ne__, imlistraw))
+    return imlistraw
+
+
+def legacy_select_granule_versions(img_names, urls, instrument):
+    if instrument == 'OLCI' or instrument == 'MSI':
+        sel = legacy_find_most_recent_esa(img_names, instrument)
+        urls = [urls[i] for i in range(len(img_names)) if img_names[i] in sel]
+        img_names = sel
+    else:
+        # NRT images are removed when the refined image is listed
+        keep = [i for i in range(len(img_names))
+                if 'NRT' not in img_names[i] or img_names[i].replace('.NRT.nc', '.nc') not in img_names]
+        img_names, urls = [img_names[i] for i in keep], [urls[i] for i in keep]
+    image_names, url_dwld = [], []
+    for x in range(len(img_names)):
+        if img_names[x] not in image_names:
+            image_names.append(img_names[x])
+            url_dwld.append(urls[x])
+    return image_names, url_dwld
+
+
+def timeit(fun, *args):
+    t = perf_counter()
+    result = fun(*args)
+    return perf_counter() - t, result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark selection of image versions and removal of duplicates')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--max-legacy', type=int, default=10000,
+                        help='largest list processed with the previous implementation')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    print('%-12s %8s %12s %12s %8s' % ('instrument', 'images', 'engine (s)', 'legacy (s)', 'match'))
+    for instrument, generator in [('OLCI', olci_names), ('MSI', msi_names), ('MODIS-Aqua', nasa_names)]:
+        for n in args.sizes:
+            names = generator(n, rng)
+            urls = ['%s%s' % (getOC.URL_GET_FILE_CMR, x) for x in names]
+            t_engine, result = timeit(getOC.select_granule_versions, names, urls, instrument)
+            if n <= args.max_legacy:
+                t_legacy, expected = timeit(legacy_select_granule_versions, names, urls, instrument)
+                print('%-12s %8i %12.4f %12.4f %8s' % (instrument, n, t_engine, t_legacy, result == expected))
+            else:
+                print('%-12s %8i %12.4f %12s %8s' % (instrument, n, t_engine, '-', '-'))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Benchmark queries (get_image_list_*) and downloads (login_download) of getOC against the local mock servers of
+benchmarks/mock_servers.py, no network access is needed.
+
+Synthetic files of points of interest of increasing size are queried on each access platform, then the first
+--max-downloads images found are downloaded. Queries/s, MB/s, and peak memory (python heap) are reported.
+
+    python benchmarks/bench_getoc.py --sizes 10 100 1000 --latency 0.02 --bandwidth 50
+    python benchmarks/bench_getoc.py --platforms cmr --query-workers 8 --workers 4 --output cmr.json
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import requests
+from pandas import read_csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import getOC  # noqa: E402
+import mock_servers  # noqa: E402
+
+# instrument, level, and product queried on each access platform
+PLATFORMS = {'cmr': ('MODIS-Aqua', 'L2', 'OC'),
+             'copernicus': ('OLCI', 'L2-WFR', 'OC'),
+             'L1L2_browser': ('MERIS', 'L2', 'OC')}
+
+
+def use_mock_servers(base_url):
+    # Send all getOC queries and downloads to the mock servers
+    getOC.URL_CMR = base_url + '/search/granules.umm_json?provider=OB_DAAC'
+    getOC.URL_GET_FILE_CMR = base_url + '/ob/getfile/'
+    getOC.URL_SEARCH_COPERNICUS = base_url + '/resto/api/collections/'
+    getOC.URL_COPERNICUS_LOGIN = base_url + '/auth/realms/CDSE/protocol/openid-connect/token'
+    getOC.URL_GET_FILE_COPERNICUS = base_url + '/odata/v1/Products'
+    getOC.URL_L12BROWSER = base_url + '/cgi/browse.pl'
+    getOC.URL_GET_FILE_CGI = base_url + '/cgi/getfile/'
+
+
+def write_pois(filename, n, rng):
+    # Points of interest at sea level latitudes in 2019 (before the NRT period), same format as getOC input files
+    t0 = datetime(2019, 1, 1)
+    with open(filename, 'w') as f:
+        for i in range(n):
+            f.write('poi%i,%s,%.5f,%.5f\n' % (i, (t0 + timedelta(hours=rng.randint(0, 364 * 24))).
+                                              strftime('%Y/%m/%d %H:%M:%S'),
+                                              rng.uniform(-60, 60), rng.uniform(-180, 180)))
+
+
+def get_stats(base_url):
+    return requests.get(base_url + '/stats').json()
+
+
+def measure(trace_memory, fun, *args):
+    # Return elapsed time, peak memory allocated by python (None if not traced), and result of fun(*args)
+    if trace_memory:
+        tracemalloc.start()
+    t = perf_counter()
+    result = fun(*args)
+    elapsed = perf_counter() - t
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def query(access_platform, pois, args):
+    instrument, level, product = PLATFORMS[access_platform]
+    query_string = getOC.set_query_string(access_platform, instrument, level, product)
+    if access_platform == 'cmr':
+        getOC.set_query_rate(access_platform, args.query_rate, args.query_workers)
+        return getOC.get_image_list_cmr(pois, access_platform, query_string, instrument, level, product, 'both',
+                                        args.query_workers, args.coalesce, footprint_index=args.footprint_index)
+    elif access_platform == 'copernicus':
+        getOC.set_query_rate(access_platform, args.query_rate, args.query_workers)
+        return getOC.get_image_list_copernicus(pois, access_platform, query_string, instrument, level,
+                                               '[0,100]', args.query_workers, args.coalesce,
+                                               footprint_index=args.footprint_index)
+    return getOC.get_image_list_l12browser(pois, access_platform, query_string, instrument, level, product,
+                                           1 / args.query_rate if args.query_rate else 0, args.query_workers)
+
+
+def run(access_platform, n_pois, base_url, args, rng, workdir):
+    # Query n_pois synthetic points of interest and download images found, return dict of results
+    instrument = PLATFORMS[access_platform][0]
+    filename = os.path.join(workdir, '%s_%i.csv' % (access_platform, n_pois))
+    write_pois(filename, n_pois, rng)
+    pois = read_csv(filename, names=['id', 'dt', 'lat', 'lon'], parse_dates=[1])
+    stats = get_stats(base_url)
+    t_query, peak_query, images = measure(args.trace_memory, query, access_platform, pois, args)
+    queries = get_stats(base_url)['queries'] - stats['queries']
+    image_names, url_dwld = images.image_list()
+    result = {'platform': access_platform, 'pois': n_pois, 'queries': queries, 'images': len(image_names),
+              'query_s': t_query, 'queries_per_s': queries / max(t_query, 1e-9), 'query_peak_mb': peak_query,
+              'downloads': 0, 'download_mb': 0, 'download_s': 0, 'mb_per_s': None, 'download_peak_mb': None}
+    if peak_query is not None:
+        result['query_peak_mb'] = peak_query / 10**6
+    if args.max_downloads == 0 or len(image_names) == 0:
+        return result
+    download_dir = os.path.join(workdir, '%s_%i' % (access_platform, n_pois))
+    os.makedirs(download_dir)
+    # download state recorded as getOC does (checksums of CMR images are then checked)
+    state = getOC.DownloadState(os.path.join(workdir, '%s_%i.db' % (access_platform, n_pois)))
+    state.register(image_names[0:args.max_downloads], url_dwld[0:args.max_downloads], images.checksums)
+    cwd = os.getcwd()
+    os.chdir(download_dir)
+    try:
+        t_download, peak_download, n_bytes = measure(
+            args.trace_memory, getOC.login_download, image_names[0:args.max_downloads], url_dwld[0:args.max_downloads],
+            instrument, access_platform, 'user', 'password', args.workers, args.segments, state, False)
+    finally:
+        os.chdir(cwd)
+    result.update({'downloads': len(os.listdir(download_dir)), 'download_mb': (n_bytes or 0) / 10**6,
+                   'download_s': t_download, 'mb_per_s': (n_bytes or 0) / 10**6 / max(t_download, 1e-9)})
+    if peak_download is not None:
+        result['download_peak_mb'] = peak_download / 10**6
+    return result
+
+
+def fmt(value, pattern):
+    return '-' if value is None else pattern % value
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark getOC queries and downloads on local mock servers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='number of points of interest queried')
+    parser.add_argument('--platforms', nargs='+', default=list(PLATFORMS.keys()), choices=list(PLATFORMS.keys()))
+    parser.add_argument('--max-downloads', type=int, default=20, help='number of images downloaded per run')
+    parser.add_argument('--query-workers', type=int, default=1)
+    parser.add_argument('--query-rate', type=float, default=None, help='queries per second, unlimited by default')
+    parser.add_argument('--coalesce', action='store_true')
+    parser.add_argument('--footprint-index', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--segments', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response of the servers')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per connection, unlimited by default')
+    parser.add_argument('--query-failure-rate', type=float, default=0)
+    parser.add_argument('--download-failure-rate', type=float, default=0,
+                        help='fraction of downloads interrupted (getOC waits before each new attempt)')
+    parser.add_argument('--corruption-rate', type=float, default=0,
+                        help='fraction of downloads with altered content (detected by checksums)')
+    parser.add_argument('--file-size', type=float, default=10, help='size of the images served in MB')
+    parser.add_argument('--no-trace-memory', action='store_false', dest='trace_memory',
+                        help='do not measure peak memory (tracemalloc slows down python code)')
+    parser.add_argument('--output', default=None, help='write results to json file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    getOC.logger.setLevel(os.environ.get('LOGLEVEL', 'WARNING'))
+    # servers run in their own process to be left out of time and memory measurements
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=mock_servers.serve, daemon=True,
+                                     args=(queue, '127.0.0.1', 0),
+                                     kwargs={'latency': args.latency,
+                                             'bandwidth': args.bandwidth * 10**6 if args.bandwidth else None,
+                                             'query_failure_rate': args.query_failure_rate,
+                                             'download_failure_rate': args.download_failure_rate,
+                                             'file_size': int(args.file_size * 10**6), 'seed': args.seed,
+                                             'corruption_rate': args.corruption_rate})
+    server.start()
+    base_url = 'http://127.0.0.1:%i' % queue.get(timeout=30)
+    use_mock_servers(base_url)
+    rng = random.Random(args.seed)
+    results = []
+    print('%-13s %6s %7s %7s %9s %10s %9s %5s %8s %9s %8s %9s' %
+          ('platform', 'pois', 'queries', 'images', 'query (s)', 'queries/s', 'peak (MB)',
+           'files', 'MB', 'dwld (s)', 'MB/s', 'peak (MB)'))
+    with tempfile.TemporaryDirectory() as workdir:
+        for access_platform in args.platforms:
+            for n_pois in args.sizes:
+                r = run(access_platform, n_pois, base_url, args, rng, workdir)
+                results.append(r)
+                print('%-13s %6i %7i %7i %9.2f %10.1f %9s %5i %8.1f %9.2f %8s %9s' %
+                      (r['platform'], r['pois'], r['queries'], r['images'], r['query_s'], r['queries_per_s'],
+                       fmt(r['query_peak_mb'], '%.1f'), r['downloads'], r['download_mb'], r['download_s'],
+                       fmt(r['mb_per_s'], '%.1f'), fmt(r['download_peak_mb'], '%.1f')))
+    server_stats = get_stats(base_url)
+    server.terminate()
+    print('Server: %(queries)i queries (%(query_failures)i failed), %(downloads)i downloads '
+          '(%(download_failures)i interrupted, %(downloads_corrupted)i corrupted), %(bytes_sent)i bytes sent' %
+          server_stats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            # metrics recorded by getOC during all runs (time per stage, retries, bytes per host)
+            json.dump({'args': vars(args), 'server_stats': server_stats, 'results': results,
+                       'metrics': getOC.metrics.summary()}, f, indent=2)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Benchmark startup of getOC: wall time and peak memory (RSS) of short command line runs, which are dominated by the
+interpreter startup and the modules imported.
+
+Runs measured (no network access is needed): python alone, import of getOC with and without pandas, --help, and -r on
+an image list whose images are already downloaded (read from the csv file, then from the download state).
+
+    python benchmarks/bench_startup.py --repeat 20
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from statistics import median
+from time import perf_counter
+
+GETOC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'getOC.py')
+IMPORT = 'import sys; sys.path.insert(0, %r); import getOC' % os.path.dirname(GETOC)
+
+
+def write_image_list(workdir, n_images):
+    # Points of interest, image list written by a previous run (getOC -w), and images already downloaded
+    with open(os.path.join(workdir, 'pts.csv'), 'w') as f:
+        for i in range(n_images):
+            f.write('poi%i,2019/01/01 12:00:00,%.5f,-70.00000\n' % (i, 40 + i / 100))
+    with open(os.path.join(workdir, 'pts_MODIS-Aqua_L2_OC.csv'), 'w') as f:
+        for i in range(n_images):
+            name = 'AQUA_MODIS.20190101T%06i.L2.OC.nc' % i
+            f.write('poi%i,2019/01/01 12:00:00,%.5f,-70.00000,%s,https://oceandata.sci.gsfc.nasa.gov/ob/getfile/%s\n'
+                    % (i, 40 + i / 100, name, name))
+            with open(os.path.join(workdir, name), 'wb') as image:
+                image.truncate(3 * 10**5)
+
+
+def run(cmd, workdir):
+    # Return wall time (s) and peak memory (MB) of cmd, the password prompted is written on stdin (the process has no
+    # controlling terminal)
+    t = perf_counter()
+    p = subprocess.Popen(cmd, cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+    p.stdin.write(b'password\n')
+    p.stdin.close()
+    _, status, rusage = os.wait4(p.pid, 0)
+    elapsed = perf_counter() - t
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError('%s exited with status %i' % (' '.join(cmd), os.waitstatus_to_exitcode(status)))
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    return elapsed, rusage.ru_maxrss / (10**6 if sys.platform == 'darwin' else 10**3)
+
+
+def imports_pandas(cmd, workdir):
+    # Run cmd again, reporting at exit whether pandas was imported (-X importtime misses modules imported with
+    # importlib, as getOC does)
+    hook = "import atexit, sys; atexit.register(lambda: sys.stderr.write('pandas=%s' % ('pandas' in sys.modules)))"
+    if cmd[1] == '-c':
+        cmd = [cmd[0], '-c', hook + '; ' + cmd[2]]
+    else:
+        cmd = [cmd[0], '-c', hook + '; import runpy; sys.argv = sys.argv[1:]; '
+                                    'runpy.run_path(sys.argv[0], run_name="__main__")'] + cmd[1:]
+    p = subprocess.run(cmd, cwd=workdir, input=b'password\n', stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       start_new_session=True)
+    return b'pandas=True' in p.stderr
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark startup time and memory of getOC command line runs')
+    parser.add_argument('--repeat', type=int, default=10, help='runs of each command (median and min reported)')
+    parser.add_argument('--images', type=int, default=100, help='images in the list read with -r')
+    args = parser.parse_args()
+
+    python = sys.executable
+    cases = [('python', [python, '-c', 'pass'], None),
+             ('import getOC', [python, '-c', IMPORT], None),
+             ('import getOC + pandas', [python, '-c', IMPORT + '; getOC.pd.DataFrame'], None),
+             ('getOC.py --help', [python, GETOC, '--help'], None),
+             ('getOC.py -r (csv)', [python, GETOC, '-i', 'MODIS-Aqua', '-u', 'user', '-r', 'pts.csv'],
+              'pts_MODIS-Aqua_L2_OC.db'),
+             ('getOC.py -r (state)', [python, GETOC, '-i', 'MODIS-Aqua', '-u', 'user', '-r', 'pts.csv'], None)]
+    print('%-24s %10s %10s %10s %7s' % ('run', 'min (ms)', 'med (ms)', 'RSS (MB)', 'pandas'))
+    with tempfile.TemporaryDirectory() as workdir:
+        write_image_list(workdir, args.images)
+        for label, cmd, remove in cases:
+            times, rss = [], []
+            for _ in range(args.repeat):
+                if remove and os.path.isfile(os.path.join(workdir, remove)):
+                    # download state removed to read the image list from the csv file
+                    os.remove(os.path.join(workdir, remove))
+                elapsed, peak = run(cmd, workdir)
+                times.append(elapsed)
+                rss.append(peak)
+            print('%-24s %10.1f %10.1f %10.1f %7s' % (label, min(times) * 1000, median(times) * 1000, max(rss),
+                                                      'yes' if imports_pandas(cmd, workdir) else 'no'))
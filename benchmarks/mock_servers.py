@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Local stand-ins for the search and download endpoints used by getOC.
+
+One http server answers all the requests getOC sends to:
+    - CMR granules.umm_json search (pages followed with the CMR-Search-After header)
+    - Copernicus dataspace resto search.json, keycloak token, OData Products(<id>) metadata (checksums), and
+      Products(<id>)/$value redirected to the file
+    - L1L2 browser browse.pl (html pages with one or several images)
+    - ob/getfile and cgi/getfile downloads (range requests, ETag)
+
+Granules are synthetic but deterministic: one granule every 5 minutes with a 20 x 20 degrees footprint, so any
+point of the globe is seen about twice a day. Files served are made of one of FILE_VARIANTS blocks repeated (the
+MD5 checksums published are then computed once per variant). Latency, bandwidth, and failure or corruption rates are
+configurable to reproduce slow or unreliable servers.
+
+    python benchmarks/mock_servers.py --port 8000 --latency 0.05 --bandwidth 20
+"""
+
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import urlsplit, parse_qsl
+
+SLOT = timedelta(minutes=5)
+EPOCH = datetime(1970, 1, 1)
+FOOTPRINT_SZ = 20
+CHUNK_SZ = 64 * 1024
+FILE_VARIANTS = 16
+
+# File name prefix of CMR collections
+CMR_MISSION = {'MODISA': 'AQUA_MODIS',
+               'MODIST': 'TERRA_MODIS',
+               'VIIRSN': 'SNPP_VIIRS',
+               'VIIRSJ1': 'JPSS1_VIIRS',
+               'VIIRSJ2': 'JPSS2_VIIRS',
+               'SEAWIFS': 'SEASTAR_SEAWIFS_GAC',
+               'OCTS': 'ADEOS_OCTS_GAC',
+               'CZCS': 'NIMBUS7_CZCS',
+               'GOCI': 'COMS_GOCI'}
+# File name prefix of L1L2 browser sensors
+L12BROWSER_MISSION = {'amod': 'AQUA_MODIS',
+                      'tmod': 'TERRA_MODIS',
+                      'vrsn': 'SNPP_VIIRS',
+                      'vrj1': 'JPSS1_VIIRS',
+                      'vrj2': 'JPSS2_VIIRS',
+                      'MLAC': 'SEASTAR_SEAWIFS_LAC',
+                      'RR': 'ENVISAT_MERIS_RR',
+                      'hi': 'ISS_HICO'}
+
+
+def parse_datetime(dt_str):
+    return datetime.strptime(dt_str[0:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def footprint(k):
+    # (w, s, e, n) of the k-th granule since 1970, footprints move along latitude then longitude like an orbit
+    s = -80 + (k % 8) * FOOTPRINT_SZ
+    w = -180 + ((k // 8) * 25) % (360 - FOOTPRINT_SZ)
+    return w, s, w + FOOTPRINT_SZ, s + FOOTPRINT_SZ
+
+
+def find_granules(start, end, box):
+    # Return (time_start, footprint) of the granules starting between start and end and intersecting box
+    w, s, e, n = box
+    k = -(-int((start - EPOCH).total_seconds()) // int(SLOT.total_seconds()))
+    granules = []
+    while EPOCH + k * SLOT <= end:
+        fw, fs, fe, fn = footprint(k)
+        if fw <= e and w <= fe and fs <= n and s <= fn:
+            granules.append((EPOCH + k * SLOT, (fw, fs, fe, fn)))
+        k += 1
+    return granules
+
+
+def file_block(name):
+    # Block of CHUNK_SZ bytes repeated in the file served for name
+    variant = hashlib.md5(name.encode()).digest()[0] % FILE_VARIANTS
+    return (hashlib.sha256(b'%i' % variant).digest() * (CHUNK_SZ // 32 + 1))[0:CHUNK_SZ]
+
+
+def granule_id(name):
+    # uuid-like identifier of Copernicus products
+    h = hashlib.md5(name.encode()).hexdigest()
+    return '%s-%s-%s-%s-%s' % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+
+class MockConfig:
+    # Behaviour of the mock server, shared by all handler threads
+    def __init__(self, latency=0, bandwidth=None, query_failure_rate=0, download_failure_rate=0,
+                 file_size=10 * 10**6, seed=0, corruption_rate=0):
+        self.latency = latency  # seconds added before answering any request
+        self.bandwidth = bandwidth  # bytes per second per connection, None for unlimited
+        self.query_failure_rate = query_failure_rate  # fraction of searches answered with HTTP 503
+        self.download_failure_rate = download_failure_rate  # fraction of downloads cut before the end
+        self.file_size = file_size
+        self.corruption_rate = corruption_rate  # fraction of downloads with one byte altered
+        self.md5 = dict()  # checksum of each file variant
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'queries': 0, 'query_failures': 0, 'downloads': 0, 'download_failures': 0,
+                      'downloads_corrupted': 0, 'bytes_sent': 0, 'logins': 0}
+        self.products = dict()  # Copernicus product id to file name
+
+    def fail(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def checksum(self, name):
+        # MD5 of the file served for name
+        block = file_block(name)
+        with self.lock:
+            if block not in self.md5:
+                md5 = hashlib.md5()
+                for position in range(0, self.file_size, CHUNK_SZ):
+                    md5.update(block[0:min(CHUNK_SZ, self.file_size - position)])
+                self.md5[block] = md5.hexdigest()
+            return self.md5[block]
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid waiting for delayed acknowledgments
+    disable_nagle_algorithm = True
+    config = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type='application/json', status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        sleep(self.config.latency)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/openid-connect/token'):
+            self.config.count('logins')
+            self.send_body(json.dumps({'access_token': 'mock-access-%i' % self.config.stats['logins'],
+                                       'expires_in': 600, 'refresh_token': 'mock-refresh', 'refresh_expires_in': 3600,
+                                       'token_type': 'Bearer'}))
+        else:
+            self.send_body('{}', status=404)
+
+    def do_GET(self):
+        sleep(self.config.latency)
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        if url.path == '/stats':
+            with self.config.lock:
+                self.send_body(json.dumps(self.config.stats))
+        elif url.path.endswith('/granules.umm_json'):
+            self.search_cmr(params)
+        elif url.path.endswith('/search.json'):
+            self.search_resto(url.path.split('/')[-2], params)
+        elif url.path.endswith('/browse.pl'):
+            self.search_l12browser(params)
+        elif '/odata/v1/Products(' in url.path and url.path.endswith('/$value'):
+            self.redirect_odata(url.path)
+        elif '/odata/v1/Products(' in url.path:
+            self.product_odata(url.path)
+        elif '/getfile/' in url.path or url.path.startswith('/download/'):
+            self.send_file(url.path.split('/')[-1])
+        else:
+            self.send_body('{}', status=404)
+
+    def query_failed(self):
+        self.config.count('queries')
+        if self.config.fail(self.config.query_failure_rate):
+            self.config.count('query_failures')
+            self.send_body(json.dumps({'errors': ['Service temporarily unavailable']}), status=503)
+            return True
+        return False
+
+    def search_cmr(self, params):
+        if self.query_failed():
+            return
+        short_name = params['short_name']
+        box = [float(x) for x in params['bounding_box'].split(',')]
+        start, end = [parse_datetime(x) for x in params['temporal'].split(',')]
+        page_size = int(params.get('page_size', 10))
+        offset = int(json.loads(self.headers.get('CMR-Search-After', '[0]'))[0])
+        mission, *suffix = short_name.split('_')
+        granules = find_granules(start, end, box)
+        items = []
+        for t, (w, s, e, n) in granules[offset:offset + page_size]:
+            name = '%s.%s.%s.nc' % (CMR_MISSION.get(mission, mission), t.strftime('%Y%m%dT%H%M%S'), '.'.join(suffix))
+            items.append({'umm': {'GranuleUR': name,
+                                  'TemporalExtent': {'RangeDateTime': {
+                                      'BeginningDateTime': t.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                      'EndingDateTime': (t + SLOT).strftime('%Y-%m-%dT%H:%M:%S.000Z')}},
+                                  'DataGranule': {'DayNightFlag': 'Day' if -90 <= w < 90 else 'Night',
+                                                  'ArchiveAndDistributionInformation': [
+                                                      {'Name': name, 'SizeInBytes': self.config.file_size,
+                                                       'Checksum': {'Value': self.config.checksum(name),
+                                                                    'Algorithm': 'MD5'}}]},
+                                  'SpatialExtent': {'HorizontalSpatialDomain': {'Geometry': {'BoundingRectangles': [
+                                      {'WestBoundingCoordinate': w, 'SouthBoundingCoordinate': s,
+                                       'EastBoundingCoordinate': e, 'NorthBoundingCoordinate': n}]}}},
+                                  'RelatedUrls': [{'URL': 'http://%s:%i/ob/getfile/%s' %
+                                                          (*self.server.server_address, name),
+                                                   'Type': 'GET DATA'}]}})
+        headers = {'CMR-Hits': str(len(granules))}
+        if offset + page_size < len(granules):
+            headers['CMR-Search-After'] = json.dumps([offset + page_size])
+        self.send_body(json.dumps({'hits': len(granules), 'took': 1, 'items': items}), headers=headers)
+
+    def search_resto(self, collection, params):
+        if self.query_failed():
+            return
+        box = [float(x) for x in params['box'].split(',')]
+        start, end = parse_datetime(params['startDate']), parse_datetime(params['completionDate'])
+        max_records = int(params.get('maxRecords', 20))
+        page = int(params.get('page', 1))
+        features = []
+        for t, (w, s, e, n) in find_granules(start, end, box)[(page - 1) * max_records:page * max_records]:
+            t_end = t + SLOT
+            if collection == 'Sentinel2':
+                name = 'S2A_MSIL2A_%s_N0509_R022_T31TCJ_%s.SAFE' % (t.strftime('%Y%m%dT%H%M%S'),
+                                                                  (t + timedelta(days=1)).strftime('%Y%m%dT%H%M%S'))
+            else:
+                name = 'S3A_OL_2_WFR____%s_%s_%s_0179_053_122_1980_MAR_O_NT_002.SEN3' % \
+                       (t.strftime('%Y%m%dT%H%M%S'), t_end.strftime('%Y%m%dT%H%M%S'),
+                        (t + timedelta(days=1)).strftime('%Y%m%dT%H%M%S'))
+            product_id = granule_id(name)
+            with self.config.lock:
+                self.config.products[product_id] = name + '.zip'
+            features.append({'type': 'Feature', 'id': product_id,
+                             'geometry': {'type': 'Polygon',
+                                          'coordinates': [[[w, s], [e, s], [e, n], [w, n], [w, s]]]},
+                             'properties': {'title': name, 'collection': collection,
+                                            'startDate': t.strftime('%Y-%m-%dT%H:%M:%S.000000Z'),
+                                            'completionDate': t_end.strftime('%Y-%m-%dT%H:%M:%S.000000Z')}})
+        self.send_body(json.dumps({'type': 'FeatureCollection', 'features': features,
+                                   'properties': {'itemsPerPage': max_records, 'page': page}}))
+
+    def search_l12browser(self, params):
+        if self.query_failed():
+            return
+        day = EPOCH + timedelta(days=int(params['day']))
+        box = [float(params[x]) for x in ['w', 's', 'e', 'n']]
+        mission = L12BROWSER_MISSION.get(params.get('sen'), params.get('sen'))
+        suffix = 'L1A.nc' if params.get('prm') == 'TC' else 'L2.%s.nc' % {'CHL': 'OC'}.get(params.get('prm'),
+                                                                                           params.get('prm'))
+        names = ['%s.%s.%s' % (mission, t.strftime('%Y%m%dT%H%M%S'), suffix)
+                 for t, _ in find_granules(day, day + timedelta(days=1) - timedelta(seconds=1), box)]
+        if len(names) == 1:
+            html = '<html><body><a href="https://oceandata.sci.gsfc.nasa.gov/ob/getfile/%s">%s</a></body></html>' % \
+                   (names[0], names[0])
+        else:
+            html = '<html><body>%s</body></html>' % ''.join(
+                '<img src="/browse_images/%s.png" title="%s"\nwidth="70" height="70">' % (x, x) for x in names)
+        self.send_body(html, 'text/html')
+
+    def product_odata(self, path):
+        product_id = re.search(r'Products\((.*?)\)', path).group(1)
+        with self.config.lock:
+            name = self.config.products.get(product_id)
+        if name is None:
+            self.send_body(json.dumps({'detail': 'Product not found'}), status=404)
+            return
+        self.send_body(json.dumps({'Id': product_id, 'Name': name.replace('.zip', ''),
+                                   'ContentLength': self.config.file_size,
+                                   'Checksum': [{'Value': self.config.checksum(name), 'Algorithm': 'MD5'},
+                                                {'Value': hashlib.sha256(name.encode()).hexdigest(),
+                                                 'Algorithm': 'BLAKE3'}]}))
+
+    def redirect_odata(self, path):
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_body(json.dumps({'detail': 'Not authenticated'}), status=401)
+            return
+        product_id = re.search(r'Products\((.*?)\)', path).group(1)
+        self.send_body('', 'text/plain', 302, {'Location': 'http://%s:%i/download/%s' %
+                                                           (*self.server.server_address, product_id)})
+
+    def send_file(self, name):
+        # Serve deterministic content of config.file_size bytes, honouring range requests
+        self.config.count('downloads')
+        with self.config.lock:
+            name = self.config.products.get(name, name)
+        size = self.config.file_size
+        etag = '"%s"' % hashlib.md5(name.encode()).hexdigest()
+        block = file_block(name)
+        if self.config.fail(self.config.corruption_rate):
+            self.config.count('downloads_corrupted')
+            block = bytes([block[0] ^ 0xFF]) + block[1:]
+        start, end = 0, size - 1
+        content_range = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        partial = content_range is not None and self.headers.get('If-Range', etag) == etag
+        if partial:
+            start = int(content_range.group(1))
+            end = min(int(content_range.group(2)), size - 1) if content_range.group(2) else size - 1
+            if start >= size:
+                self.send_body('', 'text/plain', 416, {'Content-Range': 'bytes */%i' % size})
+                return
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if partial:
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end, size))
+        self.end_headers()
+        # connection dropped after a random number of bytes
+        cut = end + 1
+        if self.config.fail(self.config.download_failure_rate):
+            self.config.count('download_failures')
+            cut = start + int(self.config.random.random() * (end + 1 - start))
+        position = start
+        try:
+            while position < cut:
+                n = min(CHUNK_SZ - position % CHUNK_SZ, cut - position)
+                self.wfile.write(block[position % CHUNK_SZ:position % CHUNK_SZ + n])
+                position += n
+                self.config.count('bytes_sent', n)
+                if self.config.bandwidth:
+                    sleep(n / self.config.bandwidth)
+        except (ConnectionError, OSError):
+            self.close_connection = True
+            return
+        if cut <= end:
+            self.close_connection = True
+            self.wfile.flush()
+            self.connection.shutdown(2)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing kept-alive connections are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    # Start the mock server in a background thread, return the server (server_address gives the port bound)
+    handler = type('Handler', (MockHandler,), {'config': config})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve(queue, host, port, **kwargs):
+    # Run the mock server in a child process (multiprocessing target), sending the port bound on queue
+    server = start_server(MockConfig(**kwargs), host, port)
+    queue.put(server.server_address[1])
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve mock CMR, Copernicus, and L1L2 browser endpoints')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per connection, unlimited by default')
+    parser.add_argument('--query-failure-rate', type=float, default=0)
+    parser.add_argument('--download-failure-rate', type=float, default=0)
+    parser.add_argument('--corruption-rate', type=float, default=0, help='fraction of downloads with altered content')
+    parser.add_argument('--file-size', type=float, default=10, help='size of the files served in MB')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    mock = start_server(MockConfig(args.latency, args.bandwidth * 10**6 if args.bandwidth else None,
+                                   args.query_failure_rate, args.download_failure_rate,
+                                   int(args.file_size * 10**6), args.seed, args.corruption_rate), args.host, args.port)
+    print('Mock servers listening on http://%s:%i' % mock.server_address)
+    threading.Event().wait()
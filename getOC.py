@@ -10,19 +10,55 @@ Copyright (c) 2019 Nils Haentjens & Guillaume Bourdin
 import sys
 from datetime import datetime, timedelta
 from operator import itemgetter
+from collections import namedtuple
 from getpass import getpass
-import requests
 # from requests.auth import HTTPBasicAuth
 import re
 import os
-from time import sleep
-from pandas import read_csv
-import numpy as np
-import pandas as pd
-# import socket
+from time import sleep, time, monotonic
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import threading
+import queue
+import socket
 import math
-# import json
+import json
 import logging
+import sqlite3
+import zlib
+import hashlib
+import random
+import csv
+import importlib
+from itertools import accumulate
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+
+class LazyModule:
+    # Module imported when one of its attributes is first used
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+# Heavy modules are imported when needed: pandas and numpy are only used to query points of interest and requests to
+# send queries and downloads, so short runs (e.g. -r with images already downloaded, --help) start faster
+requests = LazyModule('requests')
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+# pyarrow is optional, only needed to write and read image lists in parquet or arrow format
+pa = LazyModule('pyarrow')
+pc = LazyModule('pyarrow.compute')
+pq = LazyModule('pyarrow.parquet')
+# netCDF4 is optional, only needed to extract matchups from the images downloaded (scipy speeds up pixel searches)
+nc = LazyModule('netCDF4')
+spatial = LazyModule('scipy.spatial')
 
 __version__ = "0.8.0"
 
@@ -31,12 +67,14 @@ URL_L12BROWSER = 'https://oceancolor.gsfc.nasa.gov/cgi/browse.pl'
 URL_DIRECT_ACCESS = 'https://oceandata.sci.gsfc.nasa.gov/'
 URL_SEARCH_API = 'https://oceandata.sci.gsfc.nasa.gov/api/file_search'
 URL_GET_FILE_CGI = 'https://oceandata.sci.gsfc.nasa.gov/cgi/getfile/'
-URL_CMR = 'https://cmr.earthdata.nasa.gov/search/granules.json?provider=OB_DAAC'
+URL_CMR = 'https://cmr.earthdata.nasa.gov/search/granules.umm_json?provider=OB_DAAC'
 URL_GET_FILE_CMR = 'https://oceandata.sci.gsfc.nasa.gov/ob/getfile/'
 URL_SEARCH_COPERNICUS = 'https://catalogue.dataspace.copernicus.eu/resto/api/collections/'
 URL_SEARCH_CREODIAS = 'https://finder.creodias.eu/resto/api/collections/'
 URL_CREODIAS_LOGIN = 'https://auth.creodias.eu/auth/realms/DIAS/protocol/openid-connect/token'
 URL_CREODIAS_GET_FILE = 'https://zipper.creodias.eu/download'
+URL_COPERNICUS_LOGIN = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
+URL_GET_FILE_COPERNICUS = 'https://catalogue.dataspace.copernicus.eu/odata/v1/Products'
 
 # add dates to logs
 logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
@@ -159,6 +197,73 @@ EXTENSION_L1A = {'MODIS-Aqua': '',
                  'VIIRSN': '.nc',
                  'VIIRSJ1': '.nc',
                  'VIIRSJ2': '.nc'}
+# Maximum number of simultaneous downloads allowed per access platform
+# (Copernicus dataspace quota is 4 concurrent connections per user)
+MAX_WORKERS_PLATFORM = {'cmr': 8,
+                        'L1L2_browser': 4,
+                        'copernicus': 4,
+                        'creodias': 2}
+# Minimum size (bytes) of files downloaded in several segments simultaneously
+SEGMENT_MIN_SIZE = 100 * 10**6
+# Progress of downloads is recorded in the download state every CHECKPOINT_SIZE bytes (per segment)
+CHECKPOINT_SIZE = 16 * 2**20
+# Bytes read from the connection and written to the file at once (buffer reused for every read)
+DOWNLOAD_BUFFER_SIZE = 4 * 2**20
+# Streaming mode: points of interest read per chunk of the input file, images waiting to be downloaded
+STREAM_CHUNK_SIZE = 1000
+STREAM_QUEUE_SIZE = 100
+# Connections kept alive per host by each http session and (connect, read) timeouts in seconds
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = (30, 900)
+# Default number of queries per second sent to each search endpoint
+# (L1L2_browser rate is set by the query delay option)
+QUERY_RATE_LIMIT = {'cmr': 10,
+                    'copernicus': 5,
+                    'creodias': 1,
+                    'L1L2_browser': 1}
+# Period during which NASA images might be replaced by their refined version (NRT to NT)
+NRT_PERIOD = timedelta(days=60)
+# Time to live of cached queries with time windows in the NRT period (older queries never expire)
+CACHE_NRT_TTL = timedelta(hours=6)
+# Maximum box size (degrees) and time window of the queries merging several points of interest
+COALESCE_MAX_EXTENT = 10
+COALESCE_MAX_SPAN = timedelta(days=2)
+# Footprint index: points of interest matched at once against the granule footprints of a day
+FOOTPRINT_CHUNK_SIZE = 1000
+# Retries of failed queries and downloads: attempts, exponential backoff (seconds) with jitter, and longest delay
+# honoured when asked by the server (Retry-After header)
+RETRY_MAX_ATTEMPTS = 10
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 300
+RETRY_AFTER_MAX = 3600
+# HTTP status of temporary errors always retried (timeout, rate limited, server errors), and of errors retried once
+# (expired token, range not satisfiable after a partial download), other errors are permanent (e.g. 401 credentials or
+# EULA not accepted, 403, 404)
+RETRY_STATUS = (408, 425, 429, 500, 502, 503, 504)
+RETRY_ONCE_STATUS = (401, 416)
+# Circuit breaker: consecutive failures of a host before pausing all requests to it, pause (seconds) doubled each
+# time the host fails again after a pause
+CIRCUIT_FAILURES = 5
+CIRCUIT_PAUSE = 60
+CIRCUIT_MAX_PAUSE = 900
+# Sharded runs: lease (seconds) of the chunks of points of interest and images claimed by a process, renewed every
+# LEASE_TTL / 3 seconds while it works on them, and wait (seconds) before checking again work leased by other processes
+LEASE_TTL = 120
+SHARD_POLL = 10
+# Upper bounds (seconds) of the buckets of the duration histograms exported by metrics
+METRICS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, float('inf'))
+# Formats of the image list file (extension), parquet and arrow require pyarrow
+IMAGE_LIST_FORMATS = ['csv', 'parquet', 'arrow']
+# Columns of the image list in parquet and arrow formats, one row per point of interest and image found
+IMAGE_LIST_COLUMNS = ['id', 'dt', 'lat', 'lon', 'image_name', 'url', 'size', 'checksum_algorithm', 'checksum']
+# Matchups: box of pixels (MATCHUP_SIZE x MATCHUP_SIZE) extracted around each point of interest, largest distance (km)
+# to the nearest pixel (points of interest further away are outside of the swath), and columns of the matchup table
+# followed by the variables extracted, one row per pixel
+MATCHUP_SIZE = 3
+MATCHUP_MAX_DISTANCE = 10
+MATCHUP_COLUMNS = ['id', 'dt', 'lat', 'lon', 'image_name', 'image_time', 'row', 'col', 'pixel_lat', 'pixel_lon',
+                   'distance']
+EARTH_RADIUS = 6371
 
 # https://catalogue.dataspace.copernicus.eu/resto/api/collections/Sentinel1/describe.xml
 # productType
@@ -199,6 +304,274 @@ EXTENSION_L1A = {'MODIS-Aqua': '',
 # instrument: OLI/TIRS
 # L1GT L1T L1TP L2SP
 
+_http = threading.local()
+_http_config = {'pool_size': HTTP_POOL_SIZE, 'timeout': HTTP_TIMEOUT}
+_write_config = {'buffer_size': DOWNLOAD_BUFFER_SIZE, 'preallocate': True, 'fsync': False}
+
+
+def configure_sessions(pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+    # Set connection pool size and timeouts of the http sessions created from now on
+    _http_config['pool_size'] = pool_size
+    _http_config['timeout'] = timeout
+
+
+def configure_writes(buffer_size=DOWNLOAD_BUFFER_SIZE, preallocate=True, fsync=False):
+    # Set size of the buffer of downloads, preallocation of files of known size (posix_fallocate), and fsync of
+    # files downloaded (once complete and at each checkpoint)
+    _write_config['buffer_size'] = buffer_size
+    _write_config['preallocate'] = preallocate
+    _write_config['fsync'] = fsync
+
+
+def get_session():
+    # Long-lived http session of the current thread: connections to each host are kept alive and reused by all
+    # queries and downloads run by the thread (requests sessions are not thread safe, so they are not shared)
+    if getattr(_http, 'session', None) is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=_http_config['pool_size'],
+                                                pool_maxsize=_http_config['pool_size'])
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http.session = session
+    return _http.session
+
+
+class Metrics:
+    # Thread safe counters, gauges, and duration histograms of a run, each labelled (e.g. stage, platform, host)
+    # Exported as a json summary or as a Prometheus textfile (read by the textfile collector of node_exporter)
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.t_start = time()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'count': 0, 'sum': 0, 'min': seconds, 'max': seconds,
+                                        'buckets': [0] * len(self.buckets)}
+            h = self.histograms[key]
+            h['count'] += 1
+            h['sum'] += seconds
+            h['min'] = min(h['min'], seconds)
+            h['max'] = max(h['max'], seconds)
+            h['buckets'][next(k for k, b in enumerate(self.buckets) if seconds <= b)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Observe the duration of the with block (also when it raises)
+        t = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - t, **labels)
+
+    def summary(self):
+        # Dictionary of all metrics (json serializable), histograms buckets are cumulative like in Prometheus
+        with self.lock:
+            summary = {'version': __version__, 'start': datetime.utcfromtimestamp(self.t_start).isoformat() + 'Z',
+                       'elapsed': time() - self.t_start, 'counters': {}, 'gauges': {}, 'histograms': {}}
+            for (name, labels), value in sorted(self.counters.items()):
+                summary['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), value in sorted(self.gauges.items()):
+                summary['gauges'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), h in sorted(self.histograms.items()):
+                summary['histograms'].setdefault(name, []).append(
+                    {'labels': dict(labels), 'count': h['count'], 'sum': h['sum'], 'min': h['min'], 'max': h['max'],
+                     'mean': h['sum'] / h['count'],
+                     'buckets': [[str(b), int(c)] for b, c in zip(self.buckets, accumulate(h['buckets']))]})
+        return summary
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, filename, prefix='getoc_'):
+        # Text exposition format, written to a temporary file then renamed so the collector never reads a partial file
+        def fmt(labels, **extra):
+            labels = dict(labels, **extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in labels.items())
+        summary = self.summary()
+        lines = []
+        for kind in ('counters', 'gauges'):
+            for name, values in summary[kind].items():
+                lines.append('# TYPE %s%s %s' % (prefix, name, 'counter' if kind == 'counters' else 'gauge'))
+                lines.extend('%s%s%s %r' % (prefix, name, fmt(v['labels']), v['value']) for v in values)
+        for name, values in summary['histograms'].items():
+            lines.append('# TYPE %s%s histogram' % (prefix, name))
+            for v in values:
+                lines.extend('%s%s_bucket%s %i' % (prefix, name, fmt(v['labels'], le='+Inf' if b == 'inf' else b), c)
+                             for b, c in v['buckets'])
+                lines.append('%s%s_sum%s %r' % (prefix, name, fmt(v['labels']), v['sum']))
+                lines.append('%s%s_count%s %i' % (prefix, name, fmt(v['labels']), v['count']))
+        with open(filename + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+
+# metrics of the current run
+metrics = Metrics()
+
+
+def backoff(seconds, stage):
+    # Wait before retrying a failed query or download, retries and time spent waiting are recorded in metrics
+    metrics.inc('retries_total', stage=stage)
+    metrics.inc('backoff_seconds_total', seconds, stage=stage)
+    sleep(seconds)
+
+
+def error_response(error):
+    # HTTP response of a failed request: error is the response itself or the exception raised (None if no response,
+    # e.g. connection errors)
+    if hasattr(error, 'status_code'):
+        return error
+    return getattr(error, 'response', None)
+
+
+def get_retry_after(error):
+    # Seconds asked by the server before retrying (Retry-After header in seconds or HTTP date), None if not set
+    response = error_response(error)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), RETRY_AFTER_MAX)
+
+
+class RetryPolicy:
+    # Retries of failed queries and downloads shared by all requests: errors are retried if temporary (connection
+    # errors, timeouts, truncated or corrupted files, HTTP RETRY_STATUS) or once for HTTP RETRY_ONCE_STATUS, other
+    # HTTP errors fail at once
+    # Attempt n waits base_delay * 2^(n - 1) seconds (up to max_delay) with jitter, so that workers failing together do
+    # not retry together, or longer if the server asks for it (Retry-After)
+    def __init__(self, max_retries=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def temporary(self, error):
+        # Error caused by the server or the network (counted by the circuit breaker of the host)
+        response = error_response(error)
+        if response is not None:
+            return response.status_code in RETRY_STATUS
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def retryable(self, error, attempt):
+        # Whether the request failed with error at attempt (1 for the first one) is sent again
+        if attempt >= self.max_retries:
+            return False
+        response = error_response(error)
+        if response is None or response.status_code < 400:
+            return True
+        return response.status_code in RETRY_STATUS or (response.status_code in RETRY_ONCE_STATUS and attempt == 1)
+
+    def delay(self, attempt, error=None):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        retry_after = get_retry_after(error)
+        return delay if retry_after is None else max(delay, retry_after)
+
+    def wait(self, attempt, error, stage, label):
+        # Log and wait before the next attempt of the request label
+        seconds = self.delay(attempt, error)
+        response = error_response(error)
+        logger.info('%s failed (%s), attempt [%i/%i]: retrying in %.1f s' %
+                    (label, 'HTTP %i' % response.status_code if response is not None else error, attempt,
+                     self.max_retries, seconds))
+        backoff(seconds, stage)
+
+
+_retry_policy = RetryPolicy()
+
+
+def configure_retries(max_retries=RETRY_MAX_ATTEMPTS, max_delay=RETRY_MAX_DELAY):
+    # Set number of attempts of failed queries and downloads and longest backoff (seconds)
+    global _retry_policy
+    _retry_policy = RetryPolicy(max_retries, RETRY_BASE_DELAY, max_delay)
+
+
+class CircuitBreaker:
+    # Pause all requests to a host after CIRCUIT_FAILURES consecutive temporary failures (outage, rate limited) instead
+    # of letting every worker retry on its own: workers wait until the pause is over, then the next failure pauses
+    # requests again at once (pause doubled up to CIRCUIT_MAX_PAUSE) while a success closes the circuit
+    def __init__(self, host, failures=CIRCUIT_FAILURES, pause=CIRCUIT_PAUSE):
+        self.host = host
+        self.max_failures = failures
+        self.base_pause = pause
+        self.pause = pause
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # Block while requests to the host are paused
+        while True:
+            with self.lock:
+                seconds = self.open_until - monotonic()
+            if seconds <= 0:
+                return
+            logger.info('Requests to %s paused: waiting %.1f s' % (self.host, seconds))
+            metrics.inc('circuit_wait_seconds_total', seconds, host=self.host)
+            sleep(seconds)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.pause = self.base_pause
+
+    def failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.max_failures or self.open_until > monotonic():
+                return
+            pause = max(self.pause, retry_after or 0)
+            self.open_until = monotonic() + pause
+            self.pause = min(2 * self.pause, CIRCUIT_MAX_PAUSE)
+            # half open once the pause is over: the next failure pauses requests again
+            self.failures = self.max_failures - 1
+        logger.info('%i consecutive failures on %s: pausing requests for %.1f s' %
+                    (self.max_failures, self.host, pause))
+        metrics.inc('circuit_open_total', host=self.host)
+
+
+_circuits = dict()
+_circuits_lock = threading.Lock()
+
+
+def get_circuit(url):
+    # Circuit breaker of the host of url, shared by all threads
+    host = urlsplit(url).netloc
+    with _circuits_lock:
+        if host not in _circuits:
+            _circuits[host] = CircuitBreaker(host)
+        return _circuits[host]
+
+
 def get_platform(dates, instrument, level):
     # Get acces plateform depending on product and date:
     # - COPERNICUS: MSI-L2A < 12 month, OLCI # DEPRECATED
@@ -210,20 +583,25 @@ def get_platform(dates, instrument, level):
     # if instrument == 'MSI' or instrument == 'SLSTR' or instrument == 'OLCI': # DEPRECATED
     #     access_platf = 'creodias'
     #     pwd = getpass(prompt='Creodias Password: ', stream=None)
-    if instrument == 'MSI' or instrument == 'SLSTR' or instrument == 'OLCI' or instrument == 'SRAL' \
-            or instrument == 'SYN' or instrument == 'L5-TM' or instrument == 'L8-ETM' or instrument == 'L8-OLI-TIRS' \
-            or instrument == 'SAR':
-        access_platf = 'copernicus'
+    access_platf = get_access_platform(instrument, level)
+    if access_platf == 'copernicus':
         pwd = getpass(prompt='Copernicus Password: ', stream=None)
-    elif level == 'L0' or instrument == 'MERIS' or instrument == 'HICO':
-        access_platf = 'L1L2_browser'
-        pwd = getpass(prompt='EarthData Password: ', stream=None)
     else:
-        access_platf = 'cmr'
         pwd = getpass(prompt='EarthData Password: ', stream=None)
     return access_platf, pwd
 
 
+def get_access_platform(instrument, level):
+    # Access platform of instrument and level (see get_platform)
+    if instrument == 'MSI' or instrument == 'SLSTR' or instrument == 'OLCI' or instrument == 'SRAL' \
+            or instrument == 'SYN' or instrument == 'L5-TM' or instrument == 'L8-ETM' or instrument == 'L8-OLI-TIRS' \
+            or instrument == 'SAR':
+        return 'copernicus'
+    elif level == 'L0' or instrument == 'MERIS' or instrument == 'HICO':
+        return 'L1L2_browser'
+    return 'cmr'
+
+
 def set_query_string(access_platform, instrument, level='L2', product='OC'):
     # Set query url specific to access plateform:
     # Get parameters to build query
@@ -312,191 +690,882 @@ def set_query_string(access_platform, instrument, level='L2', product='OC'):
         sys.exit(-1)
 
 
-def format_dtlatlon_query(poi, access_platform):
-    # Add room around poi using bounding box option (default = 60 nautical miles), and wrap longitude into [-180:180]
-    if poi['lat'] + options.bounding_box_sz / 60 > 90:
-        n = str(90)
-    else:
-        n = str(poi['lat'] + options.bounding_box_sz / 60)
-    if poi['lat'] - options.bounding_box_sz / 60 < -90:
-        s = str(-90)
-    else:
-        s = str(poi['lat'] - options.bounding_box_sz / 60)
-    lon_box = options.bounding_box_sz / 60 / (math.cos(poi['lat'] * math.pi / 180))
-    if poi['lon'] - lon_box < -180:
-        w = str(poi['lon'] - lon_box + 360)
-    else:
-        w = str(poi['lon'] - lon_box)
-    if poi['lon'] + lon_box > 180:
-        e = str(poi['lon'] + lon_box - 360)
-    else:
-        e = str(poi['lon'] + lon_box)
-    if access_platform == 'L1L2_browser':
-        day = str((poi['dt'] - datetime(1970, 1, 1)).days)
-        return w, s, e, n, day
-    else:
-        day_st = poi['dt'] - timedelta(hours=12, minutes=0)
-        day_end = poi['dt'] + timedelta(hours=12, minutes=0)
-        return w, s, e, n, day_st, day_end
+def get_query_boxes(pois, bounding_box_sz=60):
+    # Add room around every poi using bounding box size (nautical miles), and wrap longitude into [-180:180]
+    # Return data frame indexed like pois with the box w, s, e, n (w > e if it crosses the antimeridian), the day
+    # number since 1970-01-01 (L1L2_browser) and the +/- 12 hours time window day_st, day_end
+    lat = pois['lat'].to_numpy(dtype=float)
+    lon = pois['lon'].to_numpy(dtype=float)
+    dt = pd.to_datetime(pois['dt']).to_numpy()
+    half_box = bounding_box_sz / 60
+    with np.errstate(divide='ignore'):
+        lon_box = half_box / np.cos(lat * np.pi / 180)
+    w = lon - lon_box
+    w = np.where(w < -180, w + 360, w)
+    e = lon + lon_box
+    e = np.where(e > 180, e - 360, e)
+    # box wider than the globe near the poles
+    all_lon = ~(np.abs(lon_box) < 180)
+    w[all_lon] = -180
+    e[all_lon] = 180
+    return pd.DataFrame({'w': w, 's': np.maximum(lat - half_box, -90), 'e': e, 'n': np.minimum(lat + half_box, 90),
+                         'day': (dt - np.datetime64('1970-01-01')) // np.timedelta64(1, 'D'),
+                         'day_st': dt - np.timedelta64(12, 'h'), 'day_end': dt + np.timedelta64(12, 'h')},
+                        index=pois.index)
+
+
+def split_box(box):
+    # Split box (w, s, e, n) crossing the antimeridian (w > e) into two boxes
+    w, s, e, n = box
+    if w > e:
+        return [(w, s, 180., n), (-180., s, e, n)]
+    return [(w, s, e, n)]
 
 
 def get_login_key(username, password):  # get login key for creodias download
     login_data = {'client_id': 'CLOUDFERRO_PUBLIC','username': username,'password': password, 'grant_type': 'password'}
-    login_key = requests.post(URL_CREODIAS_LOGIN, data=login_data).json()
+    login_key = get_session().post(URL_CREODIAS_LOGIN, data=login_data, timeout=_http_config['timeout']).json()
     try:
         return login_key['access_token']
     except KeyError:
         raise RuntimeError('Unable to get login key. Response was ' + login_key.text)
 
 
-def get_keycloak(username: str, password: str) -> str:
-    data = {
-        "client_id": "cdse-public",
-        "username": username,
-        "password": password,
-        "grant_type": "password",
-    }
+def request_keycloak(data: dict) -> dict:
     try:
-        r = requests.post(
-            "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token",
-            data=data,
-            )
+        r = get_session().post(URL_COPERNICUS_LOGIN, data=data, timeout=_http_config['timeout'])
         r.raise_for_status()
     except Exception as e:
         raise Exception(
             f"Keycloak token creation failed. Reponse from the server was: {r.json()}"
         )
-    return r.json()["access_token"]
+    return r.json()
+
+
+class KeycloakToken:
+    # Copernicus dataspace access token shared by all download workers, renewed with the refresh token shortly
+    # before it expires (a new login is only required once the refresh token itself expired)
+    def __init__(self, username: str, password: str, margin: float = 60):
+        self.username = username
+        self.password = password
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.access_expires = 0
+        self.refresh_token = None
+        self.refresh_expires = 0
+
+    def get(self) -> str:
+        with self.lock:
+            now = time()
+            if self.access_token is not None and now < self.access_expires - self.margin:
+                return self.access_token
+            if self.refresh_token is not None and now < self.refresh_expires - self.margin:
+                try:
+                    self.update(request_keycloak({"client_id": "cdse-public",
+                                                  "grant_type": "refresh_token",
+                                                  "refresh_token": self.refresh_token}), now)
+                    return self.access_token
+                except Exception as e:
+                    logger.info('Unable to refresh Copernicus token (%s), login again' % e)
+            self.update(request_keycloak({"client_id": "cdse-public",
+                                          "username": self.username,
+                                          "password": self.password,
+                                          "grant_type": "password"}), now)
+            return self.access_token
+
+    def update(self, token: dict, now: float):
+        self.access_token = token["access_token"]
+        self.access_expires = now + token.get("expires_in", 0)
+        self.refresh_token = token.get("refresh_token")
+        self.refresh_expires = now + token.get("refresh_expires_in", 0)
+
+    def invalidate(self):
+        # Force a new login (e.g. token rejected by the server)
+        with self.lock:
+            self.access_token = None
+            self.refresh_token = None
+
+
+_keycloak_tokens = dict()
+_keycloak_lock = threading.Lock()
+
+
+def get_keycloak_token(username: str, password: str) -> KeycloakToken:
+    with _keycloak_lock:
+        if username not in _keycloak_tokens:
+            _keycloak_tokens[username] = KeycloakToken(username, password)
+        return _keycloak_tokens[username]
+
+
+def get_keycloak(username: str, password: str) -> str:
+    return get_keycloak_token(username, password).get()
 
 
 def clean_nrt_nt_files(imlistraw, fid_list):
+    # Remove near real time (NRT) images for which the refined image is also listed
+    refined = set(x for x in imlistraw if 'NRT' not in x)
     sel_img = []
     sel_fid = []
-    for i in range(len(imlistraw)):
-        if 'NRT' not in imlistraw[i]:
-            sel_img.append(imlistraw[i])
-            sel_fid.append(fid_list[i])
-        elif imlistraw[i].replace('.NRT.nc', 'nc') not in imlistraw:
-            sel_img.append(imlistraw[i])
-            sel_fid.append(fid_list[i])
+    for im, fid in zip(imlistraw, fid_list):
+        if 'NRT' not in im or im.replace('.NRT.nc', '.nc') not in refined:
+            sel_img.append(im)
+            sel_fid.append(fid)
     return sel_img, sel_fid
 
 
 def sel_most_recent_esa(imlistraw, fid_list, instrument):
-    sel_s3 = find_most_recent_esa(imlistraw, instrument)
+    todelete = find_superseded_esa(imlistraw, instrument)
+    sel_s3 = []
     sel_fid = []
-    for i in range(len(imlistraw)):
-        if imlistraw[i] in sel_s3:
-            sel_fid.append(fid_list[i])
+    for im, fid in zip(imlistraw, fid_list):
+        if im not in todelete:
+            sel_s3.append(im)
+            sel_fid.append(fid)
     return sel_s3, sel_fid
 
 
 def find_most_recent_esa(imlistraw, instrument):
-    ref = imlistraw
+    todelete = find_superseded_esa(imlistraw, instrument)
+    return [x for x in imlistraw if x not in todelete]
+
+
+def find_superseded_esa(imlistraw, instrument):
+    # Return the set of ESA image names superseded by another version of the same product
+    # Each name is parsed once and grouped by product identity:
+    # - OLCI: platform, product type and sensing start (to the minute)
+    # - MSI: mission, level, sensing time, relative orbit and tile
+    groups = dict()
+    todelete = set()
     if 'OLCI' in instrument:
-        ref = [x[0:29] for x in ref]
-        x = np.array(ref)
-        uref = np.unique(x)
-        todelete = []
-        for singlref in uref:
-            str_match = [s for s in imlistraw if singlref in s]
-            NR_match = [s for s in str_match if '_NR_' in s]
-            NT_match = [s for s in str_match if '_NT_' in s]
+        for x in dict.fromkeys(imlistraw):
+            groups.setdefault(x[0:29], []).append(x)
+        for str_match in groups.values():
+            if len(str_match) < 2:
+                continue
             O_match = [s for s in str_match if '_O_' in s]
             R_match = [s for s in str_match if '_R_' in s]
+            NR_match = [s for s in str_match if '_NR_' in s]
+            NT_match = [s for s in str_match if '_NT_' in s]
             LN1_match = [s for s in str_match if '_LN1_' in s]
-            # LN2_match = [s for s in str_match if '_LN2_' in s]
             MAR_match = [s for s in str_match if '_MAR_' in s]
-            if len(str_match) > 1:
-                # select reprocessed over operational
-                if len(O_match) > 0 and len(R_match) > 0:
-                    for O_img in O_match:
-                        todelete.append(O_img)
-                # select no time limit over near real time
-                if len(NR_match) > 0 and len(NT_match) > 0:
-                    for NR_img in NR_match:
-                        todelete.append(NR_img)
-                # select marine processing over land old processing code
-                if len(MAR_match) > 0 and len(LN1_match) > 0:
-                    for LN1_img in LN1_match:
-                        todelete.append(LN1_img)
-                for todel in todelete:
-                    imlistraw = list(filter(todel.__ne__, imlistraw))
+            # select reprocessed over operational
+            if len(O_match) > 0 and len(R_match) > 0:
+                todelete.update(O_match)
+            # select no time limit over near real time
+            if len(NR_match) > 0 and len(NT_match) > 0:
+                todelete.update(NR_match)
+            # select marine processing over land old processing code
+            if len(MAR_match) > 0 and len(LN1_match) > 0:
+                todelete.update(LN1_match)
     elif 'MSI' in instrument:
-        dt_processing = [datetime.strptime(x.replace('.SAFE.zip', '').split('_')[-1], '%Y%m%dT%H%M%S') for x in ref]
-        ref = ['_'.join(itemgetter(*[0,1,2,4,5])(x.replace('.SAFE.zip', '').split('_'))) for x in ref]
-        dtx = np.array(dt_processing)
-        refx = np.array(ref)
-        imlistrawx = np.array(imlistraw)
-        uref = np.unique(refx)
-        todelete = []
-        for singlref in uref:
-            str_match = imlistrawx[np.where(refx == singlref)]
-            dt_match = dtx[np.where(refx == singlref)]
-            if len(dt_match) > 1:
-                # select last reprocessing
-                dt_ref = datetime.utcnow()
-                recent_dt = dt_match[np.where(abs(dt_match - dt_ref) == min(abs(dt_match - dt_ref)))]
-                ref_tokeep = imlistrawx[np.logical_and(refx == singlref, dtx == recent_dt)]
-                ref_todel = str_match[ref_tokeep != str_match]
-                for todel in ref_todel:
-                    todelete.append(todel)
-                    imlistraw = list(filter(todel.__ne__, imlistraw))
-    return imlistraw
+        for x in dict.fromkeys(imlistraw):
+            fields = x.replace('.SAFE.zip', '').split('_')
+            dt_processing = datetime.strptime(fields[-1], '%Y%m%dT%H%M%S')
+            groups.setdefault('_'.join(itemgetter(*[0, 1, 2, 4, 5])(fields)), []).append((x, dt_processing))
+        dt_ref = datetime.utcnow()
+        for str_match in groups.values():
+            if len(str_match) < 2:
+                continue
+            # select last reprocessing
+            recent_dt = min(abs(dt - dt_ref) for _, dt in str_match)
+            todelete.update(x for x, dt in str_match if abs(dt - dt_ref) != recent_dt)
+    return todelete
+
+
+def select_granule_versions(img_names, urls, instrument):
+    # Keep a single version of each image: most recent ESA version or refined NASA image over NRT, then remove
+    # duplicates and empty names/urls (order of first occurrence is preserved)
+    if instrument == 'OLCI' or instrument == 'MSI':
+        # select the most recent version of all images
+        img_names, urls = sel_most_recent_esa(img_names, urls, instrument)
+    else:
+        img_names, urls = clean_nrt_nt_files(img_names, urls)
+    empty_urls = {URL_CREODIAS_GET_FILE + '/', URL_GET_FILE_CMR, URL_GET_FILE_CGI}
+    selection = dict()
+    for im, url in zip(img_names, urls):
+        if im and url not in empty_urls and im not in selection:
+            selection[im] = url
+    return list(selection.keys()), list(selection.values())
+
+
+class TokenBucket:
+    # Thread safe token bucket pacing the queries sent to a search endpoint
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.timestamp = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class CachedResponse:
+    # Minimal stand-in for requests.Response returned when a query is served from the cache
+    status_code = 200
+
+    def __init__(self, text, headers=None):
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class QueryCache:
+    # Persistent cache of search responses (sqlite) with least recently used eviction above max_size bytes
+    def __init__(self, filename, max_size=512 * 10**6, nrt_ttl=CACHE_NRT_TTL):
+        self.max_size = max_size
+        self.nrt_ttl = nrt_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS query (key TEXT PRIMARY KEY, body BLOB, headers TEXT, '
+                        'expires REAL, last_access REAL, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS query_last_access ON query (last_access)')
+        self.db.commit()
+
+    @staticmethod
+    def key(query, access_platform, headers=None):
+        # Normalize query: parameters order does not matter, request headers (e.g. CMR-Search-After) do
+        url = urlsplit(query)
+        params = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+        return hashlib.sha1(('%s|%s%s?%s|%s' % (access_platform, url.netloc, url.path, params,
+                                                 sorted((headers or {}).items()))).encode()).hexdigest()
+
+    def get(self, key):
+        # Return (body, response headers) of a query, None if not in cache or expired
+        with self.lock:
+            row = self.db.execute('SELECT body, headers FROM query '
+                                  'WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time())).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE query SET last_access = ? WHERE key = ?', (time(), key))
+            self.db.commit()
+        return zlib.decompress(row[0]).decode(), json.loads(row[1])
+
+    def put(self, key, text, headers=None, window_end=None):
+        # Archived data never change, queries with time windows within the NRT period expire after nrt_ttl
+        if window_end is None or datetime.utcnow() - window_end < NRT_PERIOD:
+            expires = time() + self.nrt_ttl.total_seconds()
+        else:
+            expires = None
+        body = zlib.compress(text.encode())
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO query VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, body, json.dumps(dict(headers or {})), expires, time(), len(body)))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        self.db.execute('DELETE FROM query WHERE expires IS NOT NULL AND expires <= ?', (time(),))
+        total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM query').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for key, size in self.db.execute('SELECT key, size FROM query ORDER BY last_access').fetchall():
+            self.db.execute('DELETE FROM query WHERE key = ?', (key,))
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+
+_query_cache = None
+
+
+def set_query_cache(filename, max_size=512 * 10**6):
+    # Enable persistent cache of search responses, None to disable
+    global _query_cache
+    _query_cache = QueryCache(filename, max_size) if filename else None
+
+
+_rate_limiters = dict()
 
 
-def get_image_list_copernicus(pois, access_platform, query_string, instrument, level='L1', cloud_cover='[0,100]'):
+def set_query_rate(access_platform, rate, burst=1):
+    # (Re)define the rate limit (queries per second) applied to an access platform, None or 0 to disable
+    _rate_limiters[access_platform] = TokenBucket(rate, burst)
+
+
+def get_query(query, access_platform, window_end=None, refresh=False, headers=None):
+    # Send a search query once the rate limiter of the access platform allows it, temporary errors are retried (see
+    # RetryPolicy) and queries wait while the circuit breaker of the host is open
+    # Responses are served from the query cache when enabled (refresh=True to ignore the cached response)
+    if _query_cache is not None:
+        key = QueryCache.key(query, access_platform, headers)
+        cached = None if refresh else _query_cache.get(key)
+        if cached is not None:
+            metrics.inc('query_cache_hits_total', platform=access_platform)
+            return CachedResponse(*cached)
+    if access_platform not in _rate_limiters:
+        set_query_rate(access_platform, QUERY_RATE_LIMIT.get(access_platform))
+    circuit = get_circuit(query)
+    attempt = 0
+    while True:
+        circuit.wait()
+        t = monotonic()
+        _rate_limiters[access_platform].acquire()
+        metrics.inc('rate_limit_wait_seconds_total', monotonic() - t, platform=access_platform)
+        try:
+            with metrics.timer('query_seconds', platform=access_platform):
+                r = get_session().get(query, timeout=_http_config['timeout'], headers=headers)
+        except requests.RequestException as e:
+            metrics.inc('queries_total', platform=access_platform, status=type(e).__name__)
+            r = e
+        else:
+            metrics.inc('queries_total', platform=access_platform, status=r.status_code)
+            if r.status_code not in RETRY_STATUS:
+                circuit.success()
+                break
+        attempt += 1
+        if _retry_policy.temporary(r):
+            circuit.failure(get_retry_after(r))
+        if not _retry_policy.retryable(r, attempt):
+            if isinstance(r, Exception):
+                raise r
+            break
+        _retry_policy.wait(attempt, r, 'query', 'Query of %s' % access_platform)
+    if _query_cache is not None and r.status_code == 200:
+        _query_cache.put(key, r.text, r.headers, window_end)
+    return r
+
+
+class ImageTable:
+    # Images found for the points of interest, normalized: each image name and url is stored once (names, urls, in
+    # order of first occurrence) and the images of the k-th point of interest are names[j] for j in
+    # index[offsets[k]:offsets[k + 1]] (integer arrays), instead of lists of names repeated in each row of pois
+    # checksums maps image names to the (algorithm, value) published by the access platform and sizes to their size in
+    # bytes (if published)
+    def __init__(self, pois, results, checksums=None, sizes=None):
+        # results: (image names, urls) of each point of interest, in the order of pois
+        ids = dict()
+        self.pois = pois
+        self.names, self.urls = [], []
+        index, counts = [], []
+        for imlist, urls in results:
+            for name, url in zip(imlist, urls):
+                j = ids.get(name)
+                if j is None:
+                    j = ids[name] = len(self.names)
+                    self.names.append(name)
+                    self.urls.append(url)
+                index.append(j)
+            counts.append(len(imlist))
+        self.index = np.array(index, dtype=np.int32)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.checksums = checksums if checksums is not None else dict()
+        self.sizes = sizes if sizes is not None else dict()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self):
+        # number of images of each point of interest
+        return np.diff(self.offsets)
+
+    def images(self, k):
+        # image names and urls of the k-th point of interest
+        index = self.index[self.offsets[k]:self.offsets[k + 1]]
+        return [self.names[j] for j in index], [self.urls[j] for j in index]
+
+    def image_list(self):
+        # image names and urls found for all points of interest, without duplicates
+        return list(self.names), list(self.urls)
+
+    def to_frame(self):
+        # Points of interest with the image names and urls found joined by ';' (columns image_names and url)
+        names = np.array(self.names, dtype=object)
+        urls = np.array(self.urls, dtype=object)
+        bounds = list(zip(self.offsets[:-1], self.offsets[1:]))
+        frame = self.pois.copy()
+        frame['image_names'] = [';'.join(names[self.index[a:b]]) for a, b in bounds]
+        frame['url'] = [';'.join(urls[self.index[a:b]]) for a, b in bounds]
+        return frame
+
+    def write_csv(self, filename, mode='w'):
+        # Write points of interest with the image names and urls found in csv file (read back with -r)
+        self.to_frame().to_csv(filename, mode=mode, date_format='%Y/%m/%d %H:%M:%S', header=False, index=False,
+                               float_format='%.5f')
+
+    def to_arrow(self):
+        # Arrow table (IMAGE_LIST_COLUMNS) with one row per point of interest and image found, points of interest
+        # without image have one row with null image_name, url, size, and checksum
+        counts = self.counts()
+        rows = np.maximum(counts, 1)
+        pois = self.pois.iloc[np.repeat(np.arange(len(self)), rows)]
+        index = np.full(int(rows.sum()), -1, dtype=np.int32)
+        index[np.repeat(counts > 0, rows)] = self.index
+        index = pa.array(index, mask=index < 0)
+        checksums = [self.checksums.get(name, (None, None)) for name in self.names]
+        columns = [pa.array(pois['id'].astype(str), pa.string()),
+                   pa.array(pois['dt']).cast(pa.timestamp('us')),
+                   pa.array(pois['lat'], pa.float64()),
+                   pa.array(pois['lon'], pa.float64()),
+                   pa.array(self.names, pa.string()).take(index),
+                   pa.array(self.urls, pa.string()).take(index),
+                   pa.array([self.sizes.get(name) for name in self.names], pa.int64()).take(index),
+                   pa.array([c[0] for c in checksums], pa.string()).take(index),
+                   pa.array([c[1] for c in checksums], pa.string()).take(index)]
+        return pa.Table.from_arrays(columns, names=IMAGE_LIST_COLUMNS)
+
+
+class ImageListWriter:
+    # Write the ImageTable of each chunk of points of interest queried in the image list file (read back with -r)
+    # csv: one row per point of interest with image names and urls joined by ';' (compatible with previous versions)
+    # parquet or arrow (Arrow IPC file): one row per point of interest and image with typed columns, including size
+    # and checksum of images, each chunk is a row group (parquet) or record batch (arrow)
+    def __init__(self, filename, file_format='csv'):
+        self.filename = filename
+        self.file_format = file_format
+        self.writer = None
+        self.chunks = 0
+
+    def write(self, images):
+        if self.file_format == 'csv':
+            images.write_csv(self.filename, 'w' if self.chunks == 0 else 'a')
+        else:
+            table = images.to_arrow()
+            if self.writer is None and self.file_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.filename, table.schema)
+            elif self.writer is None:
+                self.writer = pa.ipc.new_file(self.filename, table.schema)
+            self.writer.write_table(table)
+        self.chunks += 1
+
+    def close(self):
+        # parquet and arrow files are readable once closed (footer written)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_image_list(filename):
+    # Return image names and urls (without duplicates) of an image list file written by ImageListWriter
+    # csv files are read without pandas to start faster, parquet and arrow files are memory mapped and read by batches
+    # of rows, only the image_name and url columns
+    images = dict()
+    if os.path.splitext(filename)[1] == '.csv':
+        # id, dt, lat, lon, image_names, url
+        with open(filename, newline='') as f:
+            for record in csv.reader(f):
+                # points of interest without image
+                if len(record) < 6 or not record[4]:
+                    continue
+                # Convert 'stringified' list to list
+                for name, url in zip(record[4].split(';'), record[5].split(';')):
+                    images.setdefault(name, url)
+        return list(images.keys()), list(images.values())
+    if os.path.splitext(filename)[1] == '.arrow':
+        reader = pa.ipc.open_file(pa.memory_map(filename))
+        batches = (reader.get_batch(i).select(['image_name', 'url']) for i in range(reader.num_record_batches))
+    else:
+        batches = pq.ParquetFile(filename, memory_map=True).iter_batches(columns=['image_name', 'url'])
+    for batch in batches:
+        # images repeated for each point of interest are reduced within the batch before converting to python
+        names = batch.column(0)
+        unique = names.drop_null().unique()
+        first = pc.index_in(unique, value_set=names)
+        for name, url in zip(unique.to_pylist(), batch.column(1).take(first).to_pylist()):
+            images.setdefault(name, url)
+    return list(images.keys()), list(images.values())
+
+
+def query_pois(pois, boxes, query_poi, label, workers=1, callback=None):
+    # Run query_poi(poi, box) on every point of interest with up to workers queries in flight, poi is a named tuple
+    # (id, dt, lat, lon) and box the row of get_query_boxes corresponding to the poi
+    # query_poi returns (image_names, urls), return ImageTable of the results in the input order
+    # callback(image_names, urls, poi=index of the poi) is called as soon as each query is completed (from the worker
+    # thread)
+    def run(k, i, poi, box):
+        logger.info('[%i/%i]   Querying %s %s    %s    %.5f  %.5f' %
+                    (k + 1, len(pois), poi.id, label, poi.dt, poi.lat, poi.lon))
+        result = query_poi(poi, box)
+        if callback is not None:
+            callback(*result, poi=i)
+        return result
+
+    rows = zip(pois.index, pois[['id', 'dt', 'lat', 'lon']].itertuples(index=False), boxes.itertuples(index=False))
+    if workers <= 1:
+        results = [run(k, i, poi, box) for k, (i, poi, box) in enumerate(rows)]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, k, i, poi, box) for k, (i, poi, box) in enumerate(rows)]
+            results = [f.result() for f in futures]
+    return ImageTable(pois, results)
+
+
+# Granule found by a query: checksum is a tuple (algorithm, value), bbox the (w, s, e, n) box around its footprint,
+# footprint the list of polygons (rings of (lon, lat) points) published, None if not available
+Granule = namedtuple('Granule', ['name', 'url', 'time_start', 'time_end', 'day_night_flag', 'size', 'checksum',
+                                 'bbox', 'footprint'])
+
+
+def parse_iso_datetime(dt_str):
+    # Parse ISO 8601 dates returned by CMR and Copernicus (UTC, naive datetime like the points of interest)
+    return datetime.strptime(dt_str[0:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def footprint_bbox(lons, lats):
+    # Bounding box (w, s, e, n) of a granule footprint, footprints crossing the antimeridian span all longitudes
+    if len(lons) == 0 or len(lats) == 0:
+        return None
+    w, e = min(lons), max(lons)
+    if e - w > 180:
+        w, e = -180., 180.
+    return w, min(lats), e, max(lats)
+
+
+def lon_intervals(w, e):
+    # Split longitude range wrapped around the antimeridian (w > e) into two intervals
+    if w > e:
+        return [(w, 180.), (-180., e)]
+    return [(w, e)]
+
+
+def boxes_intersect(box_a, box_b):
+    # Test if two (w, s, e, n) boxes intersect, boxes with w > e wrap around the antimeridian
+    if box_a is None or box_b is None:
+        return True
+    if box_a[1] > box_b[3] or box_b[1] > box_a[3]:
+        return False
+    return any(wa <= eb and wb <= ea
+               for wa, ea in lon_intervals(box_a[0], box_a[2])
+               for wb, eb in lon_intervals(box_b[0], box_b[2]))
+
+
+def plan_queries(boxes, max_extent=COALESCE_MAX_EXTENT, max_span=COALESCE_MAX_SPAN):
+    # Group points of interest whose bounding boxes and time windows overlap, so each group is searched once
+    # Points are visited in chronological order and appended to the current group as long as the group box stays
+    # within max_extent degrees and the group window within max_span, points wrapping around the antimeridian are
+    # searched alone
+    # Return list of (poi indices, poi boxes, poi windows, group box, group window)
+    groups = []
+    current = None
+    for i, w, s, e, n, _, day_st, day_end in boxes.sort_values('day_st', kind='stable').itertuples():
+        box = (w, s, e, n)
+        wrapped = box[0] > box[2]
+        if current is not None and not wrapped and not current['wrapped'] and \
+                day_st <= current['window'][1] and current['window'][0] <= day_end and \
+                boxes_intersect(box, current['box']):
+            gbox = (min(box[0], current['box'][0]), min(box[1], current['box'][1]),
+                    max(box[2], current['box'][2]), max(box[3], current['box'][3]))
+            gwindow = (min(day_st, current['window'][0]), max(day_end, current['window'][1]))
+            if gbox[2] - gbox[0] <= max_extent and gbox[3] - gbox[1] <= max_extent and \
+                    gwindow[1] - gwindow[0] <= max_span:
+                current['indices'].append(i)
+                current['boxes'].append(box)
+                current['windows'].append((day_st, day_end))
+                current['box'], current['window'] = gbox, gwindow
+                continue
+        current = {'indices': [i], 'boxes': [box], 'windows': [(day_st, day_end)], 'box': box,
+                   'window': (day_st, day_end), 'wrapped': wrapped}
+        groups.append(current)
+    logger.info('Coalesced %i points of interest into %i queries' % (len(boxes), len(groups)))
+    return [(g['indices'], g['boxes'], g['windows'], g['box'], g['window']) for g in groups]
+
+
+def match_footprints(granules, boxes, windows):
+    # Select the granules of a group intersecting the box and time window of each point of interest, with the footprint
+    # polygons of the granules as the server does (bounding boxes of oblique swaths cover many points they miss)
+    # Return list of (image names, urls), each name once in the order returned by the server
+    return FootprintIndex(granules).match(boxes, windows)
+
+
+def plan_days(boxes):
+    # Group points of interest by the UTC day their time window starts, the granules of that day and the next one
+    # (windows are 24 hours long) are searched once over the whole globe and matched locally with match_footprints
+    # Return list of (poi indices, poi boxes, poi windows, group box, group window) like plan_queries
+    days = boxes['day_st'].dt.floor('D')
+    groups = []
+    for day, b in boxes.groupby(days, sort=True):
+        groups.append((list(b.index), list(zip(b.w, b.s, b.e, b.n)), list(zip(b.day_st, b.day_end)),
+                       (-180., -90., 180., 90.), (day, day + timedelta(days=2))))
+    logger.info('Grouped %i points of interest into %i days' % (len(boxes), len(groups)))
+    return groups
+
+
+class DailyGranules:
+    # Granules of each UTC day returned by query_day(start, end), searched once per day and kept for the run (a day of
+    # a swath sensor is a few hundred granules), shared by the threads querying groups
+    def __init__(self, query_day):
+        self.query_day = query_day
+        self.days = dict()
+        self.lock = threading.Lock()
+
+    def get(self, window):
+        # Granules of the days covering window, each name once in the order of the days
+        granules, names = [], set()
+        day = window[0].floor('D')
+        while day < window[1]:
+            with self.lock:
+                entry = self.days.setdefault(day, [threading.Lock(), None])
+            with entry[0]:
+                if entry[1] is None:
+                    entry[1] = self.query_day(day, day + timedelta(days=1))
+            for g in entry[1]:
+                if g.name not in names:
+                    names.add(g.name)
+                    granules.append(g)
+            day += timedelta(days=1)
+        return granules
+
+
+class FootprintIndex:
+    # Granule footprints (polygons, or bounding box if no polygon is published) matched against the boxes of many
+    # points of interest at once with numpy arrays: bounding boxes and time windows of all pairs of points and granules
+    # are compared first, then the pairs left are tested exactly (an edge of the polygon crosses the box, or the center
+    # of the box is inside the polygon), as the server filters granules on the box of each query (in plane coordinates)
+    # Footprints crossing the antimeridian are unwrapped to longitudes above 180, the edges of the k-th granule are the
+    # rows offsets[k]:offsets[k + 1] of edges (x0, y0, x1, y1)
+    def __init__(self, granules):
+        self.granules = granules
+        self.t0 = np.array([g.time_start if g.time_start is not None else np.datetime64('NaT') for g in granules],
+                           dtype='datetime64[us]')
+        self.t1 = np.array([g.time_end if g.time_end is not None else np.datetime64('NaT') for g in granules],
+                           dtype='datetime64[us]')
+        # points of the rings of every granule in one array (bounding box if no polygon is published)
+        points, ring_sizes, counts = [], [], []
+        for g in granules:
+            rings = g.footprint
+            if not rings and g.bbox is not None:
+                w, s, e, n = g.bbox
+                rings = [[(w, s), (e, s), (e, n), (w, n)]]
+            rings = [r for r in rings or [] if len(r) > 1]
+            for ring in rings:
+                points.extend(ring)
+                ring_sizes.append(len(ring))
+            counts.append(sum(len(r) for r in rings))
+        points = np.array(points, dtype=float).reshape(-1, 2)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.offsets = np.zeros(len(granules) + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=self.offsets[1:])
+        # granules without footprint nor box always intersect
+        self.bbox = np.tile([-np.inf, -np.inf, np.inf, np.inf], (len(granules), 1))
+        found = self.counts > 0
+        if found.any():
+            starts = self.offsets[:-1][found]
+            lon, lat = points[:, 0], points[:, 1]
+            wrapped = np.zeros(len(granules), dtype=bool)
+            wrapped[found] = np.maximum.reduceat(lon, starts) - np.minimum.reduceat(lon, starts) > 180
+            lon[np.repeat(wrapped, self.counts) & (lon < 0)] += 360
+            self.bbox[found] = np.column_stack([np.minimum.reduceat(lon, starts), np.minimum.reduceat(lat, starts),
+                                                np.maximum.reduceat(lon, starts), np.maximum.reduceat(lat, starts)])
+        # edges from each point to the next one of its ring, the last point is joined to the first (rings already
+        # closed have a last edge of length 0, which does not change the tests)
+        following = np.arange(1, len(points) + 1)
+        ring_ends = np.cumsum(ring_sizes, dtype=np.int64)
+        following[ring_ends - 1] = ring_ends - np.array(ring_sizes, dtype=np.int64)
+        self.edges = np.hstack([points, points[following]])
+
+    def candidates(self, bw, bs, be, bn, t0, t1):
+        # Pairs (point, granule, longitude shift of the box) whose bounding boxes and time windows intersect
+        gw, gs, ge, gn = [self.bbox[:, j][np.newaxis, :] for j in range(4)]
+        in_time = np.isnat(self.t0)[np.newaxis, :] | \
+            ((self.t0[np.newaxis, :] <= t1[:, np.newaxis]) & (self.t1[np.newaxis, :] >= t0[:, np.newaxis]))
+        in_lat = (gs <= bn[:, np.newaxis]) & (bs[:, np.newaxis] <= gn) & in_time
+        pairs = []
+        for shift in (-360., 0., 360.):
+            p, g = np.nonzero(in_lat & (gw <= be[:, np.newaxis] + shift) & (bw[:, np.newaxis] + shift <= ge))
+            pairs.append((p, g, np.full(len(p), shift)))
+        return [np.concatenate(x) for x in zip(*pairs)]
+
+    def intersect(self, p, g, shift, bw, bs, be, bn):
+        # Exact test of the pairs (point, granule) with the polygon edges of each granule
+        counts = self.counts[g]
+        pair = np.repeat(np.arange(len(p)), counts)
+        edge = np.repeat(self.offsets[g] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        x0, y0, x1, y1 = self.edges[edge].T
+        p = p[pair]
+        xmin, xmax = bw[p] + shift[pair], be[p] + shift[pair]
+        ymin, ymax = bs[p], bn[p]
+        # Liang-Barsky clipping of each edge by the box
+        dx, dy = x1 - x0, y1 - y0
+        t_in, t_out = np.zeros(len(edge)), np.ones(len(edge))
+        crosses = np.ones(len(edge), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for d, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+                t = q / d
+                crosses &= (d != 0) | (q >= 0)
+                t_in = np.where(d < 0, np.maximum(t_in, t), t_in)
+                t_out = np.where(d > 0, np.minimum(t_out, t), t_out)
+            crosses &= t_in <= t_out
+            # ray casting from the center of the box
+            cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+            ray = ((y0 > cy) != (y1 > cy)) & (cx < x0 + (cy - y0) * dx / dy)
+        n = len(g)
+        return (counts == 0) | (np.bincount(pair, crosses, n) > 0) | (np.bincount(pair, ray, n) % 2 == 1)
+
+    def match(self, boxes, windows):
+        # Images (names, urls) intersecting each (w, s, e, n) box (w > e if crossing the antimeridian) and time window
+        # in the order of the granules
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        bw, bs, be, bn = boxes.T
+        be = np.where(bw > be, be + 360, be)
+        t0 = np.array([w[0] for w in windows], dtype='datetime64[us]')
+        t1 = np.array([w[1] for w in windows], dtype='datetime64[us]')
+        matches = []
+        for start in range(0, len(boxes), FOOTPRINT_CHUNK_SIZE):
+            chunk = slice(start, start + FOOTPRINT_CHUNK_SIZE)
+            p, g, shift = self.candidates(bw[chunk], bs[chunk], be[chunk], bn[chunk], t0[chunk], t1[chunk])
+            keep = self.intersect(p, g, shift, bw[chunk], bs[chunk], be[chunk], bn[chunk])
+            # pairs found with several shifts are kept once, sorted by point then granule
+            pairs = np.unique((p[keep] + start) * len(self.granules) + g[keep])
+            matches.append(pairs)
+        pairs = np.concatenate(matches) if matches else np.zeros(0, dtype=np.int64)
+        n = max(len(self.granules), 1)
+        bounds = np.searchsorted(pairs // n, np.arange(len(boxes) + 1))
+        results = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            found = dict()
+            for j in pairs[a:b] % n:
+                found.setdefault(self.granules[j].name, self.granules[j].url)
+            results.append((list(found.keys()), list(found.values())))
+        return results
+
+
+def query_groups(pois, groups, query_group, select_granules, label, workers=1, callback=None,
+                 match=match_footprints):
+    # Run query_group(group box, group window) once per group of points of interest and map the granules returned
+    # back to each point of interest with match(granules, poi boxes, poi windows) then select_granules(image names,
+    # urls)
+    # callback(image_names, urls, poi=index of the poi) is called for each point of interest as soon as its group is
+    # queried, return ImageTable of the results
+    def run(k, group):
+        indices, boxes, windows, box, window = group
+        logger.info('[%i/%i]   Querying %s    %i points    %s    %s' %
+                    (k + 1, len(groups), label, len(indices), window[0], window[1]))
+        granules = query_group(box, window)
+        results = []
+        for i, matched in zip(indices, match(granules, boxes, windows)):
+            imlist, urls = select_granules(*matched)
+            if callback is not None:
+                callback(imlist, urls, poi=i)
+            results.append((i, imlist, urls))
+        return results
+
+    if workers <= 1:
+        results = [run(k, g) for k, g in enumerate(groups)]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run, range(len(groups)), groups))
+    # back to the order of pois
+    position = dict(zip(pois.index, range(len(pois))))
+    ordered = [([], [])] * len(pois)
+    for group_results in results:
+        for i, imlist, urls in group_results:
+            ordered[position[i]] = (imlist, urls)
+    return ImageTable(pois, ordered)
+
+
+def query_group_copernicus(box, window, access_platform, query_string, instrument, cloud_cover='[0,100]'):
     # https://documentation.dataspace.copernicus.eu/APIs/
-    # Add column to points of interest data frame
-    maxretries = 10
-    pois['image_names'] = [[] for _ in range(len(pois))]
-    pois['url'] = [[] for _ in range(len(pois))]
-    for i, poi in pois.iterrows():
-        logger.info('[%i/%i]   Querying %s %s %s on Copernicus    %s    %.5f  %.5f' %
-                    (i + 1, len(pois), poi['id'], instrument, level, poi['dt'], poi['lat'], poi['lon']))
-        # get polygon around poi and date
-        w, s, e, n, day_st, day_end = format_dtlatlon_query(poi, access_platform)
-        query = "%s%s/search.json?%s&cloudCover=%s&startDate=%s&completionDate=%s&maxRecords=200&box=%s,%s,%s,%s" % \
+    # Search all images in box (split if crossing the antimeridian) and time window, following pages of results
+    granules = []
+    for sub_box in split_box(box):
+        granules += search_copernicus(sub_box, window, access_platform, query_string, instrument, cloud_cover)
+    return granules
+
+
+def search_copernicus(box, window, access_platform, query_string, instrument, cloud_cover='[0,100]'):
+    max_records = 200
+    granules = []
+    page = 1
+    while True:
+        query = "%s%s/search.json?%s&cloudCover=%s&startDate=%s&completionDate=%s&maxRecords=%i&page=%i" \
+                "&box=%s,%s,%s,%s" % \
                 (URL_SEARCH_COPERNICUS, INSTRUMENT_FILE_ID[instrument], query_string, cloud_cover,
-                 day_st.strftime("%Y-%m-%dT%H:%M:%S.000Z"), day_end.strftime("%Y-%m-%dT%H:%M:%S.000Z"), w, s, e, n)
-        r = requests.get(query).json()
-        attempt = 0
-        while 'features' not in list(r.keys()) and attempt <= maxretries:
-            r = requests.get(query).json()
+                 window[0].strftime("%Y-%m-%dT%H:%M:%S.000Z"), window[1].strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                 max_records, page, *box)
+        response = get_query(query, access_platform, window[1])
+        r = response.json()
+        attempt = 1
+        # HTTP errors are already retried by get_query if temporary, responses without features are sent again
+        while 'features' not in r and response.status_code < 400 and _retry_policy.retryable(response, attempt):
+            _retry_policy.wait(attempt, 'image feature not found in server response', 'query', 'Copernicus search')
+            response = get_query(query, access_platform, window[1], refresh=True)
+            r = response.json()
             attempt += 1
-            logger.info('Image feature not found in server response, retry [%i/%i]' % (attempt, maxretries))
-            sleep(5)
-        # extract image name, id, and status from response
-        if 'features' in list(r.keys()):
-            img_features = pd.DataFrame.from_dict(r['features'])
-            if len(img_features) > 0:
-                url_list = list(img_features.id)
-                img_properties = dict(img_features.properties)
-                imlistraw = list()
-                prod_meta = list()
-                for im in range(len(url_list)):
-                    imlistraw.append(img_properties[im]['title'] + '.zip')
-                    prod_meta.append(img_properties[im]['status'])
-                sel_s3, sel_fid = sel_most_recent_esa(imlistraw, url_list, instrument)
-                # populate lists with image name, id, and status
-                # pois.at[i, 'image_names'] = [s + '.zip' for s in sel_s3]
-                pois.at[i, 'image_names'] = sel_s3
-                pois.at[i, 'url'] = sel_fid
-        else:
-            logger.info('%s unsuccessful attemps to retrieve image feature in server response, '
-                        'datetime %s, lat %s, lon %s ignored' % (maxretries, poi['dt'], poi['lat'], poi['lon']))
-    return pois
+        if 'features' not in r:
+            logger.info('%i unsuccessful attempts to retrieve image feature in server response (HTTP %i), '
+                        'datetime %s to %s ignored' % (attempt, response.status_code, window[0], window[1]))
+            return granules
+        for feature in r['features']:
+            geometry = feature.get('geometry') or {}
+            coordinates = geometry.get('coordinates', [])
+            # outer ring of each polygon (GeoJSON Polygon or MultiPolygon)
+            footprint = coordinates[0:1] if geometry.get('type') == 'Polygon' else \
+                [polygon[0] for polygon in coordinates] if geometry.get('type') == 'MultiPolygon' else []
+            while len(coordinates) > 0 and isinstance(coordinates[0][0], list):
+                coordinates = [c for part in coordinates for c in part]
+            granules.append(Granule(feature['properties']['title'] + '.zip', feature['id'],
+                                    parse_iso_datetime(feature['properties']['startDate']),
+                                    parse_iso_datetime(feature['properties']['completionDate']),
+                                    None, None, None,
+                                    footprint_bbox([c[0] for c in coordinates], [c[1] for c in coordinates]),
+                                    [[tuple(c[0:2]) for c in ring] for ring in footprint] or None))
+        if len(r['features']) < max_records:
+            return granules
+        page += 1
+
+
+def query_poi_copernicus(poi, box, access_platform, query_string, instrument, cloud_cover='[0,100]'):
+    granules = query_group_copernicus((box.w, box.s, box.e, box.n), (box.day_st, box.day_end), access_platform,
+                                      query_string, instrument, cloud_cover)
+    # extract image name and id from response
+    imlistraw, url_list = [], []
+    for g in granules:
+        if g.name not in imlistraw:
+            imlistraw.append(g.name)
+            url_list.append(g.url)
+    return sel_most_recent_esa(imlistraw, url_list, instrument)
+
 
+def get_image_list_copernicus(pois, access_platform, query_string, instrument, level='L1', cloud_cover='[0,100]',
+                              workers=1, coalesce=False, bounding_box_sz=60, callback=None, footprint_index=False):
+    # footprint_index: search the granules of each day once and match them locally (see plan_days)
+    with metrics.timer('stage_seconds', stage='plan', platform=access_platform):
+        boxes = get_query_boxes(pois, bounding_box_sz)
+        groups = plan_days(boxes) if footprint_index else plan_queries(boxes) if coalesce else None
+    daily = DailyGranules(lambda start, end: query_group_copernicus((-180., -90., 180., 90.), (start, end),
+                                                                    access_platform, query_string, instrument,
+                                                                    cloud_cover))
 
-def get_image_list_creodias(pois, access_platform, query_string, instrument, level='L1C'):  # username, password,
+    def query_group(box, window):
+        if footprint_index:
+            return daily.get(window)
+        return query_group_copernicus(box, window, access_platform, query_string, instrument, cloud_cover)
+
+    with metrics.timer('stage_seconds', stage='query', platform=access_platform):
+        if coalesce or footprint_index:
+            return query_groups(pois, groups, query_group,
+                                lambda imlist, urls: sel_most_recent_esa(imlist, urls, instrument),
+                                '%s %s on Copernicus' % (instrument, level), workers, callback)
+        return query_pois(pois, boxes, lambda poi, box: query_poi_copernicus(poi, box, access_platform, query_string,
+                                                                             instrument, cloud_cover),
+                          '%s %s on Copernicus' % (instrument, level), workers, callback)
+
+
+def get_image_list_creodias(pois, access_platform, query_string, instrument, level='L1C',
+                            bounding_box_sz=60):  # username, password,
     # Add column to points of interest data frame
     pois['image_names'] = [[] for _ in range(len(pois))]
     pois['url'] = [[] for _ in range(len(pois))]
-    for i, poi in pois.iterrows():
+    boxes = get_query_boxes(pois, bounding_box_sz)
+    for (i, poi), (w, s, e, n, _, day_st, day_end) in zip(pois.iterrows(), boxes.itertuples(index=False)):
         logger.info('[%i/%i]   Querying %s %s %s on Creodias    %s    %.5f  %.5f' %
                     (i + 1, len(pois), poi['id'], instrument, level, poi['dt'], poi['lat'], poi['lon']))
-        # get polygon around poi and date
-        w, s, e, n, day_st, day_end = format_dtlatlon_query(poi, access_platform)
         # Build Query
         query = '%s%s&startDate=%s&completionDate=%s&box=%s,%s,%s,%s' % \
                 (URL_SEARCH_CREODIAS, query_string, day_st.strftime("%Y-%m-%d"),
@@ -516,134 +1585,286 @@ def get_image_list_creodias(pois, access_platform, query_string, instrument, lev
     return pois
 
 
-def get_image_list_l12browser(pois, access_platform, query_string, instrument, level='L2', product='OC', query_delay=1):
-    # Add column to points of interest data frame
-    pois['image_names'] = [[] for _ in range(len(pois))]
-    pois['url'] = [[] for _ in range(len(pois))]
-    for i, poi in pois.iterrows():
-        logger.info('[%i/%i]   Querying %s %s %s %s on L1L2_browser    %s    %.5f  %.5f' %
-                    (i+1, len(pois), poi['id'], instrument, level, product, poi['dt'], poi['lat'], poi['lon']))
-        # get polygon around poi and date
-        w, s, e, n, day = format_dtlatlon_query(poi, access_platform)
-        # Build Query
-        query = '%s%s&per=DAY&day=%s&n=%s&s=%s&w=%s&e=%s' % (URL_L12BROWSER, query_string, day, n, s, w, e)
-        r = requests.get(query)
-        # extract image name from response
-        if 'href="https://oceandata.sci.gsfc.nasa.gov/ob/getfile/' in r.text: # if one image
-            imlistraw = re.findall(r'href="https://oceandata.sci.gsfc.nasa.gov/ob/getfile/(.*?)">', r.text)
-            imlistraw = [x for x in imlistraw if level in x]
-        else:  # if multiple images
-            imlistraw = re.findall(r'title="(.*?)"\nwidth="70"', r.text)
-            if level == 'L1A':
-                if instrument == 'MODIS-Aqua' or instrument == 'MODIS-Terra':
-                    # add missing extension when multiple results
-                    imlistraw = [s + '.bz2' for s in imlistraw]
-                    # remove duplicates
-                    imlistraw = list(dict.fromkeys(imlistraw))
-        # append VIIRS GEO file names at the end of the list
-        if 'VIIRS' in instrument and level == 'L1A':
-            imlistraw = imlistraw + [sub.replace('L1A', 'GEO') for sub in imlistraw]
-            if len(imlistraw) > 0:
-                imlistraw = [sub.replace(';;', ';') for sub in imlistraw]
-                if imlistraw[-1] == ';':
-                    imlistraw = imlistraw[0:-1]
-        # Delay next query (might get kicked by server otherwise)
-        sleep(query_delay)
-        # populate lists with image name and url
-        pois.at[i, 'image_names'] = imlistraw
-        # populate url list
-        pois.at[i, 'url'] = ['%s%s' % (URL_GET_FILE_CGI, s) for s in pois.at[i, 'image_names']]
-    return pois
+def query_poi_l12browser(poi, box, access_platform, query_string, instrument, level='L2'):
+    imlistraw = []
+    for w, s, e, n in split_box((box.w, box.s, box.e, box.n)):
+        for im in search_l12browser(w, s, e, n, box.day, access_platform, query_string, instrument, level):
+            if im not in imlistraw:
+                imlistraw.append(im)
+    # append VIIRS GEO file names at the end of the list
+    if 'VIIRS' in instrument and level == 'L1A':
+        imlistraw = imlistraw + [sub.replace('L1A', 'GEO') for sub in imlistraw]
+        if len(imlistraw) > 0:
+            imlistraw = [sub.replace(';;', ';') for sub in imlistraw]
+            if imlistraw[-1] == ';':
+                imlistraw = imlistraw[0:-1]
+    # populate lists with image name and url
+    return imlistraw, ['%s%s' % (URL_GET_FILE_CGI, s) for s in imlistraw]
 
 
-def select_day_night_flag(r, imlistraw, dn_flag):
-    if dn_flag.lower() != 'both':
-        daynight_flag = re.findall(r'"day_night_flag":"(.*?)","time_end":', r.text)
-        imlistraw = [x for x, dn in zip(imlistraw, daynight_flag) if dn == dn_flag.upper()]
+def search_l12browser(w, s, e, n, day, access_platform, query_string, instrument, level='L2'):
+    # Build Query (queries are delayed by the rate limiter, might get kicked by server otherwise)
+    query = '%s%s&per=DAY&day=%s&n=%s&s=%s&w=%s&e=%s' % (URL_L12BROWSER, query_string, day, n, s, w, e)
+    r = get_query(query, access_platform, datetime(1970, 1, 1) + timedelta(days=int(day) + 1))
+    # extract image name from response
+    if 'href="https://oceandata.sci.gsfc.nasa.gov/ob/getfile/' in r.text: # if one image
+        imlistraw = re.findall(r'href="https://oceandata.sci.gsfc.nasa.gov/ob/getfile/(.*?)">', r.text)
+        imlistraw = [x for x in imlistraw if level in x]
+    else:  # if multiple images
+        imlistraw = re.findall(r'title="(.*?)"\nwidth="70"', r.text)
+        if level == 'L1A':
+            if instrument == 'MODIS-Aqua' or instrument == 'MODIS-Terra':
+                # add missing extension when multiple results
+                imlistraw = [s + '.bz2' for s in imlistraw]
+                # remove duplicates
+                imlistraw = list(dict.fromkeys(imlistraw))
     return imlistraw
 
 
-def get_image_list_cmr(pois, access_platform, query_string, instrument, level='L2', product='OC', dn_flag='both'):
-    # https://cmr.earthdata.nasa.gov/search/granules.json?provider=OB_DAAC&short_name=MODISA_L2_OC&temporal=2016-08-21T00:00:01Z,2016-08-22T00:00:01Z&page_size=2000&page_num=1
-    # https://cmr.earthdata.nasa.gov/search/granules.json?provider=OB_DAAC&short_name=VIIRSJ1_L1&temporal=2020-08-16T00:00:01Z,2020-08-17T00:00:01Z&page_size=2000&page_num=1
-    # https://cmr.earthdata.nasa.gov/search/granules.json?provider=OB_DAAC&short_name=VIIRSJ1_L1_GEO&temporal=2020-08-16T00:00:01Z,2020-08-17T00:00:01Z&page_size=2000&page_num=1
-    # Add column to points of interest data frame
-    pois['image_names'] = [[] for _ in range(len(pois))]
-    pois['url'] = [[] for _ in range(len(pois))]
-    for i, poi in pois.iterrows():
-        logger.info('[%i/%i]   Querying %s %s %s %s on CMR    %s    %.5f  %.5f' %
-                    (i+1, len(pois), poi['id'], instrument, level, product, poi['dt'], poi['lat'], poi['lon']))
-        # get polygon around poi and date
-        w, s, e, n, day_st, day_end = format_dtlatlon_query(poi, access_platform)
-        # Build Query
-        query = '%s%s&bounding_box=%s,%s,%s,%s&temporal=%s,%s&page_size=2000&page_num=1' % \
-                (URL_CMR, query_string, w, s, e, n, day_st.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                 day_end.strftime("%Y-%m-%dT%H:%M:%SZ"))
-        r = requests.get(query)
-        # extract image name from response
-        imlistraw = re.findall(r'https://oceandata.sci.gsfc.nasa.gov/cmr/getfile/(.*?)"},', r.text)
-        imlistraw = select_day_night_flag(r, imlistraw, dn_flag)
-        # run second query for GEO files if VIIRS and L1A
-        if 'VIIRS' in instrument and level == 'L1A' or level == 'L1':
-            query = '%s%s&bounding_box=%s,%s,%s,%s&temporal=%s,%s&page_size=2000&page_num=1' % \
-                    (URL_CMR, query_string.replace('_L1', '_L1_GEO'), w, s, e, n, day_st.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                     day_end.strftime("%Y-%m-%dT%H:%M:%SZ"))
-            r = requests.get(query)
-            # extract image name from response
-            imlist_temp = re.findall(r'https://oceandata.sci.gsfc.nasa.gov/cmr/getfile/(.*?)"},', r.text)
-            imlist_temp = select_day_night_flag(r, imlist_temp, dn_flag)
-            imlistraw = imlistraw + imlist_temp
-        # run second query for NRT files if date_st or date_end more recent than 60 days
-        if datetime.utcnow() - day_st < timedelta(days=60) or datetime.utcnow() - day_end < timedelta(days=60):
-            query = '%s%s_NRT&bounding_box=%s,%s,%s,%s&temporal=%s,%s&page_size=2000&page_num=1' % \
-                    (URL_CMR, query_string, w, s, e, n, day_st.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                     day_end.strftime("%Y-%m-%dT%H:%M:%SZ"))
-            r = requests.get(query)
-            # extract image name from response
-            imlist_temp = re.findall(r'https://oceandata.sci.gsfc.nasa.gov/cmr/getfile/(.*?)"},', r.text)
-            imlist_temp = select_day_night_flag(r, imlist_temp, dn_flag)
-            imlistraw = imlistraw + imlist_temp
-        if level == 'L3m' or product == 'L3b':
-            imlistraw = [x for x in imlistraw if options.sresol in x and options.binning_period in x]
-        # Keep only good image name
-        if instrument == 'VIIRSN':
-            imlistraw = [x for x in imlistraw if "SNPP_VIIRS." in x]
-        if instrument == 'VIIRSJ1':
-            imlistraw = [x for x in imlistraw if "JPSS1_VIIRS." in x]
-        if instrument == 'VIIRSJ2':
-            imlistraw = [x for x in imlistraw if "JPSS2_VIIRS." in x]
-        if 'MODIS' in instrument:
-            if 'L1' in level:
-                imlistraw = [s + '.bz2' for s in imlistraw]
+def get_image_list_l12browser(pois, access_platform, query_string, instrument, level='L2', product='OC', query_delay=1,
+                              workers=1, bounding_box_sz=60, callback=None):
+    # pace queries to one every query_delay seconds
+    set_query_rate(access_platform, 1 / query_delay if query_delay > 0 else None)
+    with metrics.timer('stage_seconds', stage='plan', platform=access_platform):
+        boxes = get_query_boxes(pois, bounding_box_sz)
+    with metrics.timer('stage_seconds', stage='query', platform=access_platform):
+        return query_pois(pois, boxes,
+                          lambda poi, box: query_poi_l12browser(poi, box, access_platform, query_string, instrument,
+                                                                level),
+                          '%s %s %s on L1L2_browser' % (instrument, level, product), workers, callback)
+
+
+def filter_cmr_names(imlistraw, instrument, level='L2', product='OC', resolution='4km', binning_period='8D'):
+    if level == 'L3m' or product == 'L3b':
+        imlistraw = [x for x in imlistraw if resolution in x and binning_period in x]
+    # Keep only good image name
+    if instrument == 'VIIRSN':
+        imlistraw = [x for x in imlistraw if "SNPP_VIIRS." in x]
+    if instrument == 'VIIRSJ1':
+        imlistraw = [x for x in imlistraw if "JPSS1_VIIRS." in x]
+    if instrument == 'VIIRSJ2':
+        imlistraw = [x for x in imlistraw if "JPSS2_VIIRS." in x]
+    if 'MODIS' in instrument:
+        if 'L1' in level:
+            imlistraw = [s + '.bz2' for s in imlistraw]
+        else:
+            imlistraw = [x for x in imlistraw if "MODIS" in x]
+    return imlistraw
+
+
+def parse_cmr_granule(umm):
+    # Build granule record from the UMM-G metadata of a CMR search result
+    urls = [u['URL'] for u in umm.get('RelatedUrls', []) if u.get('Type') == 'GET DATA']
+    getfile = [u for u in urls if '/getfile/' in u]
+    if len(getfile) > 0:
+        name = getfile[0].split('/getfile/')[-1]
+    elif len(urls) > 0:
+        name = urls[0].split('/')[-1]
+    else:
+        name = umm.get('GranuleUR')
+    range_dt = umm.get('TemporalExtent', {}).get('RangeDateTime', {})
+    time_start = range_dt.get('BeginningDateTime', umm.get('TemporalExtent', {}).get('SingleDateTime'))
+    time_end = range_dt.get('EndingDateTime', time_start)
+    data_granule = umm.get('DataGranule', {})
+    size, checksum = None, None
+    for info in data_granule.get('ArchiveAndDistributionInformation', []):
+        if 'SizeInBytes' in info:
+            size = int(info['SizeInBytes'])
+        elif 'Size' in info:
+            size = int(float(info['Size']) * {'KB': 2**10, 'MB': 2**20, 'GB': 2**30}.get(info.get('SizeUnit'), 1))
+        if 'Checksum' in info:
+            checksum = (info['Checksum']['Algorithm'], info['Checksum']['Value'])
+        break
+    geometry = umm.get('SpatialExtent', {}).get('HorizontalSpatialDomain', {}).get('Geometry', {})
+    lons, lats, footprint = [], [], []
+    for polygon in geometry.get('GPolygons', []):
+        footprint.append([(point['Longitude'], point['Latitude']) for point in polygon['Boundary']['Points']])
+        for point in polygon['Boundary']['Points']:
+            lons.append(point['Longitude'])
+            lats.append(point['Latitude'])
+    for rectangle in geometry.get('BoundingRectangles', []):
+        w, s, e, n = [rectangle[k + 'BoundingCoordinate'] for k in ['West', 'South', 'East', 'North']]
+        # rectangles crossing the antimeridian are unwrapped
+        footprint.append([(w, s), (e + 360 if w > e else e, s), (e + 360 if w > e else e, n), (w, n)])
+        lons.extend([w, e])
+        lats.extend([s, n])
+    return Granule(name, '%s%s' % (URL_GET_FILE_CMR, name),
+                  parse_iso_datetime(time_start) if time_start else None,
+                  parse_iso_datetime(time_end) if time_end else None,
+                  data_granule.get('DayNightFlag', '').upper(), size, checksum, footprint_bbox(lons, lats),
+                  footprint or None)
+
+
+def search_cmr(short_name, box, window, access_platform, dn_flag='both', page_size=2000):
+    # Search granules of a CMR collection intersecting box (w, s, e, n) during window (start, end)
+    granules = []
+    for sub_box in split_box(box):
+        granules += search_cmr_box(short_name, sub_box, window, access_platform, dn_flag, page_size)
+    return granules
+
+
+def search_cmr_box(short_name, box, window, access_platform, dn_flag='both', page_size=2000):
+    # All pages of results are followed with the CMR-Search-After header
+    query = '%s%s&bounding_box=%s,%s,%s,%s&temporal=%s,%s&page_size=%i' % \
+            (URL_CMR, short_name, *box, window[0].strftime("%Y-%m-%dT%H:%M:%SZ"),
+             window[1].strftime("%Y-%m-%dT%H:%M:%SZ"), page_size)
+    granules = []
+    headers = None
+    while True:
+        r = get_query(query, access_platform, window[1], headers=headers)
+        items = r.json().get('items', [])
+        granules.extend(parse_cmr_granule(item['umm']) for item in items)
+        search_after = r.headers.get('CMR-Search-After')
+        if len(items) < page_size or not search_after:
+            break
+        headers = {'CMR-Search-After': search_after}
+    if dn_flag.lower() != 'both':
+        granules = [g for g in granules if g.day_night_flag == dn_flag.upper()]
+    return granules
+
+
+def query_group_cmr(box, window, access_platform, query_string, instrument, level='L2', dn_flag='both'):
+    # https://cmr.earthdata.nasa.gov/search/granules.umm_json?provider=OB_DAAC&short_name=MODISA_L2_OC&temporal=2016-08-21T00:00:01Z,2016-08-22T00:00:01Z&page_size=2000
+    # https://cmr.earthdata.nasa.gov/search/granules.umm_json?provider=OB_DAAC&short_name=VIIRSJ1_L1&temporal=2020-08-16T00:00:01Z,2020-08-17T00:00:01Z&page_size=2000
+    # https://cmr.earthdata.nasa.gov/search/granules.umm_json?provider=OB_DAAC&short_name=VIIRSJ1_L1_GEO&temporal=2020-08-16T00:00:01Z,2020-08-17T00:00:01Z&page_size=2000
+    granules = search_cmr(query_string, box, window, access_platform, dn_flag)
+    # run second query for GEO files if VIIRS and L1A
+    if 'VIIRS' in instrument and level == 'L1A' or level == 'L1':
+        granules += search_cmr(query_string.replace('_L1', '_L1_GEO'), box, window, access_platform, dn_flag)
+    # run second query for NRT files if date_st or date_end more recent than 60 days
+    if datetime.utcnow() - window[0] < NRT_PERIOD or datetime.utcnow() - window[1] < NRT_PERIOD:
+        granules += search_cmr(query_string + '_NRT', box, window, access_platform, dn_flag)
+    return granules
+
+
+def query_poi_cmr(poi, box, access_platform, query_string, instrument, level='L2', product='OC', dn_flag='both',
+                  checksums=None, resolution='4km', binning_period='8D', sizes=None):
+    granules = query_group_cmr((box.w, box.s, box.e, box.n), (box.day_st, box.day_end), access_platform,
+                               query_string, instrument, level, dn_flag)
+    if checksums is not None:
+        checksums.update((g.name, g.checksum) for g in granules if g.checksum is not None)
+    if sizes is not None:
+        sizes.update((g.name, g.size) for g in granules if g.size is not None)
+    imlistraw = filter_cmr_names(list(dict.fromkeys(g.name for g in granules)), instrument, level, product,
+                                 resolution, binning_period)
+    # populate lists with image name and url
+    return imlistraw, ['%s%s' % (URL_GET_FILE_CMR, s) for s in imlistraw]
+
+
+def get_image_list_cmr(pois, access_platform, query_string, instrument, level='L2', product='OC', dn_flag='both',
+                       workers=1, coalesce=False, bounding_box_sz=60, callback=None, resolution='4km',
+                       binning_period='8D', footprint_index=False):
+    # resolution and binning_period select L3 images, footprint_index: search the granules of each day once and match
+    # them locally (see plan_days)
+    # checksums (algorithm, value) published for the images found are kept in the ImageTable returned and passed to
+    # callback(image_names, urls, checksums, poi=index of the poi), sizes are kept in the ImageTable
+    with metrics.timer('stage_seconds', stage='plan', platform=access_platform):
+        boxes = get_query_boxes(pois, bounding_box_sz)
+        groups = plan_days(boxes) if footprint_index else plan_queries(boxes) if coalesce else None
+    checksums, sizes = dict(), dict()
+    if callback is not None:
+        callback = (lambda f: lambda imlist, urls, poi: f(imlist, urls, checksums, poi=poi))(callback)
+    if coalesce or footprint_index:
+        def select_granules(imlist, _):
+            imlist = filter_cmr_names(imlist, instrument, level, product, resolution, binning_period)
+            return imlist, ['%s%s' % (URL_GET_FILE_CMR, s) for s in imlist]
+
+        daily = DailyGranules(lambda start, end: query_group_cmr((-180., -90., 180., 90.), (start, end),
+                                                                 access_platform, query_string, instrument, level,
+                                                                 dn_flag))
+
+        def query_group(box, window):
+            if footprint_index:
+                granules = daily.get(window)
             else:
-                imlistraw = [x for x in imlistraw if "MODIS" in x]
-        # populate lists with image name and url
-        pois.at[i, 'image_names'] = imlistraw
-        pois.at[i, 'url'] = ['%s%s' % (URL_GET_FILE_CMR, s) for s in imlistraw]
-    return pois
+                granules = query_group_cmr(box, window, access_platform, query_string, instrument, level, dn_flag)
+            checksums.update((g.name, g.checksum) for g in granules if g.checksum is not None)
+            sizes.update((g.name, g.size) for g in granules if g.size is not None)
+            return granules
+    with metrics.timer('stage_seconds', stage='query', platform=access_platform):
+        if coalesce or footprint_index:
+            images = query_groups(pois, groups, query_group, select_granules,
+                                  '%s %s %s on CMR' % (instrument, level, product), workers, callback)
+        else:
+            images = query_pois(pois, boxes, lambda poi, box: query_poi_cmr(poi, box, access_platform, query_string,
+                                                                            instrument, level, product, dn_flag,
+                                                                            checksums, resolution, binning_period,
+                                                                            sizes),
+                                '%s %s %s on CMR' % (instrument, level, product), workers, callback)
+    images.checksums = checksums
+    images.sizes = sizes
+    return images
+
+
+def get_checksum_copernicus(session, product_id):
+    # Checksum (algorithm, value) of a product published by Copernicus OData, None if not available
+    # e.g. https://catalogue.dataspace.copernicus.eu/odata/v1/Products(<id>) "Checksum": [{"Algorithm": "MD5", ...}]
+    try:
+        r = session.get('%s(%s)' % (URL_GET_FILE_COPERNICUS, product_id), timeout=_http_config['timeout'])
+        r.raise_for_status()
+        checksums = [(c['Algorithm'], c['Value']) for c in r.json().get('Checksum', []) if c.get('Value')]
+    except Exception as e:
+        logger.info('Unable to get checksum of product %s: %s' % (product_id, e))
+        return None
+    # keep the first algorithm available
+    for algorithm, value in checksums:
+        if new_hash(algorithm) is not None:
+            return algorithm, value
+    return None
 
 
-def request_platform(s, image_names, url_dwld, access_platform, username, password, login_key_in):
+def new_hash(algorithm):
+    # Return hash object (hashlib interface) computing the checksum algorithm named by CMR or Copernicus, None if not
+    # supported (BLAKE3 requires the blake3 package)
+    name = algorithm.lower().replace('-', '').replace('_', '')
+    if name == 'blake3':
+        try:
+            from blake3 import blake3
+        except ImportError:
+            return None
+        return blake3()
+    if name.startswith('sha3'):
+        name = 'sha3_' + name[4:]
+    try:
+        return hashlib.new(name)
+    except ValueError:
+        return None
+
+
+def hash_file(file_name, hasher, block_size=2**20):
+    # Update hasher with the content of file_name already on disk
+    with open(file_name, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            hasher.update(block)
+    return hasher
+
+
+def request_platform(s, image_names, url_dwld, access_platform, username, password, login_key_in, range_headers=None):
     if access_platform == 'copernicus':
         # get keycloak_token
         login_key = get_keycloak(username, password)
         # start download request
-        url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products(%s)/$value" % url_dwld
+        url = "%s(%s)/$value" % (URL_GET_FILE_COPERNICUS, url_dwld)
         s.headers.update({'Authorization': 'Bearer %s' % login_key})
-        response = s.get(url, allow_redirects=False)
+        response = s.get(url, allow_redirects=False, timeout=_http_config['timeout'])
+        if response.status_code == 401:
+            # token rejected, login again at next attempt
+            get_keycloak_token(username, password).invalidate()
         while response.status_code in (301, 302, 303, 307):
             url = response.headers['Location']
-            response = s.get(url, allow_redirects=False, stream=True, timeout=30)
+            response = s.get(url, allow_redirects=False, stream=True, timeout=_http_config['timeout'])
         return response, None, url
     elif access_platform == 'creodias':  # DEPRECATED
         headers = {'Range': 'bytes=' + str(os.stat('tmp_' + image_names).st_size) + '-'}
-        response = s.get(url_dwld + login_key_in, stream=True, timeout=900, headers=headers)
+        response = s.get(url_dwld + login_key_in, stream=True, timeout=_http_config['timeout'],
+                         headers=headers)
         if response.status_code != 200 and response.status_code != 206:
             if response.text == 'Expired signature!':
                 logger.info('Login expired, reconnection ...')
                 # get login key to include it into url
                 login_key = get_login_key(username, password)
-                response = s.get(url_dwld + login_key, stream=True, timeout=900, headers=headers)
+                response = s.get(url_dwld + login_key, stream=True, timeout=_http_config['timeout'],
+                                 headers=headers)
             else:
                 login_key = None
                 logger.info(response.status_code)
@@ -656,136 +1877,1188 @@ def request_platform(s, image_names, url_dwld, access_platform, username, passwo
         # modify header to hide requests query and mimic web browser
         headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) AppleWebKit/537.36 (KHTML, '
                                  'like Gecko) Chrome/68.0.3440.106 Safari/537.36',}
-        response = s.get(url_dwld, auth=(username, password), stream=True, timeout=900, headers=headers)
+        headers.update(range_headers or {})
+        response = s.get(url_dwld, auth=(username, password), stream=True, timeout=_http_config['timeout'],
+                         headers=headers)
         return response, None, None
 
 
-def download_files(file_todownload, file_name, expected_sz):
-    prev_file_sz = 0
-    with open(file_name, "ab") as handle:
-        for chunk in file_todownload.iter_content(chunk_size=128 * 1024):
-            if chunk:
-                handle.write(chunk)
-                if os.path.isfile(file_name):
-                    tmp_file_sz = round(float(
-                        os.stat(file_name).st_size) / expected_sz * 100, -1)
-                    if tmp_file_sz > prev_file_sz:
-                        if verbose:
-                            sys.stdout.write('\rDownloading %s   %s%%' %
-                                             (file_name.replace('tmp_', ''), str(round(tmp_file_sz))))
-                        prev_file_sz = tmp_file_sz
-                else:
-                    logger.info('Warning: temporary file %s not found' % file_name)
-    if handle.closed:
-        handle = open(file_name, "ab")
+def read_chunks(response, buffer):
+    # Yield chunks of the body of a streamed response read into buffer (memoryview reused for every chunk, so no
+    # memory is allocated per chunk), encoded bodies (e.g. gzip) are decoded by requests instead
+    if response.headers.get('Content-Encoding', 'identity').lower() != 'identity' or \
+            not hasattr(response.raw, 'readinto'):
+        for chunk in response.iter_content(chunk_size=len(buffer)):
+            yield chunk
+        return
+    view = memoryview(buffer)
+    while True:
+        n = response.raw.readinto(view)
+        if not n:
+            return
+        yield view[0:n]
+
+
+def preallocate(handle, size):
+    # Reserve the disk space of the file (limits fragmentation, fails early if the disk is full)
+    # Return False if not supported by the system or the file system
+    if not _write_config['preallocate'] or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(handle.fileno(), 0, size)
+        return True
+    except OSError:
+        return False
+
+
+def sync(handle):
+    # Flush data written to the system, and to the disk if fsync is enabled
     handle.flush()
-    actual_length = os.stat(file_name).st_size
-    if actual_length < expected_sz:
-        raise IOError('incomplete read ({} bytes read, {} more expected)'.
-                      format(actual_length, expected_sz - actual_length))
-    if verbose:
+    if _write_config['fsync']:
+        os.fsync(handle.fileno())
+
+
+def download_files(file_todownload, file_name, expected_sz, show_progress=True, checkpoint=None, hasher=None):
+    # Append the body of the response to file_name, preallocated to expected_sz when known: bytes received are
+    # counted in memory (the file is only stat once) and the file is truncated to them if the download fails
+    # checkpoint(bytes in file) is called every CHECKPOINT_SIZE bytes written to record progress
+    # hasher (hashlib interface) is updated with each chunk written, avoiding to read the file again to check it
+    prev_file_sz = 0
+    received = os.stat(file_name).st_size if os.path.isfile(file_name) else 0
+    last_checkpoint = received
+    handle = open(file_name, 'r+b' if received else 'wb', buffering=_write_config['buffer_size'])
+    preallocated = False
+    if expected_sz and expected_sz > received:
+        if checkpoint is not None:
+            # bytes in file are recorded before the file size changes
+            checkpoint(received)
+        preallocated = preallocate(handle, expected_sz)
+    handle.seek(received)
+    try:
+        for chunk in read_chunks(file_todownload, bytearray(_write_config['buffer_size'])):
+            handle.write(chunk)
+            received += len(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            if checkpoint is not None and received - last_checkpoint >= CHECKPOINT_SIZE:
+                # data recorded must be in the file
+                sync(handle)
+                checkpoint(received)
+                last_checkpoint = received
+            if expected_sz and show_progress:
+                tmp_file_sz = round(received / expected_sz * 100, -1)
+                if tmp_file_sz > prev_file_sz:
+                    sys.stdout.write('\rDownloading %s   %s%%' %
+                                     (file_name.replace('tmp_', ''), str(round(tmp_file_sz))))
+                    prev_file_sz = tmp_file_sz
+        if expected_sz and received < expected_sz:
+            raise IOError('incomplete read ({} bytes read, {} more expected)'.
+                          format(received, expected_sz - received))
+        sync(handle)
+    except BaseException:
+        # partial file ends at the last byte received (resumed from its size)
+        try:
+            if preallocated:
+                handle.flush()
+                handle.truncate(received)
+        finally:
+            handle.close()
+        raise
+    if show_progress:
         print(' done')
     return handle
 
 
-def login_download(img_names, urls, instrument, access_platform, username, password):
+def download_segment(session, url, file_name, start, end, progress, auth=None, max_retries=5, checkpoint=None):
+    # Download bytes start to end (included) of url at the same position in file_name, retrying from the last byte
+    # written if the connection drops (up to max_retries attempts, waiting as set by the retry policy)
+    # checkpoint(position) is called every CHECKPOINT_SIZE bytes written to record progress
+    position = start
+    last_checkpoint = start
+    attempts = 0
+    buffer = bytearray(min(_write_config['buffer_size'], end + 1 - start))
+    while True:
+        try:
+            headers = {'Range': 'bytes=%i-%i' % (position, end)}
+            with session.get(url, auth=auth, stream=True, timeout=_http_config['timeout'], headers=headers) as r:
+                if r.status_code != 206:
+                    raise IOError('range request not honoured (HTTP %i)' % r.status_code)
+                with open(file_name, 'r+b', buffering=len(buffer)) as handle:
+                    handle.seek(position)
+                    for chunk in read_chunks(r, buffer):
+                        handle.write(chunk)
+                        position += len(chunk)
+                        progress(len(chunk))
+                        if checkpoint is not None and position - last_checkpoint >= CHECKPOINT_SIZE:
+                            sync(handle)
+                            checkpoint(position)
+                            last_checkpoint = position
+                    sync(handle)
+            if checkpoint is not None:
+                checkpoint(position)
+            if position <= end:
+                raise IOError('incomplete segment (%i bytes missing)' % (end + 1 - position))
+            return
+        except Exception as e:
+            attempts += 1
+            if attempts >= max_retries or not _retry_policy.retryable(e, attempts):
+                raise
+            _retry_policy.wait(attempts, e, 'segment', 'Segment %i-%i of %s (interrupted at byte %i)' %
+                               (start, end, file_name.replace('tmp_', ''), position))
+
+
+def download_segmented(session, url, file_name, expected_sz, segments, auth=None, show_progress=True, bounds=None,
+                       checkpoint=None):
+    # Download url in segments fetched simultaneously into a file preallocated to its final size
+    # bounds are the [position, end] of the segments left to resume an interrupted download (None to start over)
+    # checkpoint(bounds) records progress of the segments, the file is then kept if the download fails
+    if bounds is None:
+        with open(file_name, 'wb') as handle:
+            if not preallocate(handle, expected_sz):
+                # sparse file
+                handle.truncate(expected_sz)
+        segment_sz = -(-expected_sz // segments)
+        bounds = [[start, min(start + segment_sz, expected_sz) - 1] for start in range(0, expected_sz, segment_sz)]
+        if checkpoint is not None:
+            checkpoint(bounds)
+        logger.info('Downloading %s in %i segments' % (file_name.replace('tmp_', ''), len(bounds)))
+    else:
+        bounds = [list(b) for b in bounds]
+        logger.info('Resuming download of %s: %i segments left' %
+                    (file_name.replace('tmp_', ''), len([b for b in bounds if b[0] <= b[1]])))
+    lock = threading.Lock()
+    downloaded = [expected_sz - sum(end + 1 - position for position, end in bounds), 0]
+
+    def progress(n_bytes):
+        with lock:
+            downloaded[0] += n_bytes
+            pct = round(downloaded[0] / expected_sz * 100, -1)
+            if pct > downloaded[1]:
+                if show_progress:
+                    sys.stdout.write('\rDownloading %s   %s%%' % (file_name.replace('tmp_', ''), str(round(pct))))
+                downloaded[1] = pct
+
+    def save(k, position):
+        with lock:
+            bounds[k][0] = position
+            checkpoint(bounds)
+
+    def run(k, start, end):
+        # each segment thread uses its own session with the same credentials
+        segment_session = get_session()
+        segment_session.headers.update(session.headers)
+        segment_session.cookies.update(session.cookies)
+        download_segment(segment_session, url, file_name, start, end, progress, auth,
+                         checkpoint=None if checkpoint is None else lambda position: save(k, position))
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            for f in [executor.submit(run, k, start, end) for k, (start, end) in enumerate(bounds) if start <= end]:
+                f.result()
+    except Exception:
+        if checkpoint is None:
+            # file has holes, it cannot be resumed
+            os.remove(file_name)
+        raise
+    if show_progress:
+        print(' done')
+
+
+def get_validator(response):
+    # Return ETag or Last-Modified of the file if the server accepts range requests, None otherwise
+    if response.headers.get('Accept-Ranges', 'none').lower() != 'bytes' and response.status_code != 206:
+        return None
+    return response.headers.get('ETag', response.headers.get('Last-Modified', ''))
+
+
+def range_headers(file_name, validator=None):
+    # Build headers to resume download from the end of a partial file
+    # If-Range makes the server send the whole file if it changed since the partial file was downloaded
+    offset = os.stat(file_name).st_size if os.path.isfile(file_name) else 0
+    if offset == 0:
+        return {}
+    headers = {'Range': 'bytes=%i-' % offset}
+    if validator:
+        headers['If-Range'] = validator
+    return headers
+
+
+def check_range_response(response, file_name, headers):
+    # Check if the server honoured the range request, truncate the partial file otherwise
+    # Return the total size of the file expected (None if unknown)
+    if 'Range' in headers and response.status_code == 206:
+        offset = int(headers['Range'][6:-1])
+        content_range = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', response.headers.get('Content-Range', ''))
+        if content_range is None or int(content_range.group(1)) != offset:
+            raise IOError('unexpected Content-Range %s (resuming from byte %i)' %
+                          (response.headers.get('Content-Range'), offset))
+        logger.info('Resuming download of %s from %.1f MB' % (file_name.replace('tmp_', ''), offset / 10**6))
+        if content_range.group(3) == '*':
+            return None
+        return int(content_range.group(3))
+    if 'Range' in headers:
+        # range not supported or file changed on server: restart from byte zero
+        open(file_name, 'wb').close()
+    if response.headers.get('Content-Length') is None:
+        return None
+    return int(response.headers.get('Content-Length'))
+
+
+def use_segments(segments, validator, expected_sz, headers):
+    # Split download only for new files large enough, on servers supporting range requests
+    return segments > 1 and validator is not None and expected_sz is not None and \
+        expected_sz >= SEGMENT_MIN_SIZE and 'Range' not in headers
+
+
+class DownloadState:
+    # Persistent record (sqlite) of the images to download: url, expected size, checksum, bytes received, and status
+    # (pending, downloading, done, or failed) of each image are updated as the run progresses, so that an interrupted
+    # run continues where it stopped: images done are skipped without looking at the disk, partial files are resumed
+    # from the last checkpoint, and the image list is read back without querying again (option -r)
+    # Checksums are stored as algorithm:value, file_hash is the checksum computed on the file downloaded
+    # Processes sharing the state (sharded runs, see Client.shard) claim chunks of points of interest and images with
+    # leases (owner, lease_until) taken in exclusive transactions, the state is then on a shared file system and uses
+    # a rollback journal (shared=True) as WAL requires all processes to be on the same host
+    def __init__(self, filename, shared=False):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False, timeout=60)
+        self.db.execute('PRAGMA journal_mode=%s' % ('DELETE' if shared else 'WAL'))
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS image (name TEXT PRIMARY KEY, url TEXT, position INTEGER, '
+                        'expected_size INTEGER, checksum TEXT, bytes_received INTEGER DEFAULT 0, validator TEXT, '
+                        'segments TEXT, status TEXT DEFAULT \'pending\', updated REAL, file_hash TEXT)')
+        columns = [c[1] for c in self.db.execute('PRAGMA table_info(image)')]
+        for column, column_type in [('file_hash', 'TEXT'), ('owner', 'TEXT'), ('lease_until', 'REAL')]:
+            if column not in columns:
+                self.db.execute('ALTER TABLE image ADD COLUMN %s %s' % (column, column_type))
+        self.db.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)')
+        # chunks of points of interest queried in sharded runs, result holds the images found (json)
+        self.db.execute('CREATE TABLE IF NOT EXISTS chunk (k INTEGER PRIMARY KEY, status TEXT DEFAULT \'pending\', '
+                        'owner TEXT, lease_until REAL, updated REAL, result TEXT)')
+        self.db.commit()
+
+    @contextmanager
+    def transaction(self):
+        # Exclusive write transaction: other processes sharing the state wait until it is committed
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def register(self, image_names, urls, checksums=None):
+        # Record the image list of a query (replacing the previous list), progress of images already known is kept
+        # checksums: dict of image name to (algorithm, value) published
+        self.clear()
+        self.append(image_names, urls, checksums)
+        self.set_complete()
+
+    def clear(self):
+        # Start a new image list
+        with self.lock:
+            self.db.execute('UPDATE image SET position = NULL')
+            self.db.execute('DELETE FROM run WHERE key = \'image_list\'')
+            self.db.commit()
+
+    def append(self, image_names, urls, checksums=None):
+        # Add images at the end of the image list
+        with self.transaction() as db:
+            self.insert(db, image_names, urls, checksums)
+
+    def insert(self, db, image_names, urls, checksums=None):
+        # Add images at the end of the image list within a transaction (see append)
+        checksums = checksums or {}
+        offset = db.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM image').fetchone()[0]
+        db.executemany('INSERT INTO image (name, url, position, checksum, updated) VALUES (?, ?, ?, ?, ?) '
+                       'ON CONFLICT (name) DO UPDATE SET url = excluded.url, '
+                       'position = COALESCE(position, excluded.position), '
+                       'checksum = COALESCE(excluded.checksum, checksum)',
+                       [(name, url, offset + k, '%s:%s' % checksums[name] if name in checksums else None, time())
+                        for k, (name, url) in enumerate(zip(image_names, urls))])
+
+    def set_complete(self):
+        # Mark the image list as complete (all points of interest queried)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO run VALUES (\'image_list\', ?)', (datetime.utcnow().isoformat(),))
+            self.db.commit()
+
+    def complete(self):
+        # True once the image list of a query was recorded
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM run WHERE key = \'image_list\'').fetchone() is not None
+
+    def images(self):
+        # Return image names and urls of the image list recorded, in query order
+        with self.lock:
+            rows = self.db.execute('SELECT name, url FROM image WHERE position IS NOT NULL '
+                                   'ORDER BY position').fetchall()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def get(self, name):
+        # Return record of an image as a dict (segments decoded), None if unknown
+        with self.lock:
+            cursor = self.db.execute('SELECT * FROM image WHERE name = ?', (name,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        record = dict(zip([c[0] for c in cursor.description], row))
+        record['segments'] = json.loads(record['segments']) if record['segments'] else None
+        record['checksum'] = tuple(record['checksum'].split(':', 1)) if record['checksum'] else None
+        return record
+
+    def update(self, name, **values):
+        values['updated'] = time()
+        columns = list(values.keys())
+        with self.lock:
+            self.db.execute('INSERT INTO image (name, %s) VALUES (?%s) ON CONFLICT (name) DO UPDATE SET %s' %
+                            (', '.join(columns), ', ?' * len(columns),
+                             ', '.join('%s = excluded.%s' % (c, c) for c in columns)),
+                            [name] + [values[c] for c in columns])
+            self.db.commit()
+
+    def start(self, name, expected_size, validator):
+        self.update(name, expected_size=expected_size, validator=validator, status='downloading')
+
+    def progress(self, name, bytes_received, segments=None):
+        # segments: [position, end] of each segment of a segmented download
+        self.update(name, bytes_received=bytes_received, segments=json.dumps(segments) if segments else None)
+
+    def set_checksum(self, name, checksum):
+        self.update(name, checksum='%s:%s' % checksum)
+
+    def done(self, name, size, file_hash=None):
+        self.update(name, bytes_received=size, segments=None, status='done',
+                    file_hash='%s:%s' % file_hash if file_hash else None)
+
+    def failed(self, name):
+        self.update(name, status='failed')
+
+    def claim_chunk(self, k, owner, chunk_size):
+        # Lease the k-th chunk of points of interest to owner if not queried nor leased by another process, return
+        # True if claimed (chunks are numbered with the chunk_size of the first process, which all processes must use)
+        now = time()
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO run VALUES (\'chunk_size\', ?)', (str(chunk_size),))
+            if int(db.execute('SELECT value FROM run WHERE key = \'chunk_size\'').fetchone()[0]) != chunk_size:
+                raise ValueError('chunks of the state are of a different size, use the same --chunk-size in all '
+                                 'processes')
+            db.execute('INSERT OR IGNORE INTO chunk (k) VALUES (?)', (k,))
+            claimed = db.execute('UPDATE chunk SET owner = ?, lease_until = ?, updated = ? WHERE k = ? AND '
+                                 'status != \'done\' AND (owner IS NULL OR lease_until < ?)',
+                                 (owner, now + LEASE_TTL, now, k, now)).rowcount
+        return claimed == 1
+
+    def chunk_done(self, k, images, image_names, urls):
+        # Record the images found for the k-th chunk (ImageTable) and append the images to download (image_names, urls,
+        # one version of each image) to the image list, at once so that the images of a chunk are downloaded once
+        # whatever the process that queried it
+        result = {'names': images.names, 'urls': images.urls, 'index': images.index.tolist(),
+                  'offsets': images.offsets.tolist(), 'checksums': images.checksums, 'sizes': images.sizes}
+        with self.transaction() as db:
+            self.insert(db, image_names, urls, images.checksums)
+            db.execute('UPDATE chunk SET status = \'done\', owner = NULL, updated = ?, result = ? WHERE k = ?',
+                       (time(), json.dumps(result), k))
+
+    def chunk_images(self, pois, k):
+        # Return ImageTable of the images found for pois, the k-th chunk of points of interest (see chunk_done)
+        with self.lock:
+            result = json.loads(self.db.execute('SELECT result FROM chunk WHERE k = ?', (k,)).fetchone()[0])
+        names, urls, index, offsets = result['names'], result['urls'], result['index'], result['offsets']
+        return ImageTable(pois, [([names[j] for j in index[a:b]], [urls[j] for j in index[a:b]])
+                                 for a, b in zip(offsets[:-1], offsets[1:])],
+                          {name: tuple(checksum) for name, checksum in result['checksums'].items()},
+                          result['sizes'])
+
+    def chunks_left(self, n_chunks=None):
+        # Number of chunks not queried yet (of n_chunks if known) and number of them that can be claimed
+        now = time()
+        with self.lock:
+            done, claimable = self.db.execute('SELECT COALESCE(SUM(status = \'done\'), 0), '
+                                              'COALESCE(SUM(status != \'done\' AND (owner IS NULL OR '
+                                              'lease_until < ?)), 0) FROM chunk', (now,)).fetchone()
+            total = self.db.execute('SELECT COUNT(*) FROM chunk').fetchone()[0]
+        return (n_chunks if n_chunks is not None else total) - done, claimable
+
+    def claim_complete(self):
+        # Mark the image list as complete, return True only for the process that marked it
+        with self.transaction() as db:
+            return db.execute('INSERT OR IGNORE INTO run VALUES (\'image_list\', ?)',
+                              (datetime.utcnow().isoformat(),)).rowcount == 1
+
+    def claim_images(self, owner, n, started):
+        # Lease up to n images of the image list not downloaded nor leased by another process to owner, in query order
+        # Images failed during this run (since started) are not claimed again, those failed before are retried
+        now = time()
+        with self.transaction() as db:
+            rows = db.execute('SELECT name, url FROM image WHERE position IS NOT NULL AND status != \'done\' AND '
+                              '(status != \'failed\' OR updated < ?) AND (owner IS NULL OR lease_until < ?) '
+                              'ORDER BY position LIMIT ?', (started, now, n)).fetchall()
+            db.executemany('UPDATE image SET owner = ?, lease_until = ? WHERE name = ?',
+                           [(owner, now + LEASE_TTL, row[0]) for row in rows])
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def leased(self, owner):
+        # Number of chunks and images leased by other processes (lease not expired)
+        now = time()
+        with self.lock:
+            return sum(self.db.execute('SELECT COUNT(*) FROM %s WHERE status != \'done\' AND owner IS NOT NULL AND '
+                                       'owner != ? AND lease_until >= ?' % table, (owner, now)).fetchone()[0]
+                       for table in ('chunk', 'image'))
+
+    def renew(self, owner):
+        # Extend the leases held by owner (heartbeat)
+        with self.transaction() as db:
+            for table in ('chunk', 'image'):
+                db.execute('UPDATE %s SET lease_until = ? WHERE owner = ?' % table, (time() + LEASE_TTL, owner))
+
+    def release(self, owner):
+        # Release the leases held by owner, chunks and images not done can be claimed by other processes
+        with self.transaction() as db:
+            for table in ('chunk', 'image'):
+                db.execute('UPDATE %s SET owner = NULL, lease_until = NULL WHERE owner = ?' % table, (owner,))
+
+
+class Heartbeat:
+    # Renew the leases of owner in state every LEASE_TTL / 3 seconds from a background thread, leases are released
+    # when leaving the context (also on failure) so other processes take over at once
+    def __init__(self, state, owner):
+        self.state = state
+        self.owner = owner
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(LEASE_TTL / 3):
+            try:
+                self.state.renew(self.owner)
+            except sqlite3.Error as e:
+                logger.info('Unable to renew leases of %s: %s' % (self.owner, e))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.state.release(self.owner)
+
+
+def write_granule(session, response, image_name, headers, validator=None, resume=None, segments=1, auth=None,
+                  show_progress=True, state=None, checksum=None):
+    # Write the file sent in response into tmp_<image_name>, in simultaneous segments if large enough
+    # resume holds the [position, end] of the segments left by an interrupted segmented download of the file
+    # identified by validator (response is then the whole file, requested without range)
+    # Progress is recorded in state every CHECKPOINT_SIZE bytes when the download can be resumed
+    # The file is checked against checksum (algorithm, value) if published, hashing the chunks as they are written
+    # (segmented downloads are read once complete as segments are not received in order)
+    # Return handle of the file written (None if segmented), validator, and checksum of the file (None if unchecked)
+    file_validator = get_validator(response)
+    expected_length = check_range_response(response, 'tmp_' + image_name, headers)
+    if resume is not None and (file_validator is None or file_validator != validator or
+                               expected_length != resume[-1][1] + 1):
+        logger.info('File %s changed on server: downloading again' % image_name)
+        open('tmp_' + image_name, 'wb').close()
+        resume = None
+    checkpoint = None
+    if state is not None:
+        state.start(image_name, expected_length, file_validator)
+        if file_validator is not None:
+            checkpoint = lambda received: state.progress(image_name, received)
+    hasher = new_hash(checksum[0]) if checksum is not None else None
+    if resume is not None or use_segments(segments, file_validator, expected_length, headers):
+        response.close()
+        if checkpoint is not None:
+            checkpoint = lambda bounds: state.progress(
+                image_name, expected_length - sum(end + 1 - position for position, end in bounds), bounds)
+        download_segmented(session, response.url, 'tmp_' + image_name, expected_length, segments, auth,
+                           show_progress, resume, checkpoint)
+        handle = None
+        if hasher is not None:
+            hash_file('tmp_' + image_name, hasher)
+    else:
+        if hasher is not None and os.path.isfile('tmp_' + image_name):
+            # bytes received by previous attempts
+            hash_file('tmp_' + image_name, hasher)
+        handle = download_files(response, 'tmp_' + image_name, expected_length, show_progress, checkpoint, hasher)
+    if hasher is None:
+        return handle, file_validator, None
+    if hasher.hexdigest().lower() != checksum[1].lower():
+        if handle:
+            handle.close()
+        # corrupted file cannot be resumed
+        os.remove('tmp_' + image_name)
+        if state is not None:
+            state.progress(image_name, 0)
+        metrics.inc('checksum_mismatches_total')
+        raise IOError('%s checksum mismatch (%s expected, %s computed)' %
+                      (checksum[0], checksum[1], hasher.hexdigest()))
+    return handle, file_validator, (checksum[0], hasher.hexdigest())
+
+
+def download_granule(image_name, url_dwld, access_platform, username, password, login_key, show_progress=True,
+                     segments=1, state=None, checksum=None):
+    # Download one image into tmp_<image_name> and rename it once complete, failed attempts resume from the end of
+    # tmp_<image_name> with HTTP range requests when the server supports it
+    # Files larger than SEGMENT_MIN_SIZE are downloaded in several segments simultaneously if segments > 1
+    # With a download state (DownloadState), images done are skipped without looking at the disk and partial files
+    # left by an interrupted run are resumed from the progress recorded
+    # Images are checked against the checksum (algorithm, value) published by CMR (recorded in state) or Copernicus
+    # Return the number of bytes downloaded (0 if the image was already there) or None if all attempts failed
+    # ETag or Last-Modified of the file downloaded, None if the server does not support range requests
+    validator = None
+    # [position, end] of the segments left to download when resuming a segmented download
+    resume = None
+    record = state.get(image_name) if state is not None else None
+    if record is not None and record['status'] == 'done':
+        logger.info('Skip ' + image_name)
+        metrics.inc('downloads_total', status='skipped')
+        return 0
+    if checksum is None and record is not None:
+        checksum = record['checksum']
+    if checksum is None and access_platform == 'copernicus':
+        checksum = get_checksum_copernicus(get_session(), url_dwld)
+        if checksum is not None and state is not None:
+            state.set_checksum(image_name, checksum)
+    if os.path.isfile(image_name) and checksum is not None and (record is None or not record['expected_size']):
+        # downloaded before the download state was recorded: checked once, then trusted from the state
+        file_hash = hash_file(image_name, new_hash(checksum[0])).hexdigest()
+        if file_hash.lower() == checksum[1].lower():
+            if state is not None:
+                state.done(image_name, os.stat(image_name).st_size, (checksum[0], file_hash))
+            logger.info('Skip ' + image_name)
+            metrics.inc('downloads_total', status='skipped')
+            return 0
+        logger.info('File %s exists but its %s checksum does not match: downloading again' %
+                    (image_name, checksum[0]))
+        os.remove(image_name)
+    if os.path.isfile(image_name):
+        if record is not None and record['expected_size']:
+            if os.stat(image_name).st_size == record['expected_size']:
+                # renamed before the end of the download was recorded
+                state.done(image_name, record['expected_size'])
+                logger.info('Skip ' + image_name)
+                metrics.inc('downloads_total', status='skipped')
+                return 0
+            logger.info('File %s exists but incomplete: downloading again' % image_name)
+            os.remove(image_name)
+        elif float(os.stat(image_name).st_size) > 2*10**5:
+            # downloaded before the download state was recorded
+            if state is not None:
+                state.done(image_name, os.stat(image_name).st_size)
+            logger.info('Skip ' + image_name)
+            metrics.inc('downloads_total', status='skipped')
+            return 0
+        else:
+            logger.info('File %s exists but incomplete (< 200Kb): downloading again' % image_name)
+            os.remove(image_name)
+    if record is not None and record['status'] in ('downloading', 'failed') and record['validator'] and \
+            os.path.isfile('tmp_' + image_name):
+        validator = record['validator']
+        resume = record['segments']
+        logger.info('Resuming download of %s (%.1f MB received in a previous run)' %
+                    (image_name, (record['bytes_received'] or 0) / 10**6))
+        if resume is None and os.stat('tmp_' + image_name).st_size > (record['bytes_received'] or 0):
+            # preallocated file, or bytes written after the last checkpoint (not flushed when interrupted)
+            os.truncate('tmp_' + image_name, record['bytes_received'] or 0)
+    elif os.path.isfile('tmp_' + image_name):
+        os.remove('tmp_' + image_name)
+    # failures are retried as set by the retry policy, downloads wait while the host is failing (circuit breaker)
+    circuit = get_circuit(URL_GET_FILE_COPERNICUS if access_platform == 'copernicus' else url_dwld)
+    attempts = 0
+    handle = None
+    while True:
+        circuit.wait()
+        t_start = monotonic()
+        try:
+            logger.info('Downloading %s' % image_name)
+            # segments left are requested once the file is checked, the partial file has holes
+            headers = {} if resume else range_headers('tmp_' + image_name, validator)
+            # reuse connections of the thread session
+            s = get_session()
+            r, login_key, url = request_platform(s, 'tmp_' + image_name, url_dwld,
+                                                 access_platform, username, password, login_key, headers)
+            sleep(0.1)
+            if r.status_code == 416:
+                # requested range not satisfiable
+                open('tmp_' + image_name, 'wb').close()
+            r.raise_for_status()
+            if access_platform == 'copernicus':
+                r.close()
+                r = s.get(url, allow_redirects=True, stream=True, headers=headers, timeout=_http_config['timeout'])
+                r.raise_for_status()
+                auth = None
+            else:  # creodias is DEPRECATED
+                auth = None if access_platform == 'creodias' else (username, password)
+            if resume is None:
+                # known before writing so that the next attempt resumes the partial file if this one fails
+                validator = get_validator(r)
+            with r:
+                handle, validator, file_hash = write_granule(s, r, image_name, headers, validator, resume, segments,
+                                                             auth, show_progress, state, checksum)
+            if handle:
+                handle.close()
+            os.rename('tmp_' + image_name, image_name)
+            file_sz = os.stat(image_name).st_size
+            if state is not None:
+                state.done(image_name, file_sz, file_hash)
+            # metrics by host serving the file (after redirection)
+            host = urlsplit(r.url).netloc
+            metrics.observe('download_seconds', monotonic() - t_start, host=host)
+            metrics.inc('download_bytes_total', file_sz, host=host)
+            metrics.inc('downloads_total', status='done')
+            circuit.success()
+            return file_sz
+        except Exception as e:
+            logger.exception('Error downloading %s: %s' % (image_name, e))
+            if handle:
+                handle.close()
+            attempts += 1
+            if _retry_policy.temporary(e):
+                circuit.failure(get_retry_after(e))
+            # segmented downloads recorded in state are resumed, single stream ones restart from the end of the file
+            resume = state.get(image_name)['segments'] if state is not None and validator is not None else None
+            if validator is None and os.path.isfile('tmp_' + image_name):
+                os.remove('tmp_' + image_name)
+            if os.path.isfile(image_name):
+                os.remove(image_name)
+            if _retry_policy.retryable(e, attempts):
+                _retry_policy.wait(attempts, e, 'download', 'Download of %s' % image_name)
+            else:
+                metrics.inc('downloads_total', status='failed')
+                if state is not None:
+                    # partial file is kept to be resumed by the next run
+                    state.failed(image_name)
+                elif os.path.isfile('tmp_' + image_name):
+                    os.remove('tmp_' + image_name)
+                logger.exception('%d download attempts failed: aborted.\n'
+                                 '\t- Did you accept the End User License Agreement for this dataset ?\n'
+                                 '\t- Check login/username.\n'
+                                 '\t- Check image name/url in *.csv file\n'
+                                 '\t- Check for connection problems \n'
+                                 '\t- Check for blocked IP \n' % attempts)
+                # Earthdata download issuecheck https://oceancolor.gsfc.nasa.gov/forum/oceancolor/topic_show.pl?tid=6447
+                # When IP blocked on Earthdata email: connection_problems@oceancolor.gsfc.nasa.gov)
+                return None
+
+
+def login_download(img_names, urls, instrument, access_platform, username, password, workers=1, segments=1,
+                   state=None, show_progress=True):
     # Login to Earth Data and Download image
+    # Progress of each download is printed if show_progress and images are downloaded one at a time
     if len(urls) == 0 or len(img_names) == 0:
         logger.warning('No image to download.')
         return None
     # remove duplicate from image and url lists
     logger.info('Removing duplicates from %s image list' % instrument)
-    if instrument == 'OLCI' or instrument == 'MSI':
-        # select the most recent version of all images
-        img_names, urls = sel_most_recent_esa(img_names, urls, instrument)
-    else:
-        img_names, urls = clean_nrt_nt_files(img_names, urls)
-    image_names = []
-    url_dwld = []
-    for x in range(len(img_names)):
-        if img_names[x] not in image_names:
-            image_names.append(img_names[x])
-            url_dwld.append(urls[x])
-    # remove empty string from image and url lists
-    image_names = list(filter(None, image_names))
-    url_dwld = list(filter((URL_CREODIAS_GET_FILE + '/').__ne__, url_dwld))
-    url_dwld = list(filter((URL_GET_FILE_CMR).__ne__, url_dwld))
-    url_dwld = list(filter((URL_GET_FILE_CGI).__ne__, url_dwld))
+    with metrics.timer('stage_seconds', stage='dedup'):
+        image_names, url_dwld = select_granule_versions(img_names, urls, instrument)
     if access_platform == 'creodias':
         # get login key to include it into url
         login_key = get_login_key(username, password)
         sleep(1)
     else:
         login_key = None
-    handle = None
-    for i in range(len(url_dwld)):
-        dwnld_bool = True
-        if os.path.isfile(image_names[i]):
-            if float(os.stat(image_names[i]).st_size) > 2*10**5:
-                dwnld_bool = False
-                logger.info('Skip ' + image_names[i])
+    # number of simultaneous downloads is capped by the access platform
+    n_workers = max(1, min(workers, MAX_WORKERS_PLATFORM.get(access_platform, 1)))
+    if n_workers < workers:
+        logger.info('%s allows at most %i simultaneous downloads: using %i workers' %
+                    (access_platform, n_workers, n_workers))
+    t_start = time()
+    total_bytes = 0
+    with metrics.timer('stage_seconds', stage='download', platform=access_platform):
+        if n_workers == 1:
+            for i in range(len(url_dwld)):
+                file_sz = download_granule(image_names[i], url_dwld[i], access_platform, username, password, login_key,
+                                           show_progress, segments, state)
+                if file_sz is None:
+                    return None
+                total_bytes += file_sz
+        else:
+            logger.info('Downloading %i images with %i workers' % (len(url_dwld), n_workers))
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(download_granule, image_names[i], url_dwld[i], access_platform,
+                                           username, password, login_key, False, segments, state)
+                           for i in range(len(url_dwld))]
+                for future in as_completed(futures):
+                    file_sz = future.result()
+                    if file_sz is None:
+                        # abort queued downloads, running ones finish before leaving the pool
+                        for f in futures:
+                            f.cancel()
+                        return None
+                    total_bytes += file_sz
+    elapsed = time() - t_start
+    logger.info('Downloaded %.1f MB in %.1f s (%.2f MB/s, %.1f Mb/s)' %
+                (total_bytes / 10**6, elapsed, total_bytes / 10**6 / max(elapsed, 1e-3),
+                 total_bytes * 8 / 10**6 / max(elapsed, 1e-3)))
+    return total_bytes
+
+
+class DownloadStream:
+    # Download images while the points of interest are still queried: images found by each query are de-duplicated
+    # and put in a bounded queue consumed by the download workers (queries wait while the queue is full)
+    # Images are recorded in state as they arrive, the image list is marked complete by close()
+    # Versions of an image (NRT, reprocessing) are only selected among the images found by the same query
+    def __init__(self, instrument, access_platform, username, password, workers=1, segments=1, state=None,
+                 queue_size=STREAM_QUEUE_SIZE, show_progress=True):
+        self.instrument = instrument
+        self.access_platform = access_platform
+        self.username = username
+        self.password = password
+        self.segments = segments
+        self.state = state
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.total_bytes = 0
+        self.n_images = 0
+        if state is not None:
+            state.clear()
+        self.login_key = get_login_key(username, password) if access_platform == 'creodias' else None
+        # number of simultaneous downloads is capped by the access platform
+        n_workers = max(1, min(workers, MAX_WORKERS_PLATFORM.get(access_platform, 1)))
+        if n_workers < workers:
+            logger.info('%s allows at most %i simultaneous downloads: using %i workers' %
+                        (access_platform, n_workers, n_workers))
+        self.show_progress = show_progress and n_workers == 1
+        self.t_start = time()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(n_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, img_names, urls, checksums=None, poi=None):
+        # Queue images found by one query (callback of get_image_list_*), images already queued are ignored
+        with metrics.timer('stage_seconds', stage='dedup'):
+            img_names, urls = select_granule_versions(img_names, urls, self.instrument)
+        with self.lock:
+            new = [(name, url) for name, url in zip(img_names, urls) if name not in self.seen]
+            self.seen.update(name for name, _ in new)
+            self.n_images += len(new)
+        if len(new) == 0:
+            return
+        if self.state is not None:
+            self.state.append([name for name, _ in new], [url for _, url in new],
+                              {name: checksums[name] for name, _ in new if name in (checksums or {})})
+        for item in new:
+            while not self.failed.is_set():
+                try:
+                    self.queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.failed.is_set():
+                # abort queued downloads
+                continue
+            file_sz = download_granule(item[0], item[1], self.access_platform, self.username, self.password,
+                                       self.login_key, self.show_progress, self.segments, self.state)
+            if file_sz is None:
+                self.failed.set()
             else:
-                logger.info('File %s exists but incomplete (< 200Kb): downloading again' % image_names[i])
-                os.remove(image_names[i])
-        elif os.path.isfile('tmp_' + image_names[i]):
-            os.remove('tmp_' + image_names[i])
-        if dwnld_bool:
-            max_retries = 10
-            wait_seconds = 30
-            attempts = 0
-            while attempts < max_retries:
+                with self.lock:
+                    self.total_bytes += file_sz
+
+    def close(self):
+        # Wait for queued downloads, return number of bytes downloaded or None if a download failed
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        elapsed = time() - self.t_start
+        metrics.observe('stage_seconds', elapsed, stage='download', platform=self.access_platform)
+        if self.failed.is_set():
+            return None
+        if self.state is not None:
+            self.state.set_complete()
+        logger.info('Downloaded %i images, %.1f MB in %.1f s (%.2f MB/s, %.1f Mb/s)' %
+                    (self.n_images, self.total_bytes / 10**6, elapsed, self.total_bytes / 10**6 / max(elapsed, 1e-3),
+                     self.total_bytes * 8 / 10**6 / max(elapsed, 1e-3)))
+        return self.total_bytes
+
+
+# Image found for a point of interest by Client.query: checksum is a tuple (algorithm, value), None if not published
+Match = namedtuple('Match', ['poi', 'image_name', 'url', 'checksum'])
+
+
+def read_pois(pois, chunk_size=STREAM_CHUNK_SIZE):
+    # Yield data frames (id, dt, lat, lon) of up to chunk_size points of interest read from a data frame or from any
+    # iterable of (id, dt, lat, lon) tuples or dictionaries, so that long or endless sources are read lazily
+    if isinstance(pois, pd.DataFrame):
+        for k in range(0, len(pois), chunk_size):
+            yield pois.iloc[k:k + chunk_size].copy()
+        return
+    rows = iter(pois)
+    while True:
+        chunk = pd.DataFrame.from_records([row for _, row in zip(range(chunk_size), rows)],
+                                          columns=['id', 'dt', 'lat', 'lon'])
+        if len(chunk) == 0:
+            return
+        chunk['dt'] = pd.to_datetime(chunk['dt'])
+        yield chunk
+
+
+class Client:
+    # Query and download images from python instead of the command line, e.g. to embed getOC in a service
+    # Parameters are those of the command line options, the password is never prompted
+    # HTTP sessions, rate limits, and query cache are shared by all clients of the process, so a client can be kept
+    # and reused across requests, a download state (DownloadState or sqlite file name) records checksums and progress
+    # Images are downloaded in the working directory
+    def __init__(self, instrument, level='L2', product='OC', username=None, password=None, dn_flag='both',
+                 cloud_cover='[0,100]', bounding_box_sz=60, query_delay=1, query_workers=1, coalesce=False,
+                 resolution='4km', binning_period='8D', workers=1, segments=1, state=None,
+                 chunk_size=STREAM_CHUNK_SIZE, show_progress=False, footprint_index=False):
+        self.instrument = instrument
+        self.level = level
+        self.product = product
+        self.username = username
+        self.password = password
+        self.dn_flag = dn_flag
+        self.cloud_cover = cloud_cover
+        self.bounding_box_sz = bounding_box_sz
+        self.query_delay = query_delay
+        self.query_workers = query_workers
+        self.coalesce = coalesce
+        self.resolution = resolution
+        self.binning_period = binning_period
+        self.workers = workers
+        self.segments = segments
+        self.state = DownloadState(state) if isinstance(state, str) else state
+        self.chunk_size = chunk_size
+        self.show_progress = show_progress
+        self.footprint_index = footprint_index
+        self.access_platform = get_access_platform(instrument, level)
+        try:
+            self.query_string = set_query_string(self.access_platform, instrument, level, product)
+        except SystemExit:
+            raise ValueError('%s level %s product %s not supported' % (instrument, level, product))
+
+    def query_chunk(self, pois, callback=None):
+        # Query images of a data frame of points of interest (id, dt, lat, lon) with get_image_list_*
+        # Return ImageTable of the images found, callback as in query_pois
+        if self.access_platform == 'copernicus':
+            return get_image_list_copernicus(pois, self.access_platform, self.query_string, self.instrument,
+                                             self.level, self.cloud_cover, self.query_workers, self.coalesce,
+                                             bounding_box_sz=self.bounding_box_sz, callback=callback,
+                                             footprint_index=self.footprint_index)
+        elif self.access_platform == 'L1L2_browser':
+            return get_image_list_l12browser(pois, self.access_platform, self.query_string, self.instrument,
+                                             self.level, self.product, self.query_delay, self.query_workers,
+                                             bounding_box_sz=self.bounding_box_sz, callback=callback)
+        return get_image_list_cmr(pois, self.access_platform, self.query_string, self.instrument, self.level,
+                                  self.product, self.dn_flag, self.query_workers, self.coalesce,
+                                  bounding_box_sz=self.bounding_box_sz, callback=callback,
+                                  resolution=self.resolution, binning_period=self.binning_period,
+                                  footprint_index=self.footprint_index)
+
+    def query(self, pois):
+        # Yield a Match for every image found for each point of interest as soon as its query is completed
+        # Queries of a chunk of points of interest run in a background thread, the next chunk is read once they are
+        # all completed
+        for chunk in read_pois(pois, self.chunk_size):
+            ids = dict(zip(chunk.index, chunk['id']))
+            found = queue.Queue()
+
+            def run(chunk=chunk, found=found):
                 try:
-                    # Open session
-                    logger.info('Downloading %s' % image_names[i])
-                    with requests.Session() as s:
-                        r, login_key, url = request_platform(s, 'tmp_' + image_names[i], url_dwld[i],
-                                                             access_platform, username, password, login_key)
-                        sleep(0.1)
-                        r.raise_for_status()
-                        if access_platform == 'copernicus':
-                            with s.get(url, allow_redirects=True, stream=True) as file:
-                                file.raise_for_status()
-                                expected_length = int(file.headers.get('Content-Length'))
-                                handle = download_files(file, 'tmp_' + image_names[i], expected_length)
-                        elif access_platform == 'creodias' or 'cmr':  # creodias is DEPRECATED
-                            expected_length = int(r.headers.get('Content-Length'))
-                            handle = download_files(r, 'tmp_' + image_names[i], expected_length)
-                        else:
-                            with open('tmp_' + image_names[i], "ab") as handle:
-                                for chunk in r.iter_content(chunk_size=128*1024):
-                                    if chunk:
-                                        handle.write(chunk)
-                            if handle.closed:
-                                handle = open('tmp_' + image_names[i], "ab")
-                            handle.flush()
-                            actual_length = float(os.stat('tmp_' + image_names[i]).st_size)
-                            if actual_length < 2*10**5:
-                                raise IOError('Download incomplete (< 200Kb): %i bytes downloaded' % actual_length)
-                        handle.close()
-                        os.rename('tmp_' + image_names[i], image_names[i])
-                        break
-                except Exception as e:
-                    logger.exception('Error downloading %s: %s. Attempt [%i/%i] reconnection ...' %
-                                     (image_names[i], e, attempts+1, max_retries))
-                    if handle:
-                        handle.close()
-                    attempts += 1
-                    if os.path.isfile('tmp_' + image_names[i]):
-                        os.remove('tmp_' + image_names[i])
-                    if os.path.isfile(image_names[i]):
-                        os.remove(image_names[i])
-                    if attempts < max_retries:
-                        sleep(wait_seconds)
-                    else:
-                        logger.exception('%d All download attempts failed: aborted.\n'
-                                         '\t- Did you accept the End User License Agreement for this dataset ?\n'
-                                         '\t- Check login/username.\n'
-                                         '\t- Check image name/url in *.csv file\n'
-                                         '\t- Check for connection problems \n'
-                                         '\t- Check for blocked IP \n')
-                        # Earthdata download issuecheck https://oceancolor.gsfc.nasa.gov/forum/oceancolor/topic_show.pl?tid=6447
-                        # When IP blocked on Earthdata email: connection_problems@oceancolor.gsfc.nasa.gov)
+                    self.query_chunk(chunk, lambda imlist, urls, checksums=None, poi=None:
+                                     found.put((poi, imlist, urls, checksums)))
+                    found.put(None)
+                except BaseException as e:
+                    found.put(e)
+
+            threading.Thread(target=run, daemon=True).start()
+            while True:
+                item = found.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                poi, imlist, urls, checksums = item
+                for name, url in zip(imlist, urls):
+                    yield Match(ids[poi], name, url, (checksums or {}).get(name))
+
+    def download(self, matches):
+        # Download images of matches (e.g. returned by query), keeping one version of each image
+        # Images are appended to the download state (if any) so that their checksum is checked
+        # Return number of bytes downloaded or None if a download failed
+        img_names, urls, checksums = [], [], dict()
+        for m in matches:
+            img_names.append(m.image_name)
+            urls.append(m.url)
+            if m.checksum is not None:
+                checksums[m.image_name] = m.checksum
+        if len(img_names) == 0:
+            return 0
+        if self.state is not None:
+            self.state.append(img_names, urls, checksums)
+        return login_download(img_names, urls, self.instrument, self.access_platform, self.username, self.password,
+                              self.workers, self.segments, self.state, self.show_progress)
+
+    def stream(self, pois):
+        # Query points of interest and download images found at the same time (see DownloadStream)
+        # Return number of bytes downloaded or None if a download failed
+        stream = DownloadStream(self.instrument, self.access_platform, self.username, self.password, self.workers,
+                                self.segments, self.state, show_progress=self.show_progress)
+        try:
+            for chunk in read_pois(pois, self.chunk_size):
+                self.query_chunk(chunk, stream.put)
+        finally:
+            total_bytes = stream.close()
+        return total_bytes
+
+    def shard(self, pois, writer=None, owner=None):
+        # Query points of interest and download images found with other processes sharing the download state, e.g.
+        # the same command run on several hosts with the state on a shared file system (DownloadState(shared=True))
+        # pois: csv file name or data frame, read by chunks of chunk_size points of interest (the same in all processes)
+        # Each process claims (lease) chunks not queried yet, then images not downloaded yet by batches of workers, and
+        # leaves once the image list is complete and no work is leased by others (leases expire after LEASE_TTL
+        # seconds if a process dies). The process completing the image list writes it with writer (ImageListWriter)
+        # Return number of bytes downloaded by this process or None if a download failed
+        if self.state is None:
+            raise ValueError('sharded runs require a download state')
+        owner = owner or '%s:%i' % (socket.gethostname(), os.getpid())
+
+        def chunks():
+            if isinstance(pois, str):
+                return pd.read_csv(pois, names=['id', 'dt', 'lat', 'lon'], parse_dates=[1], chunksize=self.chunk_size)
+            return read_pois(pois, self.chunk_size)
+
+        started = time()
+        n_chunks = None
+        total_bytes = 0
+        with Heartbeat(self.state, owner):
+            while True:
+                if not self.state.complete() and (n_chunks is None or self.state.chunks_left(n_chunks)[1] > 0):
+                    n_chunks = 0
+                    for k, chunk in enumerate(chunks()):
+                        n_chunks = k + 1
+                        if self.state.claim_chunk(k, owner, self.chunk_size):
+                            metrics.inc('leases_claimed_total', kind='chunk')
+                            logger.info('%s: querying chunk %i (%i points of interest)' % (owner, k, len(chunk)))
+                            images = self.query_chunk(chunk)
+                            # versions are selected among all the images of the chunk, images are then downloaded
+                            # by batches which can not compare them
+                            with metrics.timer('stage_seconds', stage='dedup'):
+                                img_names, urls = select_granule_versions(images.names, images.urls,
+                                                                          self.instrument)
+                            self.state.chunk_done(k, images, img_names, urls)
+                    if self.state.chunks_left(n_chunks)[0] == 0 and self.state.claim_complete():
+                        logger.info('%s: image list complete (%i chunks)' % (owner, n_chunks))
+                        if writer is not None:
+                            for k, chunk in enumerate(chunks()):
+                                writer.write(self.state.chunk_images(chunk, k))
+                            writer.close()
+                img_names, urls = self.state.claim_images(owner, max(self.workers, 1), started)
+                if len(img_names) > 0:
+                    metrics.inc('leases_claimed_total', len(img_names), kind='image')
+                    file_sz = login_download(img_names, urls, self.instrument, self.access_platform, self.username,
+                                             self.password, self.workers, self.segments, self.state,
+                                             self.show_progress)
+                    self.state.release(owner)
+                    if file_sz is None:
                         return None
+                    total_bytes += file_sz
+                elif self.state.complete() and self.state.leased(owner) == 0:
+                    return total_bytes
+                else:
+                    # chunks or images leased by other processes, taken over if their lease expires
+                    sleep(SHARD_POLL)
+
+
+def read_image_pois(filename):
+    # Return dict of image name to the points of interest (id, dt, lat, lon) it was found for, read from an image list
+    # file written by ImageListWriter (dt formatted as in csv files)
+    images = dict()
+    if os.path.splitext(filename)[1] == '.csv':
+        with open(filename, newline='') as f:
+            for record in csv.reader(f):
+                if len(record) < 6 or not record[4]:
+                    continue
+                poi = (record[0], record[1], float(record[2]), float(record[3]))
+                for name in dict.fromkeys(record[4].split(';')):
+                    images.setdefault(name, []).append(poi)
+        return images
+    columns = ['id', 'dt', 'lat', 'lon', 'image_name']
+    if os.path.splitext(filename)[1] == '.arrow':
+        reader = pa.ipc.open_file(pa.memory_map(filename))
+        batches = (reader.get_batch(i).select(columns) for i in range(reader.num_record_batches))
+    else:
+        batches = pq.ParquetFile(filename, memory_map=True).iter_batches(columns=columns)
+    for batch in batches:
+        batch = batch.filter(pc.is_valid(batch.column(4)))
+        for poi_id, dt, lat, lon, name in zip(batch.column(0).to_pylist(),
+                                              pc.strftime(batch.column(1), '%Y/%m/%d %H:%M:%S').to_pylist(),
+                                              batch.column(2).to_pylist(), batch.column(3).to_pylist(),
+                                              batch.column(4).to_pylist()):
+            images.setdefault(name, []).append((poi_id, dt, lat, lon))
+    return images
+
+
+def find_variable(dataset, names):
+    # Return the first variable of names found in a netCDF dataset or its groups (e.g. navigation_data/latitude and
+    # geophysical_data/chlor_a in OB.DAAC level 2 files), None if not found
+    for name in names:
+        if name in dataset.variables:
+            return dataset.variables[name]
+    for group in dataset.groups.values():
+        variable = find_variable(group, names)
+        if variable is not None:
+            return variable
+    return None
+
+
+def to_xyz(lat, lon):
+    # Unit vectors of positions (degrees), the euclidean distance between them is the chord of the great circle
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord, 2) / 2)
+
+
+def nearest_pixels(lat, lon, poi_lat, poi_lon):
+    # Return row and column of the pixel nearest to each point of interest and its distance (km)
+    # lat, lon: navigation arrays of a swath (2D, NaN where invalid) or axes of a regular grid (1D, level 3 maps)
+    # Pixels of swaths are searched with a KD-tree on unit vectors (scipy) or by brute force without scipy
+    if lat.ndim == 1:
+        rows = np.abs(lat[np.newaxis, :] - poi_lat[:, np.newaxis]).argmin(axis=1)
+        cols = np.abs((lon[np.newaxis, :] - poi_lon[:, np.newaxis] + 180) % 360 - 180).argmin(axis=1)
+        pixel_lat, pixel_lon = lat[rows], lon[cols]
+    else:
+        valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        pixels = to_xyz(lat.ravel()[valid], lon.ravel()[valid])
+        points = to_xyz(poi_lat, poi_lon)
+        try:
+            nearest = spatial.cKDTree(pixels).query(points)[1]
+        except ImportError:
+            nearest = np.array([((pixels - point) ** 2).sum(axis=1).argmin() for point in points], dtype=int)
+        rows, cols = np.unravel_index(valid[nearest], lat.shape)
+        pixel_lat, pixel_lon = lat[rows, cols], lon[rows, cols]
+    distance = chord_to_km(np.linalg.norm(to_xyz(pixel_lat, pixel_lon) - to_xyz(poi_lat, poi_lon), axis=1))
+    return rows, cols, distance
+
+
+def extract_granule(file_name, pois, variables, size=MATCHUP_SIZE, max_distance=MATCHUP_MAX_DISTANCE):
+    # Extract the values of variables in the box of size x size pixels centered on each point of interest (id, dt, lat,
+    # lon) from a netCDF granule opened once, only the navigation arrays and the boxes are read
+    # Return dict of columns (MATCHUP_COLUMNS + variables), one row per pixel, values as floats (NaN if missing)
+    # Points of interest further than max_distance km from the nearest pixel are skipped
+    columns = {column: [] for column in MATCHUP_COLUMNS + variables}
+    with nc.Dataset(file_name) as dataset:
+        lat = find_variable(dataset, ['latitude', 'lat'])
+        lon = find_variable(dataset, ['longitude', 'lon'])
+        if lat is None or lon is None:
+            raise ValueError('no latitude and longitude variables')
+        lat = np.ma.filled(np.ma.asarray(lat[:], dtype=float), np.nan)
+        lon = np.ma.filled(np.ma.asarray(lon[:], dtype=float), np.nan)
+        shape = lat.shape if lat.ndim == 2 else (len(lat), len(lon))
+        found = {name: find_variable(dataset, [name]) for name in variables}
+        image_time = getattr(dataset, 'time_coverage_start', None)
+        rows, cols, distance = nearest_pixels(lat, lon, np.array([p[2] for p in pois], dtype=float),
+                                              np.array([p[3] for p in pois], dtype=float))
+        for poi, row, col in zip([p for p, d in zip(pois, distance) if d <= max_distance],
+                                 rows[distance <= max_distance], cols[distance <= max_distance]):
+            r0, r1 = max(row - size // 2, 0), min(row + size // 2 + 1, shape[0])
+            c0, c1 = max(col - size // 2, 0), min(col + size // 2 + 1, shape[1])
+            box_rows, box_cols = [a.ravel() for a in np.meshgrid(np.arange(r0, r1), np.arange(c0, c1), indexing='ij')]
+            if lat.ndim == 2:
+                pixel_lat, pixel_lon = lat[box_rows, box_cols], lon[box_rows, box_cols]
+            else:
+                pixel_lat, pixel_lon = lat[box_rows], lon[box_cols]
+            for k, value in enumerate(poi):
+                columns[MATCHUP_COLUMNS[k]].extend([value] * len(box_rows))
+            columns['image_name'].extend([os.path.basename(file_name)] * len(box_rows))
+            columns['image_time'].extend([image_time] * len(box_rows))
+            columns['row'].extend(box_rows.tolist())
+            columns['col'].extend(box_cols.tolist())
+            columns['pixel_lat'].extend(pixel_lat.tolist())
+            columns['pixel_lon'].extend(pixel_lon.tolist())
+            columns['distance'].extend(chord_to_km(np.linalg.norm(
+                to_xyz(pixel_lat, pixel_lon) - to_xyz(poi[2], poi[3]), axis=1)).tolist())
+            for name, variable in found.items():
+                # variables missing or not on the pixel grid (e.g. 1D or 3D) are NaN
+                if variable is None or variable.ndim != 2:
+                    columns[name].extend([float('nan')] * len(box_rows))
+                else:
+                    columns[name].extend(np.ma.filled(np.ma.asarray(variable[r0:r1, c0:c1], dtype=float),
+                                                      np.nan).ravel().tolist())
+    return columns
+
+
+class MatchupWriter:
+    # Write the matchups extracted from each granule (columns returned by extract_granule) in csv (with header),
+    # parquet, or arrow file as they arrive
+    def __init__(self, filename, variables, file_format='csv'):
+        self.filename = filename
+        self.file_format = file_format
+        self.columns = MATCHUP_COLUMNS + variables
+        self.file = None
+        self.writer = None
+        self.rows = 0
+
+    def write(self, columns):
+        if self.file_format == 'csv':
+            if self.file is None:
+                self.file = open(self.filename, 'w', newline='')
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(self.columns)
+            self.writer.writerows(zip(*[columns[c] for c in self.columns]))
+        else:
+            types = [pa.string(), pa.string(), pa.float64(), pa.float64(), pa.string(), pa.string(), pa.int64(),
+                     pa.int64()] + [pa.float64()] * (len(self.columns) - 8)
+            table = pa.Table.from_arrays([pa.array(columns[c], t) for c, t in zip(self.columns, types)],
+                                         names=self.columns)
+            table = table.set_column(1, 'dt', pc.strptime(table.column(1), '%Y/%m/%d %H:%M:%S', 'us'))
+            if self.writer is None and self.file_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.filename, table.schema)
+            elif self.writer is None:
+                self.writer = pa.ipc.new_file(self.filename, table.schema)
+            self.writer.write_table(table)
+        self.rows += len(columns['id'])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        elif self.writer is not None:
+            self.writer.close()
+
+
+def extract_matchups(image_list, variables, filename, file_format='csv', size=MATCHUP_SIZE, workers=None,
+                     directory='.'):
+    # Extract the values of variables around the points of interest of an image list file from the netCDF images
+    # downloaded in directory (see extract_granule), each image is opened once by one of workers processes (number of
+    # CPUs by default) and its matchups are written in filename (MatchupWriter) as soon as it is done
+    # Return number of rows written
+    images = read_image_pois(image_list)
+    files = [(os.path.join(directory, name), pois) for name, pois in images.items()
+             if os.path.splitext(name)[1] in ('.nc', '.nc4') and os.path.isfile(os.path.join(directory, name))]
+    if len(files) < len(images):
+        logger.info('Extracting matchups from %i images, %i images not downloaded or not in netCDF format skipped' %
+                    (len(files), len(images) - len(files)))
+    writer = MatchupWriter(filename, variables, file_format)
+    with metrics.timer('stage_seconds', stage='extract'), ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract_granule, file_name, pois, variables, size): file_name
+                   for file_name, pois in files}
+        for future in as_completed(futures):
+            try:
+                writer.write(future.result())
+            except Exception as e:
+                logger.warning('Unable to extract matchups from %s: %s' % (futures[future], e))
+                metrics.inc('extract_failures_total')
+    writer.close()
+    logger.info('Extracted %i pixels from %i images in %s' % (writer.rows, len(files), filename))
+    return writer.rows
 
 
 if __name__ == "__main__":
@@ -804,6 +3077,21 @@ if __name__ == "__main__":
                       "not available for CREODIAS queries (OLCI, SLSTR and MSI)")
     parser.add_option("-d", "--delay", action="store", dest="query_delay", type='float', default=1,
                       help="Delay between queries only needed to query L1L2_browser")
+    parser.add_option("--query-workers", action="store", dest="query_workers", type='int', default=1,
+                      help="number of queries sent simultaneously, default = 1")
+    parser.add_option("--coalesce", action="store_true", dest="coalesce", default=False,
+                      help="merge queries of points of interest with overlapping bounding boxes and time windows "
+                           "(CMR and Copernicus only)")
+    parser.add_option("--footprint-index", action="store_true", dest="footprint_index", default=False,
+                      help="search the images of each day once (whole globe) and match the footprints of the images "
+                           "with the points of interest locally (CMR and Copernicus only)")
+    parser.add_option("--cache", action="store", dest="cache", type='str', default=None,
+                      help="cache query responses in sqlite file to skip identical queries in following runs")
+    parser.add_option("--cache-size", action="store", dest="cache_size", type='float', default=512,
+                      help="maximum size of the query cache in MB, default = 512")
+    parser.add_option("--query-rate", action="store", dest="query_rate", type='float', default=None,
+                      help="maximum number of queries per second sent to CMR or Copernicus "
+                           "(default = 10 for CMR and 5 for Copernicus)")
     # Level 3 specific options
     parser.add_option("-b", "--binning-period", action="store", dest="binning_period", default='8D',
                       help="specify binning period (only for L3), available options are: DAY, 8D, MO, and YR")
@@ -819,14 +3107,102 @@ if __name__ == "__main__":
     parser.add_option("--dn", "--day-night-flag", action="store", dest="dn_flag", type='str', default='both',
                       help="Select day, night or both images, default = both")
     parser.add_option("-r", "--read-image-list", action="store_true", dest="read_image_list", default=False,
-                      help="Read previous query from csv file")
+                      help="Read previous query from image list file (csv, parquet, or arrow)")
+    parser.add_option("--format", action="store", dest="image_list_format", type='choice',
+                      choices=IMAGE_LIST_FORMATS, default='csv',
+                      help="format of the image list file written: csv (default), parquet, or arrow (require pyarrow)")
     parser.add_option("-q", "--quiet", action="store_false", dest="verbose", default=True)
     parser.add_option("--box", "--bounding-box-size", action="store", dest="bounding_box_sz", type='float', default=60,
                       help="specify bounding box size in nautical miles")
     parser.add_option("-c", "--cloud-cover", action="store", dest="cloud_cover", type='str', default='[0, 100]',
                       help="specify cloud cover interval to download")
+    parser.add_option("--pool-size", action="store", dest="pool_size", type='int', default=HTTP_POOL_SIZE,
+                      help="number of connections kept alive per host, default = %i" % HTTP_POOL_SIZE)
+    parser.add_option("--timeout", action="store", dest="timeout", type='float', default=HTTP_TIMEOUT[1],
+                      help="seconds without data received before a query or download is aborted, "
+                           "default = %i" % HTTP_TIMEOUT[1])
+    parser.add_option("--retries", action="store", dest="retries", type='int', default=RETRY_MAX_ATTEMPTS,
+                      help="attempts of a query or download failing with a temporary error (connection, timeout, "
+                           "HTTP 429 or 5xx), default = %i" % RETRY_MAX_ATTEMPTS)
+    parser.add_option("--max-backoff", action="store", dest="max_backoff", type='float', default=RETRY_MAX_DELAY,
+                      help="longest wait (seconds) between two attempts, unless the server asks for more "
+                           "(Retry-After), default = %i" % RETRY_MAX_DELAY)
+    parser.add_option("--workers", action="store", dest="workers", type='int', default=1,
+                      help="number of images downloaded simultaneously (capped per access platform), default = 1")
+    parser.add_option("--segments", action="store", dest="segments", type='int', default=1,
+                      help="number of simultaneous connections used to download large images (> 100 MB), "
+                           "default = 1")
+    parser.add_option("--buffer-size", action="store", dest="buffer_size", type='float',
+                      default=DOWNLOAD_BUFFER_SIZE / 2**20,
+                      help="MB read from the connection and written to disk at once, default = %g" %
+                           (DOWNLOAD_BUFFER_SIZE / 2**20))
+    parser.add_option("--no-preallocate", action="store_false", dest="preallocate", default=True,
+                      help="do not reserve the disk space of images before downloading them")
+    parser.add_option("--fsync", action="store_true", dest="fsync", default=False,
+                      help="force images to disk (fsync) once downloaded and each time progress is recorded")
+    parser.add_option("--stream", action="store_true", dest="stream", default=False,
+                      help="download images as soon as they are found instead of after querying all points of "
+                           "interest, the input file is read by chunks")
+    parser.add_option("--chunk-size", action="store", dest="chunk_size", type='int', default=STREAM_CHUNK_SIZE,
+                      help="number of points of interest read at once in streaming and sharded modes, default = %i" %
+                           STREAM_CHUNK_SIZE)
+    parser.add_option("--shard", action="store_true", dest="shard", default=False,
+                      help="share queries and downloads with other getOC processes run with the same arguments and "
+                           "download state (on a shared file system for several hosts), in chunks of --chunk-size "
+                           "points of interest")
+    parser.add_option("--extract", action="store", dest="extract", type='str', default=None,
+                      help="extract variables (comma separated, e.g. chlor_a,Rrs_443,l2_flags) around the points of "
+                           "interest from the netCDF images downloaded in a matchup table (requires netCDF4)")
+    parser.add_option("--extract-size", action="store", dest="extract_size", type='int', default=MATCHUP_SIZE,
+                      help="size of the box of pixels extracted around the points of interest, default = %i" %
+                           MATCHUP_SIZE)
+    parser.add_option("--extract-workers", action="store", dest="extract_workers", type='int', default=None,
+                      help="number of processes extracting matchups, default = number of CPUs")
+    parser.add_option("--state", action="store", dest="state", type='str', default=None,
+                      help="sqlite file recording the image list and download progress to resume interrupted runs, "
+                           "default = image list csv file with extension .db")
+    parser.add_option("--metrics", action="store", dest="metrics", type='str', default=None,
+                      help="write json summary of the run (time per stage, queries, retries, bytes per host) in file")
+    parser.add_option("--prometheus", action="store", dest="prometheus", type='str', default=None,
+                      help="write metrics of the run in Prometheus textfile (read by node_exporter textfile collector)")
+    parser.add_option("--profile", action="store", dest="profile", type='str', default=None,
+                      help="profile the run with cProfile and write statistics in file (read with pstats)")
+    parser.add_option("--trace-memory", action="store_true", dest="trace_memory", default=False,
+                      help="trace memory allocations with tracemalloc, the peak is logged and added to metrics "
+                           "(slows down the run)")
     (options, args) = parser.parse_args()
-    verbose = options.verbose
+    if options.profile or options.trace_memory or options.metrics or options.prometheus:
+        import atexit
+        if options.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if options.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+
+        def write_metrics():
+            # also called when the run is aborted
+            metrics.set('run_seconds', time() - metrics.t_start)
+            metrics.set('last_run_timestamp_seconds', time())
+            if options.profile:
+                profiler.disable()
+                profiler.dump_stats(options.profile)
+                logger.info('Profile written in %s' % options.profile)
+            if options.trace_memory:
+                metrics.set('memory_peak_bytes', tracemalloc.get_traced_memory()[1])
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[0:10]:
+                    logger.info('Memory allocated: %s' % stat)
+                logger.info('Peak memory allocated: %.1f MB' % (tracemalloc.get_traced_memory()[1] / 10**6))
+                tracemalloc.stop()
+            if options.metrics:
+                metrics.write_json(options.metrics)
+            if options.prometheus:
+                metrics.write_prometheus(options.prometheus)
+        atexit.register(write_metrics)
+    configure_sessions(options.pool_size, (HTTP_TIMEOUT[0], options.timeout))
+    configure_writes(max(int(options.buffer_size * 2**20), 2**16), options.preallocate, options.fsync)
+    configure_retries(max(options.retries, 1), options.max_backoff)
     if options.instrument is None:
         logger.info(parser.usage)
         logger.info('getOC.py: error: option -i, --instrument is required')
@@ -835,6 +3211,18 @@ if __name__ == "__main__":
         logger.info(parser.usage)
         logger.info('getOC.py: error: option -u, --username is required')
         sys.exit(-1)
+    if options.image_list_format != 'csv':
+        try:
+            importlib.import_module('pyarrow')
+        except ImportError:
+            logger.info('getOC.py: error: option --format=%s requires pyarrow' % options.image_list_format)
+            sys.exit(-1)
+    if options.extract:
+        try:
+            importlib.import_module('netCDF4')
+        except ImportError:
+            logger.info('getOC.py: error: option --extract requires netCDF4')
+            sys.exit(-1)
     if len(args) < 1 and options.level:
         logger.info(parser.usage)
         logger.info('getOC.py: error: argument filename is required for Level GEO, L1A, or L2')
@@ -847,65 +3235,102 @@ if __name__ == "__main__":
     # options.level = options.level.replace('-', '_')
     image_names = list()
     url_dwld = list()
-    # Get list of images to download from written file if available
-    if options.read_image_list and os.path.isfile(os.path.splitext(args[0])[0] + '_' + options.instrument + '_' +
-                                                  options.level + '_' + options.product + '.csv'):
+    # Record image list and progress of downloads
+    image_list_name = os.path.splitext(args[0])[0] + '_' + options.instrument + '_' + options.level + '_' + \
+        options.product
+    state = DownloadState(options.state or image_list_name + '.db', shared=options.shard)
+    # Image list file written, or read with -r (in any format, the format selected first)
+    image_list_file = image_list_name + '.' + options.image_list_format
+    image_list_read = [image_list_name + '.' + f for f in [options.image_list_format] + IMAGE_LIST_FORMATS
+                       if os.path.isfile(image_list_name + '.' + f)]
+    # Get list of images to download from download state or written file if available
+    if options.shard:
+        # the image list is read from the download state shared by all processes (queried again if the state is new)
+        options.read_image_list = False
+    if options.read_image_list and state.complete():
+        options.write_image_names = False
+        access_platform, password = get_platform(None, options.instrument, options.level)
+        image_names, url_dwld = state.images()
+    elif options.read_image_list and image_list_read:
         options.write_image_names = False
-        pois = read_csv(os.path.splitext(args[0])[0] + '_' + options.instrument + '_' +
-                        options.level + '_' + options.product + '.csv',
-                        names=['id', 'dt', 'lat', 'lon', 'image_names', 'url'], parse_dates=[1])
-        pois.dropna(subset=['image_names'], axis=0, inplace=True)
-        points_of_interest = pois.copy()
-        access_platform, password = get_platform(points_of_interest['dt'], options.instrument, options.level)
-        # Parse image_names and url
-        for index, record in pois.iterrows():
-            # Convert 'stringified' list to list
-            imli = record['image_names'].split(';')
-            urli = record['url'].split(';')
-            for im in range(len(imli)):
-                image_names.append(imli[im])
-                url_dwld.append(urli[im])
+        access_platform, password = get_platform(None, options.instrument, options.level)
+        image_names, url_dwld = read_image_list(image_list_read[0])
+        state.register(image_names, url_dwld)
     elif options.read_image_list:
-        logger.exception('IOError: [Errno 2] Option -r (read) was selected, however, file ' +
-                         os.path.splitext(args[0])[0] + '_' + options.instrument + '_' + options.level + '_' +
-                         options.product + '.csv' + ' does not exist: option -w (write) was activated by default')
+        logger.exception('IOError: [Errno 2] Option -r (read) was selected, however, file ' + image_list_file +
+                         ' does not exist: option -w (write) was activated by default')
         options.write_image_names = True
     # Query list of images to download
+    stream = None
     if options.write_image_names:
-        # Parse csv file containing points of interest
-        points_of_interest = read_csv(args[0], names=['id', 'dt', 'lat', 'lon'], parse_dates=[1])
-        access_platform, password = get_platform(points_of_interest['dt'], options.instrument, options.level)
-        query_string = set_query_string(access_platform, options.instrument, options.level, options.product)
+        writer = ImageListWriter(image_list_file, options.image_list_format)
+        # Parse csv file containing points of interest (by chunks in streaming and sharded modes)
+        if options.shard:
+            chunks = []
+            access_platform, password = get_platform(None, options.instrument, options.level)
+        elif options.stream:
+            chunks = pd.read_csv(args[0], names=['id', 'dt', 'lat', 'lon'], parse_dates=[1],
+                              chunksize=options.chunk_size)
+            access_platform, password = get_platform(None, options.instrument, options.level)
+        else:
+            points_of_interest = pd.read_csv(args[0], names=['id', 'dt', 'lat', 'lon'], parse_dates=[1])
+            chunks = [points_of_interest]
+            access_platform, password = get_platform(points_of_interest['dt'], options.instrument, options.level)
+        try:
+            client = Client(options.instrument, options.level, options.product, options.username, password,
+                            options.dn_flag, options.cloud_cover, options.bounding_box_sz, options.query_delay,
+                            options.query_workers, options.coalesce, options.sresol, options.binning_period,
+                            options.workers, options.segments, state, chunk_size=options.chunk_size,
+                            show_progress=options.verbose,
+                            footprint_index=options.footprint_index)
+        except ValueError:
+            sys.exit(-1)
         # if access_platform == 'creodias':  # DEPRECATED
         #     pois = get_image_list_creodias(points_of_interest, access_platform,
         #                                    query_string, options.instrument, options.level)
         logger.info('Query %s level %s %s on %s' % (options.instrument, options.level, options.product, access_platform))#
-        if access_platform == 'copernicus':
-            pois = get_image_list_copernicus(points_of_interest, access_platform,
-                                             query_string, options.instrument, options.level, options.cloud_cover)
-        elif access_platform == 'L1L2_browser':
-            pois = get_image_list_l12browser(points_of_interest, access_platform, query_string, options.instrument,
-                                             options.level, options.product, options.query_delay)
-        elif access_platform == 'cmr':
-            pois = get_image_list_cmr(points_of_interest, access_platform, query_string, options.instrument,
-                                      options.level, options.product, options.dn_flag)
-        else:
+        if access_platform not in ['copernicus', 'L1L2_browser', 'cmr']:
             logger.exception('Error: plateform not recognized')
             sys.exit(-1)
-        points_of_interest = pois.copy()
-        # parse image_names
-        for _, poi in pois.iterrows():
-            image_names.extend(poi['image_names'])
-            url_dwld.extend(poi['url'])
-    # Write list of images to download in csv
-    if options.write_image_names:
-        # Reformat image names & url
-        for i, poi in points_of_interest.iterrows():
-            points_of_interest.at[i, 'image_names'] = ';'.join(poi['image_names'])
-            points_of_interest.at[i, 'url'] = ';'.join(poi['url'])
-        points_of_interest.to_csv(os.path.splitext(args[0])[0] + '_' + options.instrument + '_' +
-                                  options.level + '_' + options.product + '.csv',#
-                                  date_format='%Y/%m/%d %H:%M:%S', header=False, index=False, float_format='%.5f')
+        if access_platform == 'L1L2_browser' and (options.coalesce or options.footprint_index):
+            logger.info('Options --coalesce and --footprint-index are not available on L1L2_browser: querying each '
+                        'point of interest')
+        if options.cache:
+            set_query_cache(options.cache, int(options.cache_size * 10**6))
+        if options.query_rate is not None:
+            set_query_rate(access_platform, options.query_rate, options.query_workers)
+        if options.stream:
+            # images found are downloaded while the next points of interest are queried
+            stream = DownloadStream(options.instrument, access_platform, options.username, password,
+                                    options.workers, options.segments, state, show_progress=options.verbose)
+        if options.shard:
+            # chunks of points of interest and images are claimed in the download state
+            if client.shard(args[0], writer) is None:
+                logger.info('getOC.py: error: sharded run aborted, a download failed')
+                sys.exit(-1)
+        for points_of_interest in chunks:
+            images = client.query_chunk(points_of_interest, stream.put if stream is not None else None)
+            if stream is None:
+                image_names, url_dwld = images.image_list()
+                state.register(image_names, url_dwld, images.checksums)
+            # Write list of images to download (appended chunk by chunk in streaming mode)
+            writer.write(images)
+        writer.close()
     # Download images from url list
-    login_download(image_names, url_dwld, options.instrument, access_platform, options.username, password)
+    if stream is not None:
+        stream.close()
+    elif not options.shard:
+        login_download(image_names, url_dwld, options.instrument, access_platform, options.username, password,
+                       options.workers, options.segments, state, options.verbose)
     logger.info('Download completed')
+    # Extract matchups from the images downloaded (after sharded runs, run again with -r once all images are downloaded)
+    if options.extract and options.shard:
+        logger.info('Option --extract is ignored with --shard: extract matchups with -r once all images are downloaded')
+    elif options.extract:
+        image_list_read = [image_list_file] if options.write_image_names else image_list_read
+        if len(image_list_read) == 0:
+            logger.info('getOC.py: error: option --extract requires the image list file %s' % image_list_file)
+            sys.exit(-1)
+        extract_matchups(image_list_read[0], options.extract.split(','),
+                         image_list_name + '_matchups.' + options.image_list_format, options.image_list_format,
+                         options.extract_size, options.extract_workers)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import getOC  # noqa: E402
+import mock_servers  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def mock_server():
+    # Mock CMR, Copernicus, and L1L2 browser endpoints (benchmarks/mock_servers.py) in a background thread, all getOC
+    # queries and downloads are sent to it
+    config = mock_servers.MockConfig(file_size=10**5)
+    server = mock_servers.start_server(config)
+    base_url = 'http://127.0.0.1:%i' % server.server_address[1]
+    urls = {'URL_CMR': base_url + '/search/granules.umm_json?provider=OB_DAAC',
+            'URL_GET_FILE_CMR': base_url + '/ob/getfile/',
+            'URL_SEARCH_COPERNICUS': base_url + '/resto/api/collections/',
+            'URL_COPERNICUS_LOGIN': base_url + '/auth/realms/CDSE/protocol/openid-connect/token',
+            'URL_GET_FILE_COPERNICUS': base_url + '/odata/v1/Products',
+            'URL_L12BROWSER': base_url + '/cgi/browse.pl',
+            'URL_GET_FILE_CGI': base_url + '/cgi/getfile/'}
+    saved = {name: getattr(getOC, name) for name in urls}
+    for name, url in urls.items():
+        setattr(getOC, name, url)
+    for platform in ('cmr', 'copernicus'):
+        getOC.set_query_rate(platform, None)
+    yield config
+    for name, url in saved.items():
+        setattr(getOC, name, url)
+    server.shutdown()
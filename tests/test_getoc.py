@@ -0,0 +1,121 @@
+import random
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import getOC
+
+
+def write_pois(n, seed=0, lat=(-60, 60), lon=(-180, 180), spread=timedelta(days=364)):
+    # Synthetic points of interest (id, dt, lat, lon) in 2019, as read from getOC input files
+    rng = random.Random(seed)
+    t0 = datetime(2019, 1, 1)
+    return pd.DataFrame({'id': ['poi%i' % i for i in range(n)],
+                         'dt': [t0 + timedelta(seconds=rng.randint(0, int(spread.total_seconds())))
+                                for _ in range(n)],
+                         'lat': [rng.uniform(*lat) for _ in range(n)],
+                         'lon': [rng.uniform(*lon) for _ in range(n)]})
+
+
+def query_cmr(pois, coalesce=False, footprint_index=False):
+    query_string = getOC.set_query_string('cmr', 'MODIS-Aqua', 'L2', 'OC')
+    images = getOC.get_image_list_cmr(pois, 'cmr', query_string, 'MODIS-Aqua', 'L2', 'OC', coalesce=coalesce,
+                                      footprint_index=footprint_index)
+    return [images.images(k) for k in range(len(images))]
+
+
+def polygon_intersects_box(ring, box):
+    # Reference test: a vertex of the polygon is in the box, a corner of the box is in the polygon, or edges cross
+    w, s, e, n = box
+
+    def inside(x, y):
+        crossings = 0
+        for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                crossings += 1
+        return crossings % 2 == 1
+
+    def cross(p, q, r, t):
+        def orient(a, b, c):
+            return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+        return orient(p, q, r) * orient(p, q, t) < 0 and orient(r, t, p) * orient(r, t, q) < 0
+
+    corners = [(w, s), (e, s), (e, n), (w, n)]
+    if any(w <= x <= e and s <= y <= n for x, y in ring) or any(inside(x, y) for x, y in corners):
+        return True
+    return any(cross(a, b, c, d) for a, b in zip(ring, ring[1:] + ring[:1])
+               for c, d in zip(corners, corners[1:] + corners[:1]))
+
+
+def test_match_footprints_oblique_swath():
+    # Diagonal swath: its bounding box covers points of interest the polygon misses, which the server never returns
+    ring = [(0, 0), (1, 0), (10, 9), (10, 10), (9, 10), (0, 1)]
+    t = datetime(2019, 1, 1, 12)
+    granule = getOC.Granule('A.nc', 'url/A.nc', t, t + timedelta(minutes=5), 'Day', None, None, (0, 0, 10, 10),
+                            [ring])
+    window = (datetime(2019, 1, 1), datetime(2019, 1, 2))
+    assert getOC.match_footprints([granule], [(8, 0, 9, 1)], [window]) == [([], [])]
+    assert getOC.match_footprints([granule], [(4.5, 4.5, 5.5, 5.5)], [window]) == [(['A.nc'], ['url/A.nc'])]
+    rng = random.Random(0)
+    boxes = []
+    for _ in range(500):
+        x, y, size = rng.uniform(-1, 11), rng.uniform(-1, 11), rng.uniform(0.05, 1.5)
+        boxes.append((x, y, x + size, y + size))
+    found = getOC.match_footprints([granule], boxes, [window] * len(boxes))
+    assert [len(names) == 1 for names, _ in found] == [polygon_intersects_box(ring, box) for box in boxes]
+
+
+def test_coalesce_same_images(mock_server):
+    # Coalesced queries return the same images as the queries of each point of interest
+    pois = write_pois(60, lat=(25, 28), lon=(-66, -63), spread=timedelta(days=2))
+    images = query_cmr(pois)
+    assert any(names for names, _ in images)
+    assert query_cmr(pois, coalesce=True) == images
+
+
+def fake_query_chunk(found):
+    # Client.query_chunk returning found[poi id] (image names) for each point of interest of a chunk
+    def query_chunk(pois, callback=None):
+        return getOC.ImageTable(pois, [(found[i], ['https://host/%s' % name for name in found[i]])
+                                       for i in pois['id']])
+    return query_chunk
+
+
+def test_shard_versions_selected_per_chunk(tmp_path, monkeypatch):
+    # The NRT image is superseded by its refined version found for another point of interest of the chunk, even
+    # though images are leased one at a time (workers=1)
+    downloaded = []
+    monkeypatch.setattr(getOC, 'login_download', lambda names, urls, *args: downloaded.extend(names) or 0)
+    pois = write_pois(4)
+    found = {'poi0': ['AQUA_MODIS.20190101T000000.L2.OC.NRT.nc'],
+             'poi1': ['AQUA_MODIS.20190101T000000.L2.OC.nc', 'AQUA_MODIS.20190102T000000.L2.OC.NRT.nc'],
+             'poi2': [], 'poi3': ['AQUA_MODIS.20190101T000000.L2.OC.nc']}
+    client = getOC.Client('MODIS-Aqua', state=str(tmp_path / 'state.db'), workers=1, chunk_size=4)
+    client.query_chunk = fake_query_chunk(found)
+    writer = getOC.ImageListWriter(str(tmp_path / 'list.csv'))
+    assert client.shard(pois, writer) == 0
+    assert downloaded == ['AQUA_MODIS.20190101T000000.L2.OC.nc', 'AQUA_MODIS.20190102T000000.L2.OC.NRT.nc']
+    # the image list written keeps all the images found for each point of interest
+    assert getOC.read_image_pois(str(tmp_path / 'list.csv'))['AQUA_MODIS.20190101T000000.L2.OC.NRT.nc'][0][0] == \
+        'poi0'
+
+
+def test_shard_processes_share_work(tmp_path, monkeypatch):
+    # Clients sharing a download state query each chunk and download each image once
+    downloaded, queried = [], []
+    monkeypatch.setattr(getOC, 'SHARD_POLL', 0.05)
+    monkeypatch.setattr(getOC, 'login_download', lambda names, urls, *args: downloaded.extend(names) or len(names))
+    pois = write_pois(50)
+    found = {poi_id: ['AQUA_MODIS.2019%04iT000000.L2.OC.nc' % (i // 3)] for i, poi_id in enumerate(pois['id'])}
+    query_chunk = fake_query_chunk(found)
+    clients = []
+    for owner in ('a', 'b', 'c'):
+        client = getOC.Client('MODIS-Aqua', state=getOC.DownloadState(str(tmp_path / 'state.db'), shared=True),
+                              workers=2, chunk_size=10)
+        client.query_chunk = lambda chunk, callback=None: queried.append(chunk['id'].iloc[0]) or query_chunk(chunk)
+        clients.append((client, owner))
+    with getOC.ThreadPoolExecutor(max_workers=3) as executor:
+        totals = list(executor.map(lambda c: c[0].shard(pois, owner=c[1]), clients))
+    assert sorted(queried) == sorted(pois['id'][::10])
+    assert sorted(downloaded) == sorted(set(name for names in found.values() for name in names))
+    assert sum(totals) == len(downloaded)